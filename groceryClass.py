@@ -1,7 +1,16 @@
 import streamlit as st
 import sqlite3
 import hashlib
-from typing import List, Dict
+from typing import List, Dict, NamedTuple
+
+
+class Match(NamedTuple):
+    """An item the user and a friend both want, in the user's unit (as models.Match in test/)."""
+    item: str
+    user_quantity: float
+    friend_quantity: float
+    unit: str
+
 
 class GroceryShareApp:
     def __init__(self):
@@ -90,37 +99,30 @@ class GroceryShareApp:
                        (username, item, quantity, unit))
         self.conn.commit()
 
-    def find_matching_groceries(self, username: str) -> Dict[str, List[Dict]]:
-        """Find matching grocery items among friends."""
-        friends = self.get_friends(username)
-        cursor = self.conn.cursor()
+    def find_matching_groceries(self, username: str) -> Dict[str, List[Match]]:
+        """Find matching grocery items among friends.
 
-        # Get current user's grocery items
-        cursor.execute('SELECT item, quantity, unit FROM grocery_lists WHERE username = ?', (username,))
-        user_items = cursor.fetchall()
+        Matches for every friend are resolved in one set-based join over
+        ``friends`` and ``grocery_lists`` instead of one lookup per
+        (friend, item) pair. When a friend lists the same item more than
+        once, their earliest row is used.
+        """
+        cursor = self.conn.cursor()
+        # (friend, Match) pairs, built as each row is read
+        cursor.row_factory = lambda cursor, row: (row[0], Match._make(row[1:5]))
+        cursor.execute('''
+            SELECT f.user2, g1.item, g1.quantity, g2.quantity, g1.unit, MIN(g2.rowid)
+            FROM friends f
+            JOIN grocery_lists g1 ON g1.username = f.user1
+            JOIN grocery_lists g2 ON g2.username = f.user2 AND g2.item = g1.item
+            WHERE f.user1 = ?
+            GROUP BY f.user2, g1.rowid
+            ORDER BY f.user2, g1.rowid
+        ''', (username,))
 
         matching_items = {}
-        for friend in friends:
-            friend_matches = []
-            for item, quantity, unit in user_items:
-                # Check if friend has same item
-                cursor.execute('''
-                    SELECT username, quantity, unit 
-                    FROM grocery_lists 
-                    WHERE username = ? AND item = ?
-                ''', (friend, item))
-                friend_item = cursor.fetchone()
-
-                if friend_item:
-                    friend_matches.append({
-                        'item': item,
-                        'user_quantity': quantity,
-                        'friend_quantity': friend_item[1],
-                        'unit': unit
-                    })
-
-            if friend_matches:
-                matching_items[friend] = friend_matches
+        for friend, match in cursor.fetchall():
+            matching_items.setdefault(friend, []).append(match)
 
         return matching_items
 
@@ -231,10 +233,10 @@ class GroceryShareApp:
         if matches:
             for friend, items in matches.items():
                 st.subheader(f'Matches with {friend}')
-                for item in items:
-                    st.write(f"**{item['item']}**: "
-                             f"You want {item['user_quantity']} {item['unit']}, "
-                             f"{friend} wants {item['friend_quantity']} {item['unit']}")
+                for match in items:
+                    st.write(f"**{match.item}**: "
+                             f"You want {match.user_quantity} {match.unit}, "
+                             f"{friend} wants {match.friend_quantity} {match.unit}")
         else:
             st.info('No matching grocery items found among your friends')
 
@@ -0,0 +1,624 @@
+"""Headless JSON API over DatabaseManager, for clients that are not the Streamlit app.
+
+Built on the standard library's ``http.server``. Each connection is handed to
+a bounded thread pool, so at most ``workers`` blocking SQLite calls run at a
+time. Connections beyond ``workers + backlog`` are turned away with 503
+instead of queueing without limit. Run from the ``test`` directory::
+
+    python api.py [--db grocery_share.db] [--port 8000] [--workers 8]
+
+With ``--directory`` it serves every shard of a ``shards.ShardRouter``
+instead, and each request runs on its user's shard.
+
+Log in with ``POST /login`` and send the returned token as
+``Authorization: Bearer <token>``. Every response body is JSON, and errors
+look like ``{"error": "..."}``.
+
+    POST   /register                  {username, password, email}; and community when sharded
+    POST   /login                     {username, password} -> {token}
+    POST   /logout
+    GET    /friends
+    POST   /friends                   {username}
+    DELETE /friends/<username>
+    GET    /groceries
+    POST   /groceries                 {item, quantity, unit} or {items: [...]}
+    PUT    /groceries/<id>            {item, quantity, unit}
+    DELETE /groceries/<id>
+    GET    /matches                   ?threshold= for fuzzy matches
+    GET    /matches/remote            matches with friends on other shards
+    GET    /purchases/ongoing         ?before=&limit=
+    GET    /purchases/history         ?before=&limit=
+    GET    /pools                     open pools you are buying; ?before=&limit=
+    POST   /pools                     {item, friend}: buy a matched item for both of you -> {pool_id, buyer}
+    GET    /pools/<id>                buyer, members and the buyer's friends only
+    POST   /pools/<id>/join           {quantity}; the buyer's friends only
+    POST   /pools/<id>/leave
+    POST   /pools/<id>/settle         {total_price}; buyer only
+    GET    /balances
+    POST   /payments                  {payer, amount}: record a payment you received
+    GET    /changes                   ?since=&limit=; without since, just the latest seq
+    GET    /export/<export>.<format>  a streamed exporter.EXPORTS download, e.g. /export/matches.csv
+
+``GET /export`` also accepts, instead of a token, the signed ``?user=&expires=&signature=``
+query of an ``exporter.export_link``, so a browser can follow a link from the
+app. The API checks it against the ``GROCERYSHARE_EXPORT_SECRET`` environment
+variable, which the app must share.
+"""
+import argparse
+import hmac
+import json
+import os
+import re
+import secrets
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from database import CHANGES_LIMIT, PAGE_SIZE, DatabaseManager
+from exporter import EXPORTS, FORMATS, export_rows, sign_export
+from importer import validate_row
+from models import User, Page
+from shards import ShardRouter
+
+# Largest request body accepted, in bytes
+MAX_BODY = 1 << 20
+# Largest page a client may ask for
+MAX_PAGE_SIZE = 200
+# How long cached reads may miss changes other writers (e.g. the Streamlit app) made, in seconds
+CACHE_SYNC_SECONDS = 1.0
+
+_BUSY = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Type: application/json\r\n'
+         b'Content-Length: 23\r\nRetry-After: 1\r\nConnection: close\r\n\r\n{"error": "overloaded"}')
+
+
+class APIError(Exception):
+    """An error reported to the client with an HTTP status."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# (method, path pattern, needs a logged-in user, handler name)
+_ROUTES: List[Tuple[str, re.Pattern, bool, str]] = []
+
+
+def route(method: str, pattern: str, auth: bool = True):
+    """Register a Handler method for ``method`` requests to paths matching ``pattern``."""
+    def decorator(func: Callable):
+        _ROUTES.append((method, re.compile(f'^{pattern}$'), auth, func.__name__))
+        return func
+    return decorator
+
+
+class Sessions:
+    """Bearer tokens of logged-in users, kept in memory."""
+
+    def __init__(self):
+        self._users: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def create(self, username: str) -> str:
+        token = secrets.token_urlsafe(32)
+        with self._lock:
+            self._users[token] = username
+        return token
+
+    def user(self, token: str) -> Optional[str]:
+        with self._lock:
+            return self._users.get(token)
+
+    def end(self, token: str):
+        with self._lock:
+            self._users.pop(token, None)
+
+
+class APIServer(HTTPServer):
+    """An HTTPServer that serves connections on a bounded thread pool.
+
+    Pass a ``router`` instead of ``db`` to serve a sharded deployment, and
+    an ``export_secret`` to accept signed export links.
+    """
+
+    def __init__(self, address: Tuple[str, int], db: Optional[DatabaseManager], workers: int = 8,
+                 backlog: int = 64, router: Optional[ShardRouter] = None, export_secret: Optional[str] = None):
+        self.db = db
+        self.router = router
+        self.export_secret = export_secret
+        self.sessions = Sessions()
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='api')
+        # Connections being served or waiting for a worker
+        self._slots = threading.BoundedSemaphore(workers + backlog)
+        self.request_queue_size = workers + backlog
+        super().__init__(address, Handler)
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            try:
+                request.sendall(_BUSY)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+            return
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    @contextmanager
+    def database(self, username: str):
+        """Yield the DatabaseManager holding ``username``'s data for the ``with`` block."""
+        if self.router is None:
+            yield self.db
+        else:
+            with self.router.session(username) as db:
+                yield db
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        if self.router is not None:
+            self.router.close()
+        else:
+            self.db.close_connection()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'GroceryShareAPI/1.0'
+    # Idle keep-alive connections give their worker back after this many seconds
+    timeout = 5
+    # Headers and body are separate writes; with Nagle's algorithm the body
+    # would wait for the client's delayed ACK of the headers
+    disable_nagle_algorithm = True
+    server: APIServer
+    # The logged-in user's shard, or the only database
+    db: DatabaseManager
+
+    def log_request(self, code='-', size='-'):
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method: str):
+        url = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        try:
+            self.body = self._read_body()
+            allowed = False
+            for route_method, pattern, auth, name in _ROUTES:
+                match = pattern.match(url.path)
+                if not match:
+                    continue
+                allowed = True
+                if route_method != method:
+                    continue
+                self.username = self._authenticate() if auth else None
+                if self.username is None:
+                    self.db = self.server.db
+                    status, payload = getattr(self, name)(*map(unquote, match.groups()))
+                else:
+                    with self.server.database(self.username) as self.db:
+                        self.db.sync_cache(CACHE_SYNC_SECONDS)
+                        status, payload = getattr(self, name)(*map(unquote, match.groups()))
+                break
+            else:
+                raise APIError(405, 'method not allowed') if allowed else APIError(404, 'not found')
+        except APIError as e:
+            status, payload = e.status, {'error': str(e)}
+        except ValueError as e:
+            status, payload = 400, {'error': str(e)}
+        except Exception:
+            self.log_error('%s', traceback.format_exc())
+            status, payload = 500, {'error': 'internal error'}
+        # Streaming handlers have sent their response already
+        if status is not None:
+            self._send(status, payload)
+
+    def _read_body(self) -> dict:
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            length = MAX_BODY + 1
+        if length > MAX_BODY:
+            self.close_connection = True
+            raise APIError(413, 'request body is too large')
+        if not length:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise APIError(400, 'request body is not valid JSON') from None
+        if not isinstance(body, dict):
+            raise APIError(400, 'request body must be a JSON object')
+        return body
+
+    def _authenticate(self) -> str:
+        scheme, _, token = (self.headers.get('Authorization') or '').partition(' ')
+        username = self.server.sessions.user(token) if scheme.lower() == 'bearer' else None
+        if username is None:
+            raise APIError(401, 'log in and send the token as "Authorization: Bearer <token>"')
+        return username
+
+    def _send(self, status: int, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunks(self, content_type: str, filename: str, chunks: Iterable[bytes]):
+        """Send ``chunks`` as they are produced, with chunked transfer encoding."""
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', f'attachment; filename="{filename}"')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                if chunk:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        except Exception:
+            # The status has gone out; all that is left is to cut the response short
+            self.close_connection = True
+            self.log_error('%s', traceback.format_exc())
+            return
+        self.wfile.write(b'0\r\n\r\n')
+
+    def _field(self, name: str) -> str:
+        value = self.body.get(name)
+        if not isinstance(value, str) or not value.strip():
+            raise APIError(400, f'{name} is required')
+        return value.strip()
+
+    def _number(self, name: str) -> float:
+        value = self.body.get(name)
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise APIError(400, f'{name} must be a number')
+        return float(value)
+
+    def _page_args(self) -> Tuple[Optional[int], int]:
+        try:
+            before = int(self.query['before']) if 'before' in self.query else None
+            limit = int(self.query.get('limit', PAGE_SIZE))
+        except ValueError:
+            raise APIError(400, 'before and limit must be integers') from None
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise APIError(400, f'limit must be between 1 and {MAX_PAGE_SIZE}')
+        return before, limit
+
+    @property
+    def _accounts(self):
+        """Where users are looked up: the router when sharded, else the database."""
+        return self.server.router or self.db
+
+    def _get_pool(self, pool_id: str) -> dict:
+        """The pool, if the user is its buyer, a member or a friend of the buyer; 404 otherwise."""
+        try:
+            pool = self.db.get_pool(int(pool_id))
+        except ValueError as e:
+            raise APIError(404, str(e)) from None
+        if (self.username != pool['buyer'] and self.username not in pool['members']
+                and pool['buyer'] not in self.db.get_friends(self.username)):
+            # The same answer as a missing pool, so ids cannot be probed
+            raise APIError(404, 'Invalid pool ID')
+        return pool
+
+    def _open_pool(self, pool_id: str) -> dict:
+        pool = self._get_pool(pool_id)
+        if pool['is_purchased']:
+            raise APIError(409, 'Pool is already settled')
+        return pool
+
+    @staticmethod
+    def _matches(matches: Dict[str, list]) -> dict:
+        # NamedTuples would serialize as arrays
+        return {'matches': {friend: [match._asdict() for match in rows] for friend, rows in matches.items()}}
+
+    @staticmethod
+    def _page(page: Page, columns: Tuple[str, ...]) -> dict:
+        return {'rows': [dict(zip(columns, row)) for row in page.rows], 'next_cursor': page.next_cursor}
+
+    # Accounts
+
+    @route('GET', '/health', auth=False)
+    def health(self):
+        return 200, {'status': 'ok'}
+
+    @route('POST', '/register', auth=False)
+    def register(self):
+        username, password = self._field('username'), self._field('password')
+        email = self._field('email')
+        if self.server.router is None:
+            registered = self.db.register_user(username, User.hash_password(password), email)
+        else:
+            community = self._field('community')
+            if community not in self.server.router.communities():
+                raise APIError(400, f'No community named {community}')
+            registered = self.server.router.register_user(username, User.hash_password(password), email,
+                                                          community)
+        if not registered:
+            raise APIError(409, 'Username or email already exists')
+        return 201, {'username': username}
+
+    @route('POST', '/login', auth=False)
+    def login(self):
+        username, password = self._field('username'), self._field('password')
+        if not self._accounts.login_user(username, User.hash_password(password)):
+            raise APIError(401, 'Invalid credentials')
+        return 200, {'username': username, 'token': self.server.sessions.create(username)}
+
+    @route('POST', '/logout')
+    def logout(self):
+        self.server.sessions.end(self.headers['Authorization'].partition(' ')[2])
+        return 200, {}
+
+    # Friends
+
+    @route('GET', '/friends')
+    def friends(self):
+        return 200, {'friends': self.db.get_friends(self.username)}
+
+    @route('POST', '/friends')
+    def add_friend(self):
+        friend = self._field('username')
+        if friend == self.username:
+            raise APIError(400, 'You cannot add yourself as a friend')
+        if not self._accounts.user_exists(friend):
+            raise APIError(404, f'No user named {friend}')
+        if not self._accounts.add_friend(self.username, friend):
+            raise APIError(409, f'{friend} is already your friend')
+        return 201, {'friend': friend}
+
+    @route('DELETE', '/friends/([^/]+)')
+    def remove_friend(self, friend: str):
+        self._accounts.remove_friend(self.username, friend)
+        return 200, {}
+
+    # Grocery list
+
+    @route('GET', '/groceries')
+    def groceries(self):
+        items = self.db.get_grocery_items(self.username)
+        return 200, {'items': [item._asdict() for item in items]}
+
+    @route('POST', '/groceries')
+    def add_groceries(self):
+        rows = self.body['items'] if 'items' in self.body else [self.body]
+        if not isinstance(rows, list) or not rows:
+            raise APIError(400, 'items must be a non-empty list')
+        units = self.db.get_units()
+        items, errors = [], []
+        for index, row in enumerate(rows):
+            try:
+                items.append(validate_row(row, units))
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+        if errors:
+            return 400, {'error': 'invalid items', 'errors': errors}
+        failed = self.db.add_grocery_items(self.username, items)
+        if failed:
+            return 400, {'error': 'invalid items', 'errors': [{'index': index, 'error': error}
+                                                             for index, error in failed]}
+        return 201, {'added': len(items)}
+
+    @route('PUT', r'/groceries/(\d+)')
+    def update_grocery(self, grocery_id: str):
+        item, quantity, unit = validate_row(self.body, self.db.get_units())
+        try:
+            grocery_id = self.db.update_grocery_item(self.username, int(grocery_id), item, quantity, unit)
+        except ValueError:
+            raise APIError(404, 'No such grocery item') from None
+        return 200, {'id': grocery_id}
+
+    @route('DELETE', r'/groceries/(\d+)')
+    def remove_grocery(self, grocery_id: str):
+        if not self.db.remove_grocery_item_by_id(self.username, int(grocery_id)):
+            raise APIError(404, 'No such grocery item')
+        return 200, {}
+
+    # Matches
+
+    @route('GET', '/matches')
+    def matches(self):
+        if 'threshold' in self.query:
+            try:
+                threshold = float(self.query['threshold'])
+            except ValueError:
+                raise APIError(400, 'threshold must be a number') from None
+            return 200, self._matches(self.db.find_fuzzy_matches(self.username, threshold))
+        return 200, self._matches(self.db.find_matching_groceries(self.username))
+
+    @route('GET', '/matches/remote')
+    def remote_matches(self):
+        if self.server.router is None:
+            return 200, {'matches': {}}
+        return 200, self._matches(self.server.router.find_remote_matches(self.username))
+
+    # Purchases
+
+    @route('GET', '/purchases/ongoing')
+    def ongoing_purchases(self):
+        page = self.db.get_ongoing_purchases_page(self.username, *self._page_args())
+        return 200, self._page(page, ('pool_id', 'buyer', 'item'))
+
+    @route('GET', '/purchases/history')
+    def purchase_history(self):
+        page = self.db.get_purchase_history_page(self.username, *self._page_args())
+        return 200, self._page(page, ('pool_id', 'item', 'buyer', 'total_price', 'share', 'member_count'))
+
+    @route('GET', '/pools')
+    def open_pools(self):
+        page = self.db.get_open_pools_page(self.username, *self._page_args())
+        return 200, self._page(page, ('pool_id', 'item', 'member_count'))
+
+    @route('POST', '/pools')
+    def track_purchase(self):
+        item, friend = self._field('item'), self._field('friend')
+        if friend not in self.db.get_friends(self.username):
+            raise APIError(403, f'{friend} is not your friend')
+        router = self.server.router
+        if router is not None and router.shard_of(friend) != router.shard_of(self.username):
+            # The pool, claims and balance would only exist on one of the two shards
+            raise APIError(409, f'{friend} is in another community; purchases cannot be shared across shards')
+        pool_id = self.db.track_matched_item_purchase(item, self.username, friend, self.username)
+        # The friend's claim wins if they made it first
+        return 201, {'pool_id': pool_id, 'buyer': self.db.get_pool(pool_id)['buyer']}
+
+    @route('GET', r'/pools/(\d+)')
+    def pool(self, pool_id: str):
+        pool = self._get_pool(pool_id)
+        pool['members'] = {username: {'quantity': quantity, 'share': share}
+                           for username, (quantity, share) in pool['members'].items()}
+        return 200, pool
+
+    @route('POST', r'/pools/(\d+)/join')
+    def join_pool(self, pool_id: str):
+        self._open_pool(pool_id)
+        quantity = self._number('quantity') if 'quantity' in self.body else None
+        if quantity is not None and quantity < 0:
+            raise APIError(400, 'quantity must not be negative')
+        self.db.join_pool(int(pool_id), self.username, quantity)
+        return 200, {}
+
+    @route('POST', r'/pools/(\d+)/leave')
+    def leave_pool(self, pool_id: str):
+        self._open_pool(pool_id)
+        self.db.leave_pool(int(pool_id), self.username)
+        return 200, {}
+
+    @route('POST', r'/pools/(\d+)/settle')
+    def settle_pool(self, pool_id: str):
+        if self._open_pool(pool_id)['buyer'] != self.username:
+            raise APIError(403, 'Only the buyer can settle a pool')
+        total_price = self._number('total_price')
+        if total_price < 0:
+            raise APIError(400, 'total_price must not be negative')
+        return 200, self.db.settle_pool(int(pool_id), total_price)._asdict()
+
+    # Balances
+
+    @route('GET', '/balances')
+    def balances(self):
+        return 200, {'balances': self.db.get_balances(self.username)}
+
+    @route('POST', '/payments')
+    def record_payment(self):
+        # Only the payee can say the money arrived, so a payer cannot clear their own debt
+        payer, amount = self._field('payer'), self._number('amount')
+        if not self._accounts.user_exists(payer):
+            raise APIError(404, f'No user named {payer}')
+        self.db.record_payment(payer, self.username, amount)
+        return 201, {'balance': self.db.get_balance(self.username, payer)}
+
+    # Live updates
+
+    @route('GET', '/changes')
+    def changes(self):
+        if 'since' not in self.query:
+            return 200, {'changes': [], 'seq': self.db.get_change_seq()}
+        try:
+            since = int(self.query['since'])
+            limit = int(self.query.get('limit', CHANGES_LIMIT))
+        except ValueError:
+            raise APIError(400, 'since and limit must be integers') from None
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise APIError(400, f'limit must be between 1 and {MAX_PAGE_SIZE}')
+        changes = self.db.get_changes(self.username, since, limit)
+        return 200, {'changes': [change._asdict() for change in changes],
+                     'seq': changes[-1].seq if changes else since}
+
+    @route('GET', r'/export/(\w+)\.(\w+)', auth=False)
+    def export(self, export: str, fmt: str):
+        if export not in EXPORTS or fmt not in FORMATS:
+            raise APIError(404, f"exports are {', '.join(EXPORTS)} as {' or '.join(FORMATS)}")
+        username = self._export_user(export, fmt)
+        with self.server.database(username) as db:
+            self._send_chunks(FORMATS[fmt], f'{export}.{fmt}', export_rows(db, username, export, fmt))
+        return None, None
+
+    def _export_user(self, export: str, fmt: str) -> str:
+        """Return the user a token or a signed export link downloads ``export`` for."""
+        if 'signature' not in self.query:
+            return self._authenticate()
+        secret = self.server.export_secret
+        try:
+            username, expires = self.query['user'], int(self.query['expires'])
+        except (KeyError, ValueError):
+            raise APIError(400, 'a signed link needs user and expires') from None
+        if (secret is None or expires < time.time() or not hmac.compare_digest(
+                self.query['signature'], sign_export(secret, username, export, fmt, expires))):
+            raise APIError(403, 'this export link is invalid or has expired')
+        return username
+
+
+def serve(db_path: str, host: str = '127.0.0.1', port: int = 8000, workers: int = 8,
+          backlog: int = 64, cache_size: int = 4096, directory: Optional[str] = None,
+          export_secret: Optional[str] = None) -> APIServer:
+    """Create an APIServer on a fresh DatabaseManager; call ``serve_forever`` on it.
+
+    Cached reads pick up changes other writers log, such as the Streamlit
+    app's, within ``CACHE_SYNC_SECONDS``; pass ``cache_size=0`` to read
+    every request from SQLite instead.
+    With a shard ``directory`` database, serve its shards instead of ``db_path``.
+    Signed export links are only accepted when ``export_secret`` is set.
+    """
+    if directory is not None:
+        router = ShardRouter(directory, max_connections=workers, cache_size=cache_size)
+        return APIServer((host, port), None, workers=workers, backlog=backlog, router=router,
+                         export_secret=export_secret)
+    db = DatabaseManager(db_path, max_connections=workers, cache_size=cache_size)
+    if db.pool is None:
+        raise RuntimeError(f'could not open {db_path}')
+    return APIServer((host, port), db, workers=workers, backlog=backlog, export_secret=export_secret)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default='grocery_share.db')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=8, help='requests served at once')
+    parser.add_argument('--backlog', type=int, default=64, help='connections waiting for a worker')
+    parser.add_argument('--cache-size', type=int, default=4096,
+                        help=f'cached reads, which see other writers within {CACHE_SYNC_SECONDS:g} s; 0 to disable')
+    parser.add_argument('--directory', help='shard directory database; serves its shards instead of --db')
+    args = parser.parse_args()
+
+    server = serve(args.db, args.host, args.port, args.workers, args.backlog, args.cache_size, args.directory,
+                   os.environ.get('GROCERYSHARE_EXPORT_SECRET'))
+    print(f'Serving on http://{server.server_address[0]}:{server.server_address[1]}', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
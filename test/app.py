@@ -1,13 +1,146 @@
+import io
+import os
+import tempfile
 import streamlit as st
-from models import User
+from contextlib import contextmanager
+from typing import List, Optional, Union
+from models import Change, GroceryItem, User
 from database import DatabaseManager
-import cv2
+from fuzzy import DEFAULT_THRESHOLD
+from exporter import EXPORTS, FORMATS, export_link, write_export
+from importer import import_grocery_list
+from receipt_parser import match_receipt_items
+from instrumentation import QueryStats
+from shards import ShardRouter
+from writebehind import WriteBehind
+import features
+
+# Set GROCERYSHARE_PROFILE=1 to record SQL and page timings, and list the
+# users allowed to see them in GROCERYSHARE_ADMINS (comma-separated)
+PROFILE = bool(os.environ.get('GROCERYSHARE_PROFILE'))
+ADMINS = {name.strip() for name in os.environ.get('GROCERYSHARE_ADMINS', '').split(',') if name.strip()}
+# Set GROCERYSHARE_DIRECTORY to a shards.py directory database to serve its shards instead of friends.db
+DIRECTORY = os.environ.get('GROCERYSHARE_DIRECTORY')
+# Set GROCERYSHARE_WRITE_BEHIND_MS to commit clicks in groups from a background writer, waiting at most
+# that long for more; unsharded only
+WRITE_BEHIND_MS = os.environ.get('GROCERYSHARE_WRITE_BEHIND_MS')
+# Set GROCERYSHARE_API_URL to an api.py server on the same database, and GROCERYSHARE_EXPORT_SECRET to the
+# secret it was started with, to stream exports from the API instead of preparing them here
+API_URL = os.environ.get('GROCERYSHARE_API_URL')
+EXPORT_SECRET = os.environ.get('GROCERYSHARE_EXPORT_SECRET')
+
+# How often open dashboards poll the change log, and how much activity they keep
+LIVE_UPDATE_SECONDS = 5
+ACTIVITY_SIZE = 20
+
+
+def describe_change(change: Change, username: str) -> Optional[str]:
+    """One line for the activity feed about another user's change, or None to leave it out."""
+    who, data = change.username, change.data
+    if change.kind == 'grocery_added':
+        return f"📝 {who} added {data['item']} to their list"
+    if change.kind == 'groceries_added':
+        if data['count'] == 1:
+            return f"📝 {who} added {data['items'][0]} to their list"
+        return f"📝 {who} added {data['count']} items, including {', '.join(data['items'][:3])}"
+    if change.kind == 'grocery_updated':
+        return f"✏️ {who} changed {data['item']} on their list"
+    if change.kind == 'grocery_removed':
+        return f"🗑️ {who} removed {data['item']} from their list"
+    if change.kind == 'pool_opened' and who is not None:
+        return f"🛒 {who} is purchasing {data['item']} for the group!"
+    if change.kind == 'pool_joined':
+        return f"🤝 {who} joined the purchase of {data['item']}"
+    # Settling logs a change for every member; report it once, from the buyer's
+    if change.kind == 'pool_settled' and who == data['buyer']:
+        return f"💸 {who} bought {data['item']} for ${data['total_price']:.2f}"
+    if change.kind == 'payment_recorded' and data['payee'] == username:
+        return f"💵 {data['payer']} paid you ${data['amount']:.2f}"
+    if change.kind == 'friend_added' and data['friend'] == username:
+        return f"👥 {who} added you as a friend"
+    if change.kind == 'unit_conversion_added':
+        scope = f" of {data['item']}" if data['item'] else ''
+        return f"⚖️ New conversion: 1 {data['unit']}{scope} = {data['amount']} {data['base_unit']}"
+    return None
+
+
+@st.cache_resource
+def get_database() -> DatabaseManager:
+    """Share one database manager, pool and read cache across every session."""
+    return DatabaseManager("friends.db", cache_size=1024, stats=QueryStats() if PROFILE else None)
+
+
+@st.cache_resource
+def get_router() -> ShardRouter:
+    """Share one shard router, and its shards' managers, across every session."""
+    return ShardRouter(DIRECTORY, cache_size=1024, stats=QueryStats() if PROFILE else None)
+
+
+@st.cache_resource
+def get_write_behind() -> WriteBehind:
+    """Share one write-behind queue and writer thread across every session."""
+    return WriteBehind(get_database(), float(WRITE_BEHIND_MS))
 
 
 class GroceryShareApp:
     def __init__(self):
         """Initialize the application with database manager"""
-        self.db = DatabaseManager("friends.db")
+        self.router = get_router() if DIRECTORY else None
+        self.accounts: Union[ShardRouter, DatabaseManager] = self.router or get_database()
+        self.writes = get_write_behind() if WRITE_BEHIND_MS and self.router is None else None
+        # The logged-in user's shard while shard_session() holds it
+        self.shard_db: Optional[DatabaseManager] = None
+        if self.accounts.stats is not None:
+            # Instance attributes shadow the methods, so disabled profiling costs nothing
+            for name in dir(self):
+                if name.startswith('render_') and name.endswith('_page'):
+                    setattr(self, name, self.accounts.stats.timed(name, getattr(self, name)))
+
+    @property
+    def db(self) -> DatabaseManager:
+        """The logged-in user's shard when sharded, else the only database.
+
+        Sharded, it is only available inside shard_session(). With
+        write-behind on, waits for the user's queued writes first, so every
+        read sees them.
+        """
+        if self.router is not None:
+            if self.shard_db is None:
+                raise RuntimeError('open shard_session() before using the database')
+            return self.shard_db
+        if self.writes is not None and st.session_state.get('username'):
+            self.writes.flush(st.session_state.username)
+        return self.accounts
+
+    @contextmanager
+    def shard_session(self):
+        """Hold the logged-in user's shard for the ``with`` block when sharded.
+
+        Moving the user's community waits for open sessions, and sessions
+        wait for the move, so no write lands on the shard it left.
+        """
+        if self.router is None or self.shard_db is not None:
+            yield
+            return
+        with self.router.session(st.session_state.username) as db:
+            self.shard_db = db
+            try:
+                yield
+            finally:
+                self.shard_db = None
+
+    def write(self, method: str, *args, wait: bool = False):
+        """Run the DatabaseManager mutation ``method``, through the write-behind queue when it is on.
+
+        A queued write returns None at once unless ``wait`` is set, and
+        raises what the mutation raised only then.
+        """
+        if self.writes is not None:
+            future = self.writes.submit(method, *args)
+            return future.result() if wait else None
+        # Writes that can span shards go through the router
+        target = self.router if self.router is not None and hasattr(self.router, method) else self.db
+        return getattr(target, method)(*args)
         
     def apply_custom_styling(self):
         st.markdown("""
@@ -64,7 +197,8 @@ class GroceryShareApp:
         if st.session_state.page == 'login':
             self.render_login_page()
         elif st.session_state.logged_in:
-            self.render_dashboard()
+            with self.shard_session():
+                self.render_dashboard()
         else:
             st.stop()
 
@@ -81,9 +215,13 @@ class GroceryShareApp:
 
             if st.button('Login'):
                 hashed_password = User.hash_password(password)
-                if self.db.login_user(username, hashed_password):
+                if self.accounts.login_user(username, hashed_password):
                     st.session_state.logged_in = True
                     st.session_state.username = username
+                    # Live updates start from now
+                    with self.shard_session():
+                        st.session_state.change_seq = self.db.get_change_seq()
+                    st.session_state.activity = []
                     st.session_state.page = 'dashboard'
                     st.success(f'Welcome, {username}!')
                 else:
@@ -95,13 +233,19 @@ class GroceryShareApp:
             email = st.text_input('Email Address')
             new_password = st.text_input('🔒 Password', placeholder="Enter your password", type='password')
             confirm_password = st.text_input('Confirm Password', type='password')
+            if self.router is not None:
+                community = st.selectbox('🏘️ Community', sorted(self.router.communities()))
 
             if st.button('Register'):
                 if new_password != confirm_password:
                     st.error('Passwords do not match')
                 else:
                     hashed_password = User.hash_password(new_password)
-                    if self.db.register_user(new_username, hashed_password, email):
+                    if self.router is not None:
+                        registered = self.router.register_user(new_username, hashed_password, email, community)
+                    else:
+                        registered = self.db.register_user(new_username, hashed_password, email)
+                    if registered:
                         st.success('Registration successful! Please login.')
                         st.session_state.page = 'login'
                     else:
@@ -143,8 +287,11 @@ class GroceryShareApp:
         nav_options = [
             '🛒 Grocery List', 
             '👥 Friends', 
-            '🔗 Matches'
+            '🔗 Matches',
+            '💸 Balances'
         ]
+        if st.session_state.username in ADMINS:
+            nav_options.append('📊 Profiling')
         nav_style = """
         <style>
         div[role="radiogroup"] > label {
@@ -174,7 +321,14 @@ class GroceryShareApp:
             st.session_state.logged_in = False
             st.session_state.username = None
             st.session_state.page = 'login'
-            st.experimental_rerun()
+            st.rerun()
+
+        # A full rerun reads everything afresh, so earlier updates are shown
+        st.session_state.updates_pending = 0
+        with st.sidebar:
+            self.render_live_updates()
+
+        self.render_export_panel()
 
         # Render appropriate page based on navigation
         if tab == '🛒 Grocery List':
@@ -183,6 +337,80 @@ class GroceryShareApp:
             self.render_friends_page()
         elif tab == '🔗 Matches':
             self.render_matches_page()
+        elif tab == '💸 Balances':
+            self.render_balances_page()
+        elif tab == '📊 Profiling' and st.session_state.username in ADMINS:
+            self.render_profiling_page()
+
+    @st.fragment(run_every=LIVE_UPDATE_SECONDS)
+    def render_live_updates(self):
+        """Poll the change log and show friends' activity without rerunning the page.
+
+        Each poll is one indexed read of the changes since the last one. The
+        page itself is only rerun when the user asks for the updates. Polls
+        also keep the shared read cache in step with the API and other app
+        servers, at most once per interval across all sessions, and right
+        away when this poll found changes to show.
+        """
+        username = st.session_state.username
+        # A fragment rerun runs outside the page's session
+        with self.shard_session():
+            if 'change_seq' not in st.session_state:
+                st.session_state.change_seq = self.db.get_change_seq()
+                st.session_state.activity = []
+            changes = self.db.get_changes(username, st.session_state.change_seq)
+            self.db.sync_cache(0.0 if changes else LIVE_UPDATE_SECONDS)
+        if changes:
+            st.session_state.change_seq = changes[-1].seq
+            lines = [describe_change(change, username) for change in changes if change.username != username]
+            lines = [line for line in lines if line]
+            if lines:
+                st.session_state.activity = (lines[::-1] + st.session_state.activity)[:ACTIVITY_SIZE]
+                st.session_state.updates_pending = st.session_state.get('updates_pending', 0) + len(lines)
+
+        if st.session_state.activity:
+            st.markdown('**🔔 Activity**')
+            for line in st.session_state.activity:
+                st.caption(line)
+        pending = st.session_state.get('updates_pending', 0)
+        if pending and st.button(f'🔄 Show {pending} update{"s" if pending != 1 else ""}',
+                                 use_container_width=True):
+            st.rerun(scope='app')
+
+    def render_export_panel(self):
+        with st.sidebar.expander('📤 Export your data'):
+            export = st.selectbox('Data', list(EXPORTS),
+                                  format_func=lambda name: name.replace('_', ' ').title())
+            fmt = st.radio('Format', list(FORMATS), horizontal=True)
+
+            if API_URL and EXPORT_SECRET:
+                # The API streams the rows to the browser as it reads them
+                link = export_link(API_URL, EXPORT_SECRET, st.session_state.username, export, fmt)
+                st.link_button(f'⬇️ Download {export}.{fmt}', link, use_container_width=True)
+                return
+
+            # Without the API, Streamlit serves downloads from memory: the file only
+            # keeps the rows from being held twice while the export is written
+            if st.button('Prepare Export', use_container_width=True):
+                self.discard_export()
+                with tempfile.NamedTemporaryFile(suffix=f'.{fmt}', delete=False) as f:
+                    write_export(self.db, st.session_state.username, export, fmt, f)
+                st.session_state.export_path = f.name
+                st.session_state.export_name = f'{export}.{fmt}'
+
+            path = st.session_state.get('export_path')
+            if path and os.path.exists(path):
+                name = st.session_state.export_name
+                with open(path, 'rb') as f:
+                    st.download_button(f'⬇️ Download {name}', f, file_name=name,
+                                       mime=FORMATS[name.rsplit('.', 1)[-1]],
+                                       on_click=self.discard_export, use_container_width=True)
+
+    def discard_export(self):
+        """Delete the prepared export file once it has been downloaded or replaced."""
+        path = st.session_state.pop('export_path', None)
+        if path and os.path.exists(path):
+            os.remove(path)
 
     def render_grocery_list_page(self):
         st.markdown("""
@@ -198,75 +426,177 @@ class GroceryShareApp:
 
         item = st.text_input('Item Name', placeholder="Enter item name")
         quantity = st.number_input('Quantity', min_value=0.0, step=0.1, format="%.2f")
-        unit = st.selectbox('Unit', ['kg', 'lbs', 'pieces', 'pack', 'box', 'bottle'])
+        units = self.db.get_units()
+        unit = st.selectbox('Unit', units)
 
         if st.button('Add Item'):
             if item and quantity > 0:
-                self.db.add_grocery_item(st.session_state.username, item, quantity, unit)
+                self.write('add_grocery_item', st.session_state.username, item, quantity, unit)
                 st.success(f'Added {round(quantity, 1)} {unit} of {item} to your list')
             else:
                 st.warning('Please enter a valid item and quantity')
 
+        with st.expander('📥 Import a grocery list (CSV or JSON)'):
+            st.caption('CSV needs an item,quantity,unit header. JSON can be JSON Lines or an array of objects '
+                       f"with the same keys. Units: {', '.join(units)}.")
+            uploaded = st.file_uploader('Grocery list file', type=['csv', 'json', 'jsonl'])
+            if uploaded is not None and st.button('Import Items'):
+                fmt = uploaded.name.rsplit('.', 1)[-1].lower()
+                # Decode lazily so rows are validated and inserted as they are read
+                stream = io.TextIOWrapper(uploaded, encoding='utf-8-sig', newline='')
+                try:
+                    result = import_grocery_list(self.db, st.session_state.username, stream, fmt)
+                except ValueError as e:
+                    st.error(f'Could not read {uploaded.name}: {e}')
+                else:
+                    st.success(f'Imported {result.inserted} items from {uploaded.name}')
+                    if result.error_count:
+                        st.warning(f'{result.error_count} rows were skipped')
+                        for number, message in result.errors:
+                            st.write(f'Row {number}: {message}')
+                finally:
+                    stream.detach()
+
+        with st.expander('⚖️ Custom unit conversions'):
+            st.caption('Items in different units match when they measure the same thing, '
+                       'e.g. 1 kg of apples and 2 lbs of apples.')
+            col1, col2, col3 = st.columns([2, 2, 2])
+            with col1:
+                new_unit = st.text_input('1 unit of', placeholder="e.g. pack, dozen")
+            with col2:
+                amount = st.number_input('equals', min_value=0.0, step=1.0, format="%.2f")
+            with col3:
+                base_unit = st.selectbox('of', units, key='conversion_base_unit')
+            conversion_item = st.text_input('Only for item (optional)', placeholder="e.g. eggs")
+            if st.button('Save Conversion'):
+                if new_unit and amount > 0 and new_unit != base_unit:
+                    try:
+                        self.write('add_unit_conversion', new_unit, amount, base_unit, conversion_item, wait=True)
+                        scope = f' of {conversion_item}' if conversion_item else ''
+                        st.success(f'1 {new_unit}{scope} = {round(amount, 2)} {base_unit}')
+                    except ValueError as e:
+                        st.error(str(e))
+                else:
+                    st.warning('Please enter a unit and an amount in a different unit')
+
         st.header('Your Grocery List')
         grocery_items = self.db.get_grocery_items(st.session_state.username) 
         if grocery_items:
             st.write("Here are the items you’ve added:")
-            for index, (item, quantity, unit) in enumerate(grocery_items):
+            for grocery in grocery_items:
+                item = grocery.item
+                if st.session_state.get('editing_grocery') == grocery.id:
+                    self.render_grocery_edit_form(grocery, units)
+                    continue
                 col1, col2, col3, col4 = st.columns([2, 2, 1, 1])
                 with col1:
                     st.write(f"**{item}**")
                 with col2:
-                    st.write(f"{round(quantity, 1)} {unit}")
+                    st.write(f"{round(grocery.quantity, 1)} {grocery.unit}")
                 with col3:
-                    if st.button(f"📝 Edit", key=f"edit_{index}"):
-                        st.warning("Edit functionality not implemented yet!")  
+                    if st.button(f"📝 Edit", key=f"edit_{grocery.id}"):
+                        st.session_state.editing_grocery = grocery.id
+                        st.rerun()
                 with col4:
-                    if st.button(f"❌ Remove", key=f"remove_{index}"):
-                        self.db.remove_grocery_item(st.session_state.username, item)
+                    if st.button(f"❌ Remove", key=f"remove_{grocery.id}"):
+                        self.write('remove_grocery_item_by_id', st.session_state.username, grocery.id)
                         st.success(f"Removed {item} from your grocery list.")
                         st.session_state.page = st.session_state.page
-                        st.experimental_rerun()
+                        st.rerun()
         else:
             st.info("No items in your grocery list. Start adding some!")
 
+    def render_grocery_edit_form(self, grocery: GroceryItem, units: List[str]):
+        """Edit one grocery list row in place, keyed by its id."""
+        with st.form(key=f"edit_form_{grocery.id}"):
+            col1, col2, col3 = st.columns([2, 2, 1])
+            with col1:
+                item = st.text_input('Item Name', value=grocery.item)
+            with col2:
+                quantity = st.number_input('Quantity', min_value=0.0, step=0.1, format="%.2f",
+                                           value=float(grocery.quantity))
+            with col3:
+                unit = st.selectbox('Unit', units, index=units.index(grocery.unit) if grocery.unit in units else 0)
+            save, cancel = st.columns(2)
+            saved = save.form_submit_button('💾 Save')
+            cancelled = cancel.form_submit_button('Cancel')
+        if saved:
+            item = item.strip()
+            if not item or quantity <= 0:
+                st.warning('Please enter a valid item and quantity')
+                return
+            try:
+                self.write('update_grocery_item', st.session_state.username, grocery.id, item, quantity, unit,
+                           wait=True)
+            except ValueError:
+                st.error('That item is no longer on your list')
+            del st.session_state.editing_grocery
+            st.rerun()
+        if cancelled:
+            del st.session_state.editing_grocery
+            st.rerun()
+
 
     def render_matches_page(self):
         st.header("🔗 Grocery Matches, Cost Splitting, and Purchases")
 
-        # Fetch the user's grocery items
-        user_grocery_items = self.db.get_grocery_items(st.session_state.username)
+        # Load items, purchases, friends and matches in one read transaction
+        snapshot = self.db.get_matches_snapshot(st.session_state.username)
+        user_grocery_items = snapshot.grocery_items
 
         if not user_grocery_items:
             st.info("You have no items in your grocery list to match with friends.")
             return
 
         # Check if there are any ongoing purchases involving the user
-        ongoing_purchases = self.db.get_ongoing_purchases(st.session_state.username)
-        if ongoing_purchases:
+        ongoing_purchases = snapshot.ongoing_purchases
+        if ongoing_purchases.rows:
             st.warning("⚠️ Purchase Updates:")
-            for purchase in ongoing_purchases:
-                st.write(f"🛒 {purchase[0]} is purchasing {purchase[1]} for the group!")
+            self.render_pages(
+                'ongoing_purchases', ongoing_purchases,
+                lambda before: self.db.get_ongoing_purchases_page(st.session_state.username, before),
+                lambda purchase: st.write(f"🛒 {purchase[1]} is purchasing {purchase[2]} for the group!"))
 
         # Show the user's grocery items
         st.subheader('Your Grocery Items')
-        for item, quantity, unit in user_grocery_items:
-            st.write(f"{item} - {round(quantity, 1)} {unit}")
+        for grocery in user_grocery_items:
+            st.write(f"{grocery.item} - {round(grocery.quantity, 1)} {grocery.unit}")
 
-        # Fetch friends and compare grocery lists
+        # Compare grocery lists with friends
         matches_found = False
-        friends = self.db.get_friends(st.session_state.username)
+        friends = snapshot.friends
 
         if not friends:
             st.info("You have no friends to compare with.")
             return
 
         # Get already tracked purchase items
-        tracked_purchase_items = self.db.get_tracked_purchase_items(st.session_state.username)
+        tracked_purchase_items = snapshot.tracked_purchase_items
+
+        # Exact matches come with the snapshot; similar names ("2% milk" and
+        # "Milk 2%") need the trigram index
+        if st.checkbox('Also match similar item names', key='fuzzy_matching'):
+            threshold = st.slider('Name similarity', min_value=0.3, max_value=1.0,
+                                  value=DEFAULT_THRESHOLD, step=0.05, key='fuzzy_threshold')
+            all_matches = self.db.find_fuzzy_matches(st.session_state.username, threshold)
+        else:
+            all_matches = snapshot.matches
+        # Friends in other communities are matched on the slower cross-shard path
+        remote_matches = self.router.find_remote_matches(st.session_state.username) if self.router else {}
 
         # Loop over each friend
         for friend in friends:
-            # Find matches for the current friend
-            matches = self.db.find_matching_items(st.session_state.username, friend)
+            matches = all_matches.get(friend)
+
+            if friend in remote_matches:
+                # Pools, claims and balances live on one shard, so these can only be shown
+                st.subheader(f"Matches with {friend}")
+                st.caption(f"{friend} is in another community: coordinate these purchases with them directly.")
+                for match in remote_matches[friend]:
+                    st.write(f"🔵 {match.item} - You need {round(match.user_quantity, 1)} {match.unit}, "
+                             f"{friend} needs {round(match.friend_quantity, 1)} {match.unit}")
+                matches_found = True
+                continue
 
             if not matches:
                 st.info(f"No matches found with {friend}.")
@@ -279,25 +609,36 @@ class GroceryShareApp:
 
             # Loop through each matching item
             for match in matches:
-                item = match['item']
-                user_quantity = match['user1_quantity']
-                friend_quantity = match['user2_quantity']
-                unit = match['unit']
+                item = match.item
+                user_quantity = match.user_quantity
+                friend_quantity = match.friend_quantity
+                unit = match.unit
+                # Only fuzzy matches can name the item differently
+                friend_item = getattr(match, 'friend_item', item)
+                # One of the user's items can be similar to several of the friend's
+                widget_key = f"{item}_{friend}_{friend_item}"
 
                 matches_found = True
 
                 col1, col2 = st.columns([3, 1])
                 with col1:
-                    st.write(f"🟢 Match with {friend}: {item} - You need {round(user_quantity, 1)} {unit}, {friend} needs {round(friend_quantity, 1)} {unit}")
+                    label = item if friend_item == item else f"{item} (their {friend_item})"
+                    st.write(f"🟢 Match with {friend}: {label} - You need {round(user_quantity, 1)} {unit}, {friend} needs {round(friend_quantity, 1)} {unit}")
                 with col2:
                     # Disable button if item is already being tracked for purchase
                     if item in tracked_purchase_items:
                         st.markdown(f"**You're buying {item}**")
                     else:
-                        if st.button(f"I'll Buy - {item}", key=f"purchase_{item}_{friend}"):
-                            self.db.track_matched_item_purchase(item, st.session_state.username, friend, st.session_state.username)
-                            st.success(f"You're buying {item} for the group!")
-                            st.experimental_rerun()
+                        if st.button(f"I'll Buy - {item}", key=f"purchase_{widget_key}"):
+                            pool_id = self.write('track_matched_item_purchase', item, st.session_state.username, friend,
+                                                 st.session_state.username, wait=True)
+                            # The friend may have claimed it first
+                            buyer = self.db.get_pool(pool_id)['buyer']
+                            if buyer == st.session_state.username:
+                                st.success(f"You're buying {item} for the group!")
+                            else:
+                                st.info(f"{buyer} is already buying {item} for you both")
+                            st.rerun()
 
                 # Input the cost per unit for the item
                 cost_per_unit = st.number_input(
@@ -305,7 +646,7 @@ class GroceryShareApp:
                     min_value=0.0,
                     step=0.01,
                     format="%.2f",
-                    key=f"cost_{item}_{friend}"
+                    key=f"cost_{widget_key}"
                 )
 
                 if cost_per_unit > 0:
@@ -351,9 +692,7 @@ class GroceryShareApp:
             st.info("No matches found with your friends' grocery lists.")
         else:
             st.write("These are the matches based on your grocery lists. You can now coordinate purchases with your friends.")
-            # Add "Scan Receipt" button
-            if st.button("Scan Receipt"):
-                self.scan_receipt()
+            st.caption("After shopping, scan your receipt on the 💸 Balances page to fill in the prices.")
 
 
     def render_friends_page(self):
@@ -407,7 +746,7 @@ class GroceryShareApp:
                     elif friend_username == st.session_state.username:
                         st.error('You cannot add yourself as a friend')
                     else:
-                        result = self.db.add_friend(st.session_state.username, friend_username)
+                        result = self.write('add_friend', st.session_state.username, friend_username, wait=True)
                         if result:
                             st.success(f'{friend_username} added to your friends')
                             st.session_state.page = 'friends'
@@ -449,45 +788,207 @@ class GroceryShareApp:
                         st.write(f"👤 {friend}") 
                     with col2:
                         if st.button(f"❌ Remove {friend}", key=f"remove_{index}_{friend}"):
-                            self.db.remove_friend(st.session_state.username, friend)
+                            self.write('remove_friend', st.session_state.username, friend)
                             st.success(f"{friend} has been removed.")
                             # Refresh page and show updated list
                             st.session_state.page = 'friends'
-                            st.experimental_rerun()
+                            st.rerun()
             else:
                 st.info("You have no friends added yet. Start connecting!")
 
-    def scan_receipt(self):
-        """Launch the camera for scanning a receipt and display it in Streamlit."""
-        # Initialize the camera
-        cam = cv2.VideoCapture(0)
-        if not cam.isOpened():
-            st.error("Error: Could not access the camera.")
-            return
-
-        cam.set(cv2.CAP_PROP_FRAME_WIDTH, 640)
-        cam.set(cv2.CAP_PROP_FRAME_HEIGHT, 480)
-
-        # Create a placeholder for the camera feed
-        frame_placeholder = st.empty()
+            # Friends of friends who want the same groceries, nearest first
+            st.subheader('Shopping Partners in Your Network')
+            max_hops = st.slider('Friendship hops', min_value=2, max_value=4, value=2, key='network_hops')
+            candidates = [candidate
+                          for candidate in self.db.find_network_matches(st.session_state.username, max_hops)
+                          if candidate['hops'] > 1]
+            if candidates:
+                for candidate in candidates:
+                    member = candidate['username']
+                    items = ', '.join(match.item for match in candidate['items'])
+                    col1, col2 = st.columns([4, 1])
+                    with col1:
+                        st.write(f"🧭 {member} ({candidate['hops']} hops away) also needs {items}")
+                    with col2:
+                        if st.button(f"➕ Add {member}", key=f"add_network_{member}"):
+                            self.write('add_friend', st.session_state.username, member)
+                            st.session_state.page = 'friends'
+                            st.rerun()
+            else:
+                st.info("Nobody beyond your friends shares items with your list yet.")
 
-        while True:
-            success, frame = cam.read()
-            if not success:
-                st.warning("Warning: Failed to capture frame. Retrying...")
-                continue
+    def render_balances_page(self):
+        """Settle the purchases the user is making and show who owes whom."""
+        st.title('💸 Balances')
+        username = st.session_state.username
 
-            # Convert the frame to RGB (Streamlit expects RGB images)
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        open_pools = self.db.get_open_pools_page(username)
+        if open_pools.rows:
+            st.subheader("Purchases You're Making")
+            with st.expander('🧾 Scan a receipt'):
+                self.scan_receipt()
+            self.render_pages('open_pools', open_pools,
+                              lambda before: self.db.get_open_pools_page(username, before),
+                              self.render_open_pool)
+
+        st.subheader('Balances with Friends')
+        balances = self.db.get_balances(username)
+        if not balances:
+            st.info("You're all settled up.")
+        for other, amount in sorted(balances.items()):
+            if amount > 0:
+                st.write(f"🔴 You owe {other} ${amount:.2f}")
+            else:
+                st.write(f"🟢 {other} owes you ${-amount:.2f}")
+
+        # Fewest payments that clear every balance within the user's friend group
+        st.subheader('Settle Up')
+        transfers = self.db.settle_up([username, *self.db.get_friends(username)])
+        if not transfers:
+            st.info("Nothing to settle within your friend group.")
+        for payer, payee, amount in transfers:
+            col1, col2 = st.columns([4, 1])
+            with col1:
+                st.write(f"💵 {payer} pays {payee} ${amount:.2f}")
+            with col2:
+                # Only the payee can confirm the money arrived
+                if username == payee and st.button('Mark as paid', key=f"paid_{payer}_{payee}"):
+                    self.write('record_payment', payer, payee, amount)
+                    st.rerun()
+
+        st.subheader('Purchase History')
+        history = self.db.get_purchase_history_page(username)
+        if not history.rows:
+            st.info("No completed purchases yet.")
+        self.render_pages(
+            'purchase_history', history,
+            lambda before: self.db.get_purchase_history_page(username, before),
+            lambda purchase: st.write(f"🧾 {purchase[1]}: ${purchase[3]:.2f} paid by {purchase[2]}, "
+                                      f"shared by {purchase[5]}, your share ${purchase[4] or 0:.2f}"))
+
+    def render_profiling_page(self):
+        """Admins only: SQL statement statistics, the slow-query log and page render times."""
+        st.title('📊 Profiling')
+        stats = self.db.stats
+        if stats is None:
+            st.info('Profiling is off. Restart the app with GROCERYSHARE_PROFILE=1 to record timings.')
+            return
 
-            # Display the frame in Streamlit
-            frame_placeholder.image(frame_rgb, caption="Scan Receipt", use_container_width=True)
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            stats.slow_ms = st.number_input('Log statements slower than (ms)', min_value=0.0,
+                                            value=float(stats.slow_ms), step=10.0)
+        with col2:
+            if st.button('Reset', use_container_width=True):
+                stats.reset()
+                st.rerun()
+        if self.db.cache is not None:
+            st.caption(f'Read cache: {self.db.cache.hits} hits, {self.db.cache.misses} misses. '
+                       'Cache hits run no SQL and are not counted below.')
+
+        st.subheader('Pages')
+        st.dataframe([{'page': p.page, 'renders': p.calls, 'total ms': round(p.total_ms, 1),
+                       'p50 ms': round(p.p50_ms, 2), 'p95 ms': round(p.p95_ms, 2),
+                       'SQL ms': round(p.sql_ms, 1), 'statements / render': round(p.statements / p.calls, 1)}
+                      for p in stats.pages()], use_container_width=True)
+
+        st.subheader('Statements')
+        st.dataframe([{'statement': s.sql, 'calls': s.calls, 'total ms': round(s.total_ms, 1),
+                       'mean ms': round(s.mean_ms, 3), 'p50 ms': round(s.p50_ms, 3),
+                       'p95 ms': round(s.p95_ms, 3), 'p99 ms': round(s.p99_ms, 3),
+                       'rows': s.rows, 'rows / call': round(s.rows / s.calls, 1)}
+                      for s in stats.statements()], use_container_width=True)
+
+        st.subheader('Slow Queries')
+        slow = stats.slow_queries()
+        if not slow:
+            st.info(f'No statement has taken longer than {stats.slow_ms:g} ms.')
+        for query in slow:
+            with st.expander(f"{query.ms:.1f} ms, {query.rows} rows: {query.sql[:80]}"):
+                st.code(query.sql, language='sql')
+                st.code('\n'.join(query.plan) if query.plan else 'No query plan captured', language='text')
+
+    def render_open_pool(self, pool):
+        """Show one pool the user is buying with a price input to settle it."""
+        pool_id, item, member_count = pool
+        col1, col2, col3 = st.columns([3, 2, 1])
+        with col1:
+            st.write(f"🛒 {item}, shared by {member_count}")
+        with col2:
+            price = st.number_input(f"Total price of {item}", min_value=0.0, step=0.01,
+                                    format="%.2f", key=f"pool_price_{pool_id}")
+        with col3:
+            if st.button('Bought', key=f"settle_{pool_id}", disabled=price <= 0):
+                # Waits: the rerun's flush only covers writes queued for the user, not the pool
+                self.write('settle_pool', pool_id, price, wait=True)
+                st.success(f"Split ${price:.2f} for {item} between {member_count} people")
+                st.rerun()
+
+    def render_pages(self, key, first_page, fetch_page, render_row):
+        """Render a paginated feed: its first page, then any pages loaded with "Load more".
+
+        Loaded pages are kept in session state under ``key`` until the first
+        page changes, so each rerun fetches only the first page.
+        """
+        loaded = st.session_state.get(key)
+        if loaded is None or loaded['after'] != first_page.next_cursor:
+            loaded = st.session_state[key] = {'after': first_page.next_cursor, 'rows': [],
+                                              'cursor': first_page.next_cursor}
+        for row in [*first_page.rows, *loaded['rows']]:
+            render_row(row)
+        if loaded['cursor'] is not None and st.button('Load more', key=f"{key}_more"):
+            page = fetch_page(loaded['cursor'])
+            loaded['rows'].extend(page.rows)
+            loaded['cursor'] = page.next_cursor
+            st.rerun()
 
-            # Check for 'q' key press to exit
-            if cv2.waitKey(1) & 0xFF == ord('q'):
-                break
+    def scan_receipt(self):
+        """Read receipt photos and fill in the prices of the purchases the user is making.
 
-        # Release resources
-        cam.release()
-        cv2.destroyAllWindows()
-        frame_placeholder.empty()  # Clear the placeholder when done
\ No newline at end of file
+        Must run before the open pools' price inputs are rendered, since it
+        sets their values.
+        """
+        unavailable = features.missing('receipts')
+        if unavailable:
+            st.info(f"Receipt scanning is not available on this server. It needs {', '.join(unavailable)}.")
+            return
+        # Imported here so OpenCV is loaded by the first scan, not by every app start
+        from receipts import read_receipts
+
+        username = st.session_state.username
+        uploads = st.file_uploader('Receipt photos', type=['png', 'jpg', 'jpeg'],
+                                   accept_multiple_files=True, key='receipt_uploads')
+        photo = st.camera_input('Or take a photo', key='receipt_photo')
+        images = [upload.getvalue() for upload in uploads or []]
+        if photo is not None:
+            images.append(photo.getvalue())
+
+        if images and st.button('Read Receipts'):
+            with st.spinner(f'Reading {len(images)} receipt(s)...'):
+                receipts = read_receipts(images)
+            for receipt in receipts:
+                if receipt.error:
+                    st.warning(f'Could not read a receipt: {receipt.error}')
+            st.session_state.receipt_matches = match_receipt_items(receipts, self.db.iter_open_pools(username))
+            for match in st.session_state.receipt_matches:
+                st.session_state[f"pool_price_{match.pool_id}"] = match.line.price
+
+        matches = st.session_state.get('receipt_matches')
+        if matches is None:
+            return
+        if not matches:
+            st.info("No receipt lines matched the purchases you're making.")
+            return
+        for match in matches:
+            st.write(f"🧾 {match.line.name} ${match.line.price:.2f} → {match.item}")
+        st.caption('The prices below are filled in from the receipt. Check them, then press Bought, '
+                   'or settle every matched purchase at once.')
+        if st.button(f'Settle {len(matches)} matched purchase(s)'):
+            for match in matches:
+                try:
+                    self.write('complete_item_purchase', match.pool_id, match.line.price, wait=True)
+                except ValueError:
+                    # Already settled by hand since the receipt was read
+                    pass
+            del st.session_state.receipt_matches
+            st.rerun()
@@ -0,0 +1,306 @@
+"""Time every DatabaseManager method on synthetic populations and write the results as JSON.
+
+For each scale tier a population is generated with ``synthetic.py`` (or
+reused from ``--data-dir``), upgraded by ``DatabaseManager`` and every public
+method is called on a fixed sample of users, reads first and then writes.
+The original ``groceryClass.GroceryShareApp.find_matching_groceries`` is
+timed alongside ``DatabaseManager.find_matching_groceries`` when Streamlit is
+installed. Run from the ``test`` directory::
+
+    python bench_suite.py [--tiers 1000 10000 100000] [--output bench_suite.json]
+    python bench_suite.py --tiers 1000 --compare bench_suite.json
+
+With ``--compare`` the run fails if a method got slower than the previous
+results by more than ``--tolerance``.
+"""
+import argparse
+import datetime
+import importlib
+import inspect
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from database import DatabaseManager
+from models import User
+from synthetic import PASSWORD, generate, user_name
+
+# Public methods that are not timed, and why
+NOT_TIMED = {
+    'create_tables': 'timed as the migration of each tier',
+    'close_connection': 'ends the run',
+    'sync_cache': 'a no-op without the read cache, which the suite runs without',
+}
+
+
+class Context:
+    """State shared by the argument builders of one tier."""
+
+    def __init__(self, db: DatabaseManager, users: List[str], seed: int):
+        self.db = db
+        self.users = users
+        self.rng = random.Random(seed)
+        self.friends = {user: db.get_friends(user) for user in users}
+        self.items = {user: [grocery.item for grocery in db.get_grocery_items(user)] for user in users}
+
+    def user(self, call: int) -> str:
+        return self.users[call % len(self.users)]
+
+    def friend(self, call: int) -> str:
+        return self.rng.choice(self.friends[self.user(call)])
+
+    def item(self, call: int) -> str:
+        return self.rng.choice(self.items[self.user(call)])
+
+    def open_pool(self, call: int) -> int:
+        """An open pool bought by user(call) with one of their friends as a member."""
+        user = self.user(call)
+        return self.db.track_matched_item_purchase(f'bench pool {call}', user, self.friend(call), user)
+
+
+class Timed(NamedTuple):
+    method: str
+    # (context, call number) -> positional arguments; runs untimed
+    arguments: Callable[[Context, int], tuple]
+    # Calls per tier, when fewer than --calls are enough
+    calls: Optional[int] = None
+
+
+# Reads run before writes, so every read sees the population as generated
+TIMED = [
+    Timed('login_user', lambda c, i: (c.user(i), User.hash_password(PASSWORD))),
+    Timed('user_exists', lambda c, i: (c.user(i),)),
+    Timed('get_friends', lambda c, i: (c.user(i),)),
+    Timed('get_extended_network', lambda c, i: (c.user(i),)),
+    Timed('find_network_matches', lambda c, i: (c.user(i),)),
+    Timed('get_grocery_items', lambda c, i: (c.user(i),)),
+    Timed('iter_grocery_items', lambda c, i: (c.user(i),)),
+    Timed('find_matching_groceries', lambda c, i: (c.user(i),)),
+    Timed('iter_matches', lambda c, i: (c.user(i),)),
+    Timed('find_fuzzy_matches', lambda c, i: (c.user(i),)),
+    Timed('find_matching_items', lambda c, i: (c.user(i), c.friend(i))),
+    Timed('get_matches_snapshot', lambda c, i: (c.user(i),)),
+    Timed('check_matches', lambda c, i: (c.user(i),)),
+    Timed('get_units', lambda c, i: ()),
+    Timed('get_ongoing_purchases', lambda c, i: (c.user(i),)),
+    Timed('get_ongoing_purchases_page', lambda c, i: (c.user(i),)),
+    Timed('get_tracked_purchase_items', lambda c, i: (c.user(i),)),
+    Timed('get_purchase_history', lambda c, i: (c.user(i),)),
+    Timed('get_purchase_history_page', lambda c, i: (c.user(i),)),
+    Timed('iter_purchase_history', lambda c, i: (c.user(i),)),
+    Timed('get_open_pools_page', lambda c, i: (c.user(i),)),
+    Timed('iter_open_pools', lambda c, i: (c.user(i),)),
+    Timed('get_balance', lambda c, i: (c.user(i), c.friend(i))),
+    Timed('get_balances', lambda c, i: (c.user(i),)),
+    Timed('settle_up', lambda c, i: ([c.user(i), *c.friends[c.user(i)][:10]],)),
+    Timed('get_change_seq', lambda c, i: ()),
+    Timed('get_changes', lambda c, i: (c.user(i), 0)),
+
+    Timed('register_user', lambda c, i: (f'bench{i}', User.hash_password(PASSWORD), f'bench{i}@example.com')),
+    Timed('add_friend', lambda c, i: (c.user(i), f'bench{i}')),
+    Timed('remove_friend', lambda c, i: (c.user(i), f'bench{i}')),
+    Timed('add_grocery_item', lambda c, i: (c.user(i), f'bench item {i}', 1.0, 'kg')),
+    Timed('remove_grocery_item', lambda c, i: (c.user(i), f'bench item {i}')),
+    # A fresh row per call, so every call edits or removes one that exists
+    Timed('update_grocery_item',
+          lambda c, i: (c.user(i), c.db.add_grocery_item(c.user(i), f'bench row {i}', 1.0, 'kg'),
+                        f'bench row {i}', 2.0, 'lbs')),
+    Timed('remove_grocery_item_by_id',
+          lambda c, i: (c.user(i), c.db.add_grocery_item(c.user(i), f'bench row {i}', 1.0, 'kg'))),
+    Timed('add_grocery_items', lambda c, i: (c.user(i), [(f'bench batch {i} {n}', 1.0, 'kg') for n in range(50)])),
+    Timed('add_unit_conversion', lambda c, i: ('pack', 6, 'pieces', c.item(i))),
+    Timed('track_matched_item_purchase', lambda c, i: (c.item(i), c.user(i), c.friend(i), c.user(i))),
+    Timed('create_pool', lambda c, i: (f'bench item {i}', c.user(i))),
+    Timed('get_pool', lambda c, i: (c.open_pool(i),)),
+    Timed('join_pool', lambda c, i: (c.open_pool(i), c.user(i + 1))),
+    Timed('leave_pool', lambda c, i: (c.open_pool(i), c.user(i))),
+    Timed('settle_pool', lambda c, i: (c.open_pool(i), 10.0)),
+    Timed('complete_item_purchase', lambda c, i: (c.open_pool(i), 10.0)),
+    Timed('record_payment', lambda c, i: (c.friend(i), c.user(i), 1.0)),
+    Timed('rebuild_balances', lambda c, i: (), calls=3),
+    Timed('rebuild_matches', lambda c, i: (), calls=3),
+]
+
+
+def untimed_methods() -> List[str]:
+    """Public DatabaseManager methods that neither TIMED nor NOT_TIMED covers."""
+    timed = {spec.method for spec in TIMED} | NOT_TIMED.keys()
+    return sorted(name for name, _ in inspect.getmembers(DatabaseManager, inspect.isfunction)
+                  if not name.startswith('_') and name not in timed)
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    milliseconds = sorted(s * 1000 for s in seconds)
+    return {
+        'calls': len(milliseconds),
+        'min_ms': round(milliseconds[0], 4),
+        'median_ms': round(statistics.median(milliseconds), 4),
+        'p95_ms': round(milliseconds[min(len(milliseconds) - 1, int(len(milliseconds) * 0.95))], 4),
+        'max_ms': round(milliseconds[-1], 4),
+    }
+
+
+def time_call(func: Callable, args: tuple) -> float:
+    start = time.perf_counter()
+    result = func(*args)
+    if inspect.isgenerator(result):
+        for _ in result:
+            pass
+    return time.perf_counter() - start
+
+
+def legacy_matcher(path: str):
+    """groceryClass.GroceryShareApp reading ``path``, or None without Streamlit."""
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        module = importlib.import_module('groceryClass')
+    except ImportError:
+        return None
+    finally:
+        sys.path.pop(0)
+    # __init__ would open grocery_share.db in the working directory
+    app = module.GroceryShareApp.__new__(module.GroceryShareApp)
+    app.conn = sqlite3.connect(path, check_same_thread=False)
+    return app
+
+
+def sample_users(users: int, count: int, seed: int) -> List[str]:
+    """The biggest hub (user0) plus users spread over the population."""
+    rng = random.Random(seed)
+    others = rng.sample(range(1, users), min(count, users) - 1) if users > 1 else []
+    return [user_name(0)] + [user_name(index) for index in others]
+
+
+def run_tier(users: int, args) -> dict:
+    source = os.path.join(args.data_dir, f'population_{users}_{args.seed}.db')
+    dataset = {}
+    if not os.path.exists(source):
+        start = time.perf_counter()
+        dataset.update(generate(source, users, seed=args.seed))
+        dataset['generate_seconds'] = round(time.perf_counter() - start, 3)
+    else:
+        with sqlite3.connect(source) as conn:
+            dataset.update(users=users, **{
+                name: conn.execute(query).fetchone()[0] for name, query in (
+                    ('friendships', 'SELECT COUNT(*) / 2 FROM friends'),
+                    ('grocery_rows', 'SELECT COUNT(*) FROM grocery_lists'),
+                    ('purchases', 'SELECT COUNT(*) FROM purchase_tracking'),
+                )})
+        conn.close()
+    work = os.path.join(args.work_dir, f'tier_{users}.db')
+    shutil.copyfile(source, work)
+
+    start = time.perf_counter()
+    db = DatabaseManager(work, cache_size=0)
+    dataset['migrate_seconds'] = round(time.perf_counter() - start, 3)
+    if db.pool is None:
+        raise RuntimeError(f'could not open {work}')
+
+    methods = {}
+    try:
+        context = Context(db, sample_users(users, args.sample, args.seed), args.seed)
+        for spec in TIMED:
+            func = getattr(db, spec.method)
+            seconds = [time_call(func, spec.arguments(context, call))
+                       for call in range(spec.calls or args.calls)]
+            methods[f'DatabaseManager.{spec.method}'] = summarize(seconds)
+            print(f'{users:>7} {spec.method:<30} {methods[f"DatabaseManager.{spec.method}"]["median_ms"]:>10.3f} ms',
+                  flush=True)
+
+        legacy = legacy_matcher(work)
+        name = 'GroceryShareApp.find_matching_groceries'
+        if legacy is None:
+            methods[name] = {'skipped': 'groceryClass needs streamlit, which is not installed'}
+        else:
+            try:
+                methods[name] = summarize([time_call(legacy.find_matching_groceries, (context.user(call),))
+                                           for call in range(args.calls)])
+            finally:
+                legacy.conn.close()
+    finally:
+        db.close_connection()
+        os.remove(work)
+    return {'dataset': dataset, 'methods': methods}
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_ms: float) -> List[str]:
+    """Describe every method whose median got slower than in ``baseline`` by more than ``tolerance``."""
+    regressions = []
+    for tier, tier_results in results['tiers'].items():
+        old_methods = baseline.get('tiers', {}).get(tier, {}).get('methods', {})
+        for method, timing in tier_results['methods'].items():
+            old = old_methods.get(method)
+            if not old or 'median_ms' not in old or 'median_ms' not in timing:
+                continue
+            new_ms, old_ms = timing['median_ms'], old['median_ms']
+            if new_ms > old_ms * (1 + tolerance) and new_ms - old_ms > min_ms:
+                regressions.append(f'{tier} users: {method} {old_ms:.3f} ms -> {new_ms:.3f} ms '
+                                   f'({new_ms / old_ms:.1f}x)')
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tiers', type=int, nargs='+', default=[1000, 10_000, 100_000], help='population sizes')
+    parser.add_argument('--calls', type=int, default=20, help='timed calls per method and tier')
+    parser.add_argument('--sample', type=int, default=20, help='users the calls rotate through')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--data-dir', help='keep generated populations here and reuse them on later runs')
+    parser.add_argument('--output', default='bench_suite.json')
+    parser.add_argument('--compare', help='results of an earlier run to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='allowed slowdown, as a fraction; timings on a busy machine vary by ~50%%')
+    parser.add_argument('--min-ms', type=float, default=0.05, help='ignore slowdowns smaller than this')
+    args = parser.parse_args()
+
+    missing = untimed_methods()
+    if missing:
+        print(f"FAIL: add these DatabaseManager methods to TIMED or NOT_TIMED: {', '.join(missing)}")
+        return 1
+
+    results = {
+        'meta': {
+            'started': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'calls': args.calls,
+            'sample': args.sample,
+        },
+        'tiers': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        args.work_dir = tmp
+        if args.data_dir:
+            os.makedirs(args.data_dir, exist_ok=True)
+        else:
+            args.data_dir = tmp
+        for users in args.tiers:
+            results['tiers'][str(users)] = run_tier(users, args)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f'wrote {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_ms)
+        for regression in regressions:
+            print(f'FAIL: {regression}')
+        if regressions:
+            return 1
+        print(f'OK: no method is more than {args.tolerance:.0%} slower than in {args.compare}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
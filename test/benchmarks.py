@@ -0,0 +1,1227 @@
+"""Benchmarks for the GroceryShare data layer.
+
+Run from the ``test`` directory, for example::
+
+    python benchmarks.py matching
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import features
+from database import _MATCHES_FROM_SCRATCH, DatabaseManager
+from exporter import write_export
+from importer import import_grocery_list
+from instrumentation import QueryStats
+from models import UNITS
+from receipt_parser import parse_receipt_text
+from shards import ShardRouter
+from synthetic import generate, user_name
+from writebehind import WriteBehind
+
+
+def seed_friend_network(db: DatabaseManager, username: str, friend_count: int, item_count: int):
+    """Give ``username`` a grocery list and friends who all want the same items."""
+    users = [username] + [f'friend{i}' for i in range(friend_count)]
+    with db.pool.transaction() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                           [(user, 'x', f'{user}@example.com') for user in users])
+        cursor.executemany('INSERT INTO friends (user1, user2) VALUES (?, ?)',
+                           [(username, friend) for friend in users[1:]] +
+                           [(friend, username) for friend in users[1:]])
+        cursor.executemany('INSERT INTO grocery_lists (username, item, quantity, unit) VALUES (?, ?, ?, ?)',
+                           [(user, f'item{i}', 1.0, 'kg') for user in users for i in range(item_count)])
+
+
+def count_statements(db: DatabaseManager, func, *args):
+    """Run ``func`` and return (result, statements executed, seconds elapsed)."""
+    statements = []
+    db.pool.set_trace_callback(statements.append)
+    try:
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - start
+    finally:
+        db.pool.set_trace_callback(None)
+    return result, len(statements), elapsed
+
+
+def bench_matching(args) -> bool:
+    """Check that find_matching_groceries issues a constant number of queries."""
+    tiers = [(5, 5), (20, 20), (80, 60), (args.max_friends, args.max_items)]
+    counts = set()
+    print(f"{'friends':>8} {'items':>6} {'matches':>8} {'queries':>8} {'ms':>9}")
+    for friend_count, item_count in tiers:
+        db = DatabaseManager(':memory:')
+        seed_friend_network(db, 'bench_user', friend_count, item_count)
+        matches, queries, elapsed = count_statements(db, db.find_matching_groceries, 'bench_user')
+        match_count = sum(len(items) for items in matches.values())
+        counts.add(queries)
+        print(f'{friend_count:>8} {item_count:>6} {match_count:>8} {queries:>8} {elapsed * 1000:>9.2f}')
+        db.close_connection()
+
+    if len(counts) != 1:
+        print('FAIL: query count grows with friends and items')
+        return False
+    print('OK: query count is constant')
+    return True
+
+
+def bench_bulk_import(args) -> bool:
+    """Compare a chunked bulk import with calling add_grocery_item in a loop."""
+    with tempfile.TemporaryDirectory() as tmp:
+        csv_path = os.path.join(tmp, 'groceries.csv')
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['item', 'quantity', 'unit'])
+            for i in range(args.import_rows):
+                writer.writerow([f'item{i % 5000}', 1 + i % 7, UNITS[i % len(UNITS)]])
+
+        db = DatabaseManager(os.path.join(tmp, 'bulk.db'))
+        start = time.perf_counter()
+        with open(csv_path, newline='') as f:
+            result = import_grocery_list(db, 'bench_user', f, 'csv')
+        bulk_rate = result.inserted / (time.perf_counter() - start)
+        db.close_connection()
+
+        # One commit per row is slow enough that a sample gives a stable rate
+        db = DatabaseManager(os.path.join(tmp, 'loop.db'), max_connections=1)
+        start = time.perf_counter()
+        for i in range(args.loop_rows):
+            db.add_grocery_item('bench_user', f'item{i}', 1.0, 'kg')
+        loop_rate = args.loop_rows / (time.perf_counter() - start)
+        db.close_connection()
+
+    print(f'bulk import:      {result.inserted} rows, {bulk_rate:,.0f} rows/s, {result.error_count} errors')
+    print(f'add_grocery_item: {args.loop_rows} rows, {loop_rate:,.0f} rows/s ({bulk_rate / loop_rate:.1f}x slower)')
+    if bulk_rate / loop_rate < 10:
+        print('FAIL: bulk import is less than 10x faster than per-row inserts')
+        return False
+    print('OK: bulk import is at least 10x faster than per-row inserts')
+    return True
+
+
+def bench_export(args) -> bool:
+    """Check that streaming exports use constant memory as history grows."""
+    peaks = []
+    print(f"{'purchases':>10} {'format':>6} {'MB written':>11} {'peak KB':>8} {'s':>7}")
+    for purchases in (1_000, 10_000, args.export_rows):
+        db = DatabaseManager(':memory:')
+        with db.pool.transaction() as conn:
+            conn.executemany('''
+                INSERT INTO purchase_pools (pool_id, item, buyer, total_price, is_purchased)
+                VALUES (?, ?, 'bench_user', 10.0, 1)
+            ''', ((i, f'item{i}') for i in range(1, purchases + 1)))
+            conn.executemany('''
+                INSERT INTO pool_members (pool_id, username, quantity, share, is_purchased)
+                VALUES (?, ?, 1.0, 5.0, 1)
+            ''', ((i, user) for i in range(1, purchases + 1) for user in ('bench_user', f'friend{i % 50}')))
+
+        for fmt in ('csv', 'jsonl'):
+            with open(os.devnull, 'wb') as sink:
+                tracemalloc.start()
+                start = time.perf_counter()
+                written = write_export(db, 'bench_user', 'purchases', fmt, sink)
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            peaks.append(peak)
+            print(f'{purchases:>10} {fmt:>6} {written / 1e6:>11.2f} {peak / 1024:>8.0f} {elapsed:>7.2f}')
+        db.close_connection()
+
+    # Allow for noise, but a full in-memory export would grow ~100x here
+    if max(peaks) > 4 * min(peaks):
+        print('FAIL: export memory grows with history size')
+        return False
+    print('OK: export memory is independent of history size')
+    return True
+
+
+_PRODUCTS = ['milk', 'bread', 'apples', 'bananas', 'rice', 'pasta', 'cheese', 'butter', 'yogurt',
+             'chicken', 'beef', 'tofu', 'eggs', 'spinach', 'lettuce', 'tomatoes', 'onions', 'garlic',
+             'coffee', 'tea', 'orange juice', 'sparkling water', 'crackers', 'cookies', 'chocolate',
+             'honey', 'jam', 'peanut butter', 'olive oil', 'vinegar', 'ketchup', 'mustard', 'oats',
+             'cereal', 'flour', 'sugar', 'salt', 'black pepper', 'salmon', 'shrimp', 'tuna', 'bacon',
+             'ham', 'sausages', 'turkey', 'lamb', 'pork chops', 'cod', 'avocados', 'lemons', 'limes',
+             'grapes', 'strawberries', 'blueberries', 'raspberries', 'pears', 'peaches', 'plums',
+             'mangoes', 'pineapple', 'watermelon', 'carrots', 'potatoes', 'sweet potatoes', 'broccoli',
+             'cauliflower', 'cucumber', 'zucchini', 'bell peppers', 'mushrooms', 'celery', 'kale',
+             'cabbage', 'corn', 'peas', 'green beans', 'chickpeas', 'lentils', 'black beans', 'quinoa',
+             'couscous', 'noodles', 'tortillas', 'bagels', 'croissants', 'muffins', 'pancake mix',
+             'maple syrup', 'cream cheese', 'sour cream', 'mozzarella', 'parmesan', 'cheddar', 'feta',
+             'ice cream', 'frozen pizza', 'hummus', 'salsa', 'pesto', 'soy sauce', 'mayonnaise',
+             'almonds', 'walnuts', 'cashews', 'raisins', 'granola', 'popcorn', 'pretzels', 'tortilla chips',
+             'dish soap', 'paper towels', 'toilet paper', 'laundry detergent', 'sponges', 'trash bags']
+_VARIANTS = ['organic', '2%', 'whole', 'brown', 'frozen', 'fresh', 'large', 'small', 'red',
+             'green', 'greek', 'low fat', 'dark', 'unsalted', 'free range']
+
+
+def random_item_name(rng: random.Random) -> str:
+    """A grocery item name with an optional variant, word order swap or typo."""
+    name = rng.choice(_PRODUCTS)
+    if rng.random() < 0.5:
+        variant = rng.choice(_VARIANTS)
+        name = f'{name} {variant}' if rng.random() < 0.3 else f'{variant} {name}'
+    if rng.random() < 0.1:
+        i = rng.randrange(len(name))
+        name = name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz') + name[i + 1:]
+    return name
+
+
+def bench_fuzzy(args) -> bool:
+    """Time find_fuzzy_matches as friends' lists grow."""
+    rng = random.Random(0)
+    timings = {}
+    print(f"{'friends':>8} {'friend items':>13} {'matches':>8} {'best ms':>8}")
+    for friend_count in (10, 30, args.fuzzy_friends):
+        db = DatabaseManager(':memory:')
+        with db.pool.transaction() as conn:
+            conn.executemany('INSERT INTO friends (user1, user2) VALUES (?, ?)',
+                             [('bench_user', f'friend{i}') for i in range(friend_count)])
+        db.add_grocery_items('bench_user', [(random_item_name(rng), 1.0, 'kg') for _ in range(50)])
+        for i in range(friend_count):
+            db.add_grocery_items(f'friend{i}', [(random_item_name(rng), 1.0, 'kg') for _ in range(100)])
+
+        # Best of several runs, as timeit does, to keep scheduler noise out
+        best = float('inf')
+        for _ in range(7):
+            start = time.perf_counter()
+            matches = db.find_fuzzy_matches('bench_user')
+            best = min(best, time.perf_counter() - start)
+        timings[friend_count] = best
+        match_count = sum(len(items) for items in matches.values())
+        print(f'{friend_count:>8} {friend_count * 100:>13} {match_count:>8} {best * 1000:>8.2f}')
+        db.close_connection()
+
+    if timings[args.fuzzy_friends] * 1000 > args.fuzzy_budget_ms:
+        print(f'FAIL: fuzzy matching takes more than {args.fuzzy_budget_ms} ms')
+        return False
+    print(f'OK: fuzzy matching is within {args.fuzzy_budget_ms} ms')
+    return True
+
+
+def seed_social_graph(db: DatabaseManager, user_count: int, edge_count: int, rng: random.Random):
+    """Create a power-law friendship graph with ``edge_count`` rows in ``friends``.
+
+    Endpoints are drawn with Zipf-like weights, so a few users have thousands
+    of friends and most have a handful. Every user gets five grocery items.
+    """
+    users = [f'user{i}' for i in range(user_count)]
+    weights = [1 / (rank + 1) ** 0.8 for rank in range(user_count)]
+    pairs = set()
+    while len(pairs) * 2 < edge_count:
+        needed = edge_count // 2 - len(pairs)
+        for user1, user2 in zip(rng.choices(users, weights, k=needed), rng.choices(users, k=needed)):
+            if user1 != user2:
+                pairs.add((min(user1, user2), max(user1, user2)))
+    with db.pool.transaction() as conn:
+        conn.executemany('INSERT INTO friends (user1, user2) VALUES (?, ?)',
+                         [edge for user1, user2 in pairs for edge in ((user1, user2), (user2, user1))])
+        conn.executemany('''
+            INSERT INTO grocery_lists (username, item, quantity, unit, dimension, base_quantity)
+            VALUES (?, ?, 1.0, 'kg', 'mass', 1000.0)
+        ''', ((user, item) for user in users for item in rng.sample(_PRODUCTS, 5)))
+    return users
+
+
+def bench_network(args) -> bool:
+    """Time extended-network traversal and matching on a large friendship graph."""
+    rng = random.Random(0)
+    db = DatabaseManager(':memory:', cache_size=1024)
+    start = time.perf_counter()
+    users = seed_social_graph(db, args.graph_users, args.graph_edges, rng)
+    print(f'seeded {args.graph_users:,} users and {args.graph_edges:,} friend rows '
+          f'in {time.perf_counter() - start:.1f} s')
+
+    # A typical user, not one of the hubs at the head of the distribution
+    username = users[len(users) // 2]
+    ok = True
+    print(f"{'hops':>5} {'reached':>8} {'candidates':>11} {'cold ms':>9} {'cached queries':>15}")
+    for hops in range(1, args.max_hops + 1):
+        network, _, network_elapsed = count_statements(db, db.get_extended_network, username, hops)
+        candidates, _, match_elapsed = count_statements(db, db.find_network_matches, username, hops)
+        _, cached_queries, _ = count_statements(db, db.find_network_matches, username, hops)
+        cold_ms = (network_elapsed + match_elapsed) * 1000
+        print(f'{hops:>5} {len(network):>8} {len(candidates):>11} {cold_ms:>9.1f} {cached_queries:>15}')
+        if cached_queries:
+            print('FAIL: a repeated call was not served from the cache')
+            ok = False
+        if hops == 2 and cold_ms > args.network_budget_ms:
+            print(f'FAIL: friends-of-friends matching takes more than {args.network_budget_ms} ms')
+            ok = False
+
+    # An edge added inside the neighbourhood must invalidate the cached result
+    neighbour = db.get_extended_network(username, 2)[-1][0]
+    db.add_friend(neighbour, 'newcomer')
+    _, queries, _ = count_statements(db, db.find_network_matches, username, 2)
+    db.close_connection()
+    if not queries:
+        print('FAIL: add_friend in the neighbourhood did not invalidate the cache')
+        return False
+    if ok:
+        print('OK: repeated calls are cached and add_friend invalidates them')
+    return ok
+
+
+def render_matches_per_friend(db: DatabaseManager, username: str):
+    """The queries render_matches_page issued before it used a snapshot."""
+    db.get_grocery_items(username)
+    db.get_ongoing_purchases(username)
+    db.get_tracked_purchase_items(username)
+    for friend in db.get_friends(username):
+        db.find_matching_items(username, friend)
+
+
+def bench_snapshot(args) -> bool:
+    """Compare the Matches page snapshot with one query per friend."""
+    counts = set()
+    print(f"{'friends':>8} {'per-friend queries':>19} {'ms':>8} {'snapshot queries':>17} {'ms':>8}")
+    for friend_count in (5, 20, 80, args.max_friends):
+        db = DatabaseManager(':memory:')
+        seed_friend_network(db, 'bench_user', friend_count, 20)
+        _, legacy_queries, legacy_elapsed = count_statements(
+            db, render_matches_per_friend, db, 'bench_user')
+        _, queries, elapsed = count_statements(db, db.get_matches_snapshot, 'bench_user')
+        # BEGIN and COMMIT are traced too
+        counts.add(queries)
+        print(f'{friend_count:>8} {legacy_queries:>19} {legacy_elapsed * 1000:>8.2f} '
+              f'{queries:>17} {elapsed * 1000:>8.2f}')
+        db.close_connection()
+
+    if len(counts) != 1:
+        print('FAIL: snapshot statement count grows with friends')
+        return False
+    print('OK: snapshot statement count is constant')
+    return True
+
+
+def bench_pools(args) -> bool:
+    """Check that creating, joining and settling a pool is linear in its size."""
+    ok = True
+    statement_counts = set()
+    per_member_ms = []
+    print(f"{'members':>8} {'pairwise rows':>14} {'join queries':>13} {'join ms':>8} "
+          f"{'settle queries':>15} {'settle ms':>10}")
+    for member_count in (10, 100, 1_000, args.pool_members):
+        db = DatabaseManager(':memory:')
+        members = [f'member{i}' for i in range(member_count)]
+        with db.pool.transaction() as conn:
+            conn.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                             [(member, 'x', f'{member}@example.com') for member in members])
+        pool_id = db.create_pool('rice', members[0])
+
+        start = time.perf_counter()
+        for i, member in enumerate(members[:-1]):
+            db.join_pool(pool_id, member, float(i + 1))
+        join_elapsed = time.perf_counter() - start
+        # The last join is traced to check it costs the same as the first
+        _, join_queries, last_join = count_statements(db, db.join_pool, pool_id, members[-1], 1.0)
+        join_elapsed += last_join
+        purchase, settle_queries, settle_elapsed = count_statements(db, db.settle_pool, pool_id, 100.0)
+        db.close_connection()
+
+        statement_counts.add((join_queries, settle_queries))
+        per_member_ms.append((join_elapsed + settle_elapsed) * 1000 / member_count)
+        print(f'{member_count:>8} {member_count * (member_count - 1) // 2:>14} {join_queries:>13} '
+              f'{join_elapsed * 1000:>8.1f} {settle_queries:>15} {settle_elapsed * 1000:>10.2f}')
+        if len(purchase.shares) != member_count or abs(sum(purchase.shares.values()) - 100.0) > 1e-6:
+            print('FAIL: shares do not cover every member and the full price')
+            ok = False
+
+    if len(statement_counts) != 1:
+        print('FAIL: join or settle statement count grows with pool size')
+        ok = False
+    # Allow for noise; quadratic work would grow ~100x across these sizes
+    if max(per_member_ms) > 4 * min(per_member_ms):
+        print('FAIL: per-member cost grows with pool size')
+        ok = False
+    if ok:
+        print('OK: pool operations cost a constant number of statements and linear time')
+    return ok
+
+
+def seed_purchases(db: DatabaseManager, users, first_pool_id: int, count: int, rng: random.Random):
+    """Insert ``count`` settled pools of two to four members, each split equally."""
+    pools, members = [], []
+    for pool_id in range(first_pool_id, first_pool_id + count):
+        group = rng.sample(users, rng.randint(2, 4))
+        price = rng.randint(100, 5000) / 100
+        pools.append((pool_id, rng.choice(_PRODUCTS), group[0], price))
+        members.extend((pool_id, member, price / len(group)) for member in group)
+    with db.pool.transaction() as conn:
+        # The member triggers fill in total_quantity and member_count
+        conn.executemany('''
+            INSERT INTO purchase_pools (pool_id, item, buyer, total_price, is_purchased) VALUES (?, ?, ?, ?, 1)
+        ''', pools)
+        conn.executemany('''
+            INSERT INTO pool_members (pool_id, username, quantity, share, is_purchased) VALUES (?, ?, 1.0, ?, 1)
+        ''', members)
+
+
+def bench_ledger(args) -> bool:
+    """Check that settling a pool and reading a balance do not slow down as history grows."""
+    rng = random.Random(0)
+    ok = True
+    users = [f'user{i}' for i in range(args.ledger_users)]
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'ledger.db'))
+        with db.pool.transaction() as conn:
+            conn.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                             [(user, 'x', f'{user}@example.com') for user in users])
+
+        # The same pair balance computed from the purchase history
+        def history_balance(username, other):
+            with db.pool.connection() as conn:
+                return conn.execute('''
+                    SELECT COALESCE(SUM(CASE WHEN m.username = :user AND p.buyer = :other THEN m.share
+                                             WHEN m.username = :other AND p.buyer = :user THEN -m.share END), 0)
+                    FROM pool_members m
+                    JOIN purchase_pools p ON p.pool_id = m.pool_id
+                    WHERE m.username IN (:user, :other) AND p.is_purchased = 1
+                ''', {'user': username, 'other': other}).fetchone()[0]
+
+        def best_ms(func, calls):
+            # Best of several rounds, as timeit does, to keep scheduler noise out
+            best = float('inf')
+            for _ in range(5):
+                start = time.perf_counter()
+                for call_args in calls:
+                    func(*call_args)
+                best = min(best, time.perf_counter() - start)
+            return best * 1000 / len(calls)
+
+        timings = {}
+        seeded = 0
+        print(f"{'purchases':>10} {'settle ms':>10} {'balance ms':>11} {'history ms':>11} {'settle_up ms':>13}")
+        for purchases in (10_000, 100_000, args.ledger_purchases):
+            seed_purchases(db, users, seeded + 1, purchases - seeded, rng)
+            seeded = purchases
+            db.rebuild_balances()
+
+            pools = []
+            for number in range(500):
+                group = rng.sample(users, 3)
+                # A buyer has one open pool per item
+                pool_id = db.create_pool(f'rice {number}', group[0])
+                for member in group:
+                    db.join_pool(pool_id, member, 1.0)
+                pools.append(pool_id)
+            start = time.perf_counter()
+            for pool_id in pools:
+                db.settle_pool(pool_id, 9.0)
+            settle_ms = (time.perf_counter() - start) * 1000 / len(pools)
+            seeded += len(pools)
+
+            pairs = [tuple(rng.sample(users, 2)) for _ in range(200)]
+            balance_ms = best_ms(db.get_balance, pairs)
+            history_ms = best_ms(history_balance, pairs[:20])
+            settle_up_ms = best_ms(db.settle_up, [(rng.sample(users, 12),)])
+            timings[purchases] = (settle_ms, balance_ms)
+            print(f'{purchases:>10} {settle_ms:>10.3f} {balance_ms:>11.3f} {history_ms:>11.3f} {settle_up_ms:>13.2f}')
+
+        for username, other in pairs:
+            if abs(db.get_balance(username, other) - history_balance(username, other)) > 1e-6:
+                print('FAIL: an incrementally maintained balance disagrees with the history')
+                ok = False
+                break
+        incremental = db.get_balances(users[0])
+        db.rebuild_balances()
+        if any(abs(amount - db.get_balances(users[0]).get(other, 0.0)) > 1e-6
+               for other, amount in incremental.items()):
+            print('FAIL: rebuilding balances from the history changed them')
+            ok = False
+        db.close_connection()
+
+    # Allow for noise; a history scan would grow ~100x across these sizes
+    smallest, largest = timings[10_000], timings[args.ledger_purchases]
+    if largest[0] > 3 * smallest[0] or largest[1] > 3 * smallest[1]:
+        print('FAIL: settling or reading a balance slows down as history grows')
+        ok = False
+    if ok:
+        print('OK: settle and balance cost is independent of history size')
+    return ok
+
+
+def bench_feeds(args) -> bool:
+    """Check that the first page of a user's purchase feeds does not slow down as history grows."""
+    rng = random.Random(0)
+    ok = True
+    timings = {}
+    print(f"{'history':>9} {'full history ms':>16} {'history page ms':>16} {'ongoing page ms':>16} "
+          f"{'deep page ms':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'feeds.db'))
+        friends = [f'friend{i}' for i in range(50)]
+        # Each tier 10x the last, up to --feed-history; smaller ones would not fill a deep page
+        tiers = sorted({min(max(history, 1_000), args.feed_history)
+                        for history in (args.feed_history // 1_000, args.feed_history // 100,
+                                        args.feed_history // 10, args.feed_history)})
+        # A few purchases still open, the same in every tier and newer than all of the history
+        open_pools = range(args.feed_history + 1, args.feed_history + 6)
+        with db.pool.transaction() as conn:
+            conn.executemany('INSERT INTO purchase_pools (pool_id, item, buyer) VALUES (?, ?, ?)',
+                             zip(open_pools, rng.sample(_PRODUCTS, 5), rng.sample(friends, 5)))
+        for pool_id in open_pools:
+            db.join_pool(pool_id, 'bench_user', 1.0)
+        seeded = 0
+        for history in tiers:
+            # Years of settled purchases shared with friends
+            with db.pool.transaction() as conn:
+                conn.executemany('''
+                    INSERT INTO purchase_pools (pool_id, item, buyer, total_price, is_purchased) VALUES (?, ?, ?, 9.0, 1)
+                ''', ((pool_id, rng.choice(_PRODUCTS), rng.choice(friends))
+                      for pool_id in range(seeded + 1, history + 1)))
+                conn.executemany('''
+                    INSERT INTO pool_members (pool_id, username, quantity, share, is_purchased) VALUES (?, ?, 1.0, 4.5, 1)
+                ''', ((pool_id, user) for pool_id in range(seeded + 1, history + 1)
+                      for user in ('bench_user', friends[pool_id % len(friends)])))
+            seeded = history
+
+            def best_ms(func, *func_args, calls=1):
+                # Best of several runs, as timeit does, to keep scheduler noise out
+                best = float('inf')
+                for _ in range(7):
+                    start = time.perf_counter()
+                    for _ in range(calls):
+                        func(*func_args)
+                    best = min(best, time.perf_counter() - start)
+                return best * 1000 / calls
+
+            full_ms = best_ms(db.get_purchase_history, 'bench_user')
+            page_ms = best_ms(db.get_purchase_history_page, 'bench_user', calls=100)
+            ongoing_ms = best_ms(db.get_ongoing_purchases_page, 'bench_user', calls=100)
+            deep_ms = best_ms(db.get_purchase_history_page, 'bench_user', history // 2, calls=100)
+            timings[history] = (page_ms, ongoing_ms, deep_ms)
+            print(f'{history:>9} {full_ms:>16.2f} {page_ms:>16.3f} {ongoing_ms:>16.3f} {deep_ms:>13.3f}')
+
+        # Walking every page must visit each settled purchase exactly once
+        seen, cursor = 0, None
+        while True:
+            page = db.get_purchase_history_page('bench_user', cursor, 1_000)
+            seen += len(page.rows)
+            cursor = page.next_cursor
+            if cursor is None:
+                break
+        db.close_connection()
+
+    if seen != args.feed_history:
+        print(f'FAIL: paging visited {seen} purchases, expected {args.feed_history}')
+        ok = False
+    # Allow for noise; reading the whole history grows ~1000x across these sizes
+    smallest, largest = timings[tiers[0]], timings[tiers[-1]]
+    if any(large > 3 * small for small, large in zip(smallest, largest)):
+        print('FAIL: page latency grows with history length')
+        ok = False
+    if ok:
+        print('OK: page latency is independent of history length')
+    return ok
+
+
+def match_dicts(db: DatabaseManager, username: str):
+    """find_matching_groceries as it was before it returned Match records: one dict per row."""
+    matching_items = {}
+    for friend, item, quantity, friend_quantity, unit in db.iter_matches(username):
+        matching_items.setdefault(friend, []).append({
+            'item': item,
+            'user_quantity': quantity,
+            'friend_quantity': friend_quantity,
+            'unit': unit
+        })
+    return matching_items
+
+
+def retained_memory(func, *func_args):
+    """Return (result, bytes, allocated blocks) still held once ``func`` returns, and its seconds."""
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        result = func(*func_args)
+        elapsed = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    statistics = snapshot.statistics('filename')
+    return result, sum(stat.size for stat in statistics), sum(stat.count for stat in statistics), elapsed
+
+
+def bench_records(args) -> bool:
+    """Compare the memory held by a large match set as Match records and as per-row dicts."""
+    db = DatabaseManager(':memory:')
+    seed_friend_network(db, 'bench_user', args.record_friends, 500)
+    dicts, dict_bytes, dict_blocks, dict_seconds = retained_memory(match_dicts, db, 'bench_user')
+    del dicts
+    records, record_bytes, record_blocks, record_seconds = retained_memory(
+        db.find_matching_groceries, 'bench_user')
+    rows = sum(len(matches) for matches in records.values())
+    db.close_connection()
+
+    print(f"{'rows as':>8} {'matches':>8} {'bytes/row':>10} {'blocks/row':>11} {'ms (traced)':>12}")
+    for name, size, blocks, seconds in (('dicts', dict_bytes, dict_blocks, dict_seconds),
+                                        ('records', record_bytes, record_blocks, record_seconds)):
+        print(f'{name:>8} {rows:>8} {size / rows:>10.1f} {blocks / rows:>11.2f} {seconds * 1000:>12.1f}')
+
+    if record_bytes > 0.7 * dict_bytes:
+        print('FAIL: Match records do not save at least 30% of the memory of dicts')
+        return False
+    print(f'OK: Match records hold {1 - record_bytes / dict_bytes:.0%} less memory than dicts')
+    return True
+
+
+def render_dashboard_reads(db: DatabaseManager, username: str):
+    """The reads of one Matches page rerun with the read cache off."""
+    db.get_friends(username)
+    db.get_grocery_items(username)
+    db.get_matches_snapshot(username)
+    db.get_balances(username)
+
+
+def bench_instrumentation(args) -> bool:
+    """Measure what query instrumentation costs, enabled and disabled."""
+    reruns = 200
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'instrumented.db')
+        plain = DatabaseManager(path)
+        seed_friend_network(plain, 'bench_user', 50, 50)
+        stats = QueryStats()
+        instrumented = DatabaseManager(path, stats=stats)
+
+        def best_ms(db):
+            best = float('inf')
+            for _ in range(7):
+                start = time.perf_counter()
+                for _ in range(reruns):
+                    render_dashboard_reads(db, 'bench_user')
+                best = min(best, time.perf_counter() - start)
+            return best * 1000 / reruns
+
+        plain_ms = best_ms(plain)
+        instrumented_ms = best_ms(instrumented)
+        plain_types = {type(conn) for conn in plain.pool._connections}
+        calls = {summary.sql: summary.calls for summary in stats.statements()}
+        plain.close_connection()
+        instrumented.close_connection()
+
+    overhead = instrumented_ms / plain_ms - 1
+    print(f'{reruns * 7} reruns: {plain_ms:.3f} ms plain, {instrumented_ms:.3f} ms instrumented '
+          f'({overhead:+.1%}), {len(calls)} distinct statements recorded')
+    ok = True
+    if plain_types != {sqlite3.Connection}:
+        print(f'FAIL: uninstrumented pool opened {plain_types}')
+        ok = False
+    if calls.get('SELECT user2 FROM friends WHERE user1 = ?') != 2 * reruns * 7:
+        print('FAIL: statement calls were not all recorded')
+        ok = False
+    if overhead > args.max_instrumentation_overhead:
+        print(f'FAIL: instrumentation costs more than {args.max_instrumentation_overhead:.0%}')
+        ok = False
+    if ok:
+        print('OK: disabled instrumentation uses plain connections and enabled instrumentation is cheap')
+    return ok
+
+
+def bench_materialized(args) -> bool:
+    """Compare matches read from the materialized table with the join it replaces, and check it stays exact."""
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'population.db')
+        generate(path, args.materialized_users)
+        start = time.perf_counter()
+        db = DatabaseManager(path)
+        migrate_s = time.perf_counter() - start
+        with db.pool.connection() as conn:
+            rows = conn.execute('SELECT COUNT(*) FROM matches').fetchone()[0]
+        print(f'{args.materialized_users} users: {rows} materialized matches, migrated in {migrate_s:.1f} s')
+
+        # user0 is the best-connected hub of the synthetic friend graph
+        users = [user_name(0)] + [user_name(rng.randrange(args.materialized_users)) for _ in range(199)]
+
+        def join_matches(username):
+            with db.pool.connection() as conn:
+                return conn.execute(_MATCHES_FROM_SCRATCH + ' WHERE f.user1 = ?', (username,)).fetchall()
+
+        def best_ms(func, calls):
+            best = float('inf')
+            for _ in range(5):
+                start = time.perf_counter()
+                for call_args in calls:
+                    func(*call_args)
+                best = min(best, time.perf_counter() - start)
+            return best * 1000 / len(calls)
+
+        print(f"{'users':>9} {'join ms':>8} {'table ms':>9} {'add ms':>7} {'remove ms':>10}")
+        timings = {}
+        for label, sample in (('hub', users[:1]), ('sampled', users)):
+            calls = [(user,) for user in sample]
+            join_ms = best_ms(join_matches, calls)
+            table_ms = best_ms(lambda user: list(db.iter_matches(user)), calls)
+            # A popular item, so every write refreshes matches against many friends
+            start = time.perf_counter()
+            for user in sample:
+                db.add_grocery_item(user, 'milk', 1.0, 'lbs')
+            add_ms = (time.perf_counter() - start) * 1000 / len(sample)
+            start = time.perf_counter()
+            for user in sample:
+                db.remove_grocery_item(user, 'milk')
+            remove_ms = (time.perf_counter() - start) * 1000 / len(sample)
+            timings[label] = (join_ms, table_ms)
+            print(f'{label:>9} {join_ms:>8.3f} {table_ms:>9.3f} {add_ms:>7.2f} {remove_ms:>10.2f}')
+
+        # Random writes of every kind the triggers handle
+        items = [grocery.item for grocery in db.get_grocery_items(user_name(0))]
+        for call in range(args.materialized_writes):
+            user, other = user_name(rng.randrange(100)), user_name(rng.randrange(args.materialized_users))
+            kind = call % 6
+            if kind == 0:
+                db.add_grocery_item(user, rng.choice(items), float(rng.randint(1, 5)), rng.choice(UNITS))
+            elif kind == 1:
+                db.remove_grocery_item(user, rng.choice(items))
+            elif kind == 2:
+                db.add_friend(user, other)
+            elif kind == 3:
+                db.remove_friend(user, other)
+            elif kind == 4:
+                rows = db.get_grocery_items(user)
+                if rows:
+                    db.update_grocery_item(user, rng.choice(rows).id, rng.choice(items),
+                                           float(rng.randint(1, 5)), rng.choice(UNITS))
+            else:
+                db.add_grocery_items(other, [(item, 1.0, rng.choice(UNITS)) for item in rng.sample(items, 3)])
+        db.add_unit_conversion('bottle', 1, 'kg', items[0])
+        start = time.perf_counter()
+        diff = db.check_matches()
+        check_s = time.perf_counter() - start
+        db.close_connection()
+
+    print(f'{args.materialized_writes} random writes and a unit conversion later, '
+          f'check_matches took {check_s:.1f} s: {len(diff.missing)} missing, {len(diff.unexpected)} unexpected')
+    ok = True
+    if diff.missing or diff.unexpected:
+        print('FAIL: the materialized matches differ from a rebuild')
+        ok = False
+    if any(table_ms > join_ms for join_ms, table_ms in timings.values()):
+        print('FAIL: reading the materialized matches is slower than the join')
+        ok = False
+    if ok:
+        print('OK: materialized matches are exact and faster to read than the join')
+    return ok
+
+
+def bench_changes(args) -> bool:
+    """Check that polling for changes costs the same however long the change log is."""
+    rng = random.Random(0)
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        db = DatabaseManager(os.path.join(tmp, 'changes.db'))
+        users = seed_social_graph(db, args.change_users, args.change_users * 10, rng)
+        pollers = rng.sample(users, 200)
+
+        def best_ms(since):
+            best = float('inf')
+            for _ in range(5):
+                start = time.perf_counter()
+                for username in pollers:
+                    db.get_changes(username, since)
+                best = min(best, time.perf_counter() - start)
+            return best * 1000 / len(pollers)
+
+        timings = {}
+        logged = 0
+        print(f"{'log rows':>10} {'poll ms':>8} {'changes/poll':>13} {'full reload ms':>15}")
+        for rows in (10_000, 100_000, args.change_log_rows):
+            with db.pool.transaction() as conn:
+                conn.executemany('INSERT INTO change_log (username, kind, data) VALUES (?, ?, ?)',
+                                 ((rng.choice(users), 'grocery_added', '{"item": "milk"}')
+                                  for _ in range(rows - logged)))
+            logged = rows
+            # Every poll picks up the last thousand changes, as a dashboard a few seconds behind would
+            since = db.get_change_seq() - 1000
+            poll_ms = best_ms(since)
+            per_poll = sum(len(db.get_changes(username, since)) for username in pollers) / len(pollers)
+            reload_ms = min(count_statements(db, render_dashboard_reads, db, username)[2]
+                            for username in pollers[:20]) * 1000
+            timings[rows] = poll_ms
+            print(f'{rows:>10} {poll_ms:>8.3f} {per_poll:>13.1f} {reload_ms:>15.3f}')
+
+        seq = db.get_change_seq()
+        db.add_friend(pollers[0], pollers[1])
+        db.add_grocery_item(pollers[1], 'milk', 1.0, 'kg')
+        kinds = [(change.username, change.kind) for change in db.get_changes(pollers[0], seq)]
+        db.close_connection()
+
+    if kinds != [(pollers[0], 'friend_added'), (pollers[1], 'friend_added'), (pollers[1], 'grocery_added')]:
+        print(f"FAIL: a poll after adding a friend and their item returned {kinds}")
+        ok = False
+    # Allow for noise; a scan of the log would grow ~100x across these sizes
+    if timings[args.change_log_rows] > 3 * timings[10_000]:
+        print('FAIL: polling slows down as the change log grows')
+        ok = False
+    if ok:
+        print('OK: polls see their own and friends\' changes at a cost independent of log size')
+    return ok
+
+
+def render_receipt(lines, rng: random.Random):
+    """Draw receipt text as a slightly rotated, noisy grayscale photo."""
+    import cv2
+    import numpy as np
+
+    height = 60 + 36 * len(lines)
+    image = np.full((height, 640), 255, np.uint8)
+    for row, text in enumerate(lines):
+        cv2.putText(image, text, (30, 50 + 36 * row), cv2.FONT_HERSHEY_SIMPLEX, 0.8, 0, 2, cv2.LINE_AA)
+    rotation = cv2.getRotationMatrix2D((320, height / 2), rng.uniform(-3, 3), 1.0)
+    image = cv2.warpAffine(image, rotation, (640, height), borderValue=200)
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).normal(0, 12, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+# Summary lines whose wording overlaps the payment lines that are skipped
+_RECEIPT_TOTALS = {
+    'TOTAL                  3.47': 3.47,
+    'BALANCE DUE            3.47': 3.47,
+    'AMOUNT DUE             3.47': 3.47,
+}
+
+
+def check_receipt_totals() -> bool:
+    """Check that each way of printing the total is read as the total, not an item."""
+    ok = True
+    for line, expected in _RECEIPT_TOTALS.items():
+        receipt = parse_receipt_text(f'AVOCADO                1.98\nBANANAS                1.49\n'
+                                     f'SUBTOTAL               3.47\nPREVIOUS BALANCE       0.00\n{line}')
+        if receipt.total != expected or [item.name for item in receipt.items] != ['AVOCADO', 'BANANAS']:
+            print(f"FAIL: {line.split('  ')[0]!r} parsed as total {receipt.total} with items {receipt.items}")
+            ok = False
+    return ok
+
+
+def bench_receipts(args) -> bool:
+    """Measure receipts read per second, serially and in a process pool."""
+    if not check_receipt_totals():
+        return False
+    unavailable = features.missing('receipts')
+    if unavailable:
+        print(f"SKIP: receipt reading needs {', '.join(unavailable)}")
+        return True
+    import cv2
+    from receipts import read_receipts
+
+    rng = random.Random(0)
+    expected = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for number in range(args.receipts):
+            items = [(rng.choice(_PRODUCTS).upper(), rng.randint(50, 2000) / 100) for _ in range(rng.randint(5, 15))]
+            lines = [f'{name:<20} {price:>7.2f}' for name, price in items]
+            lines.append(f"{'TOTAL':<20} {sum(price for _, price in items):>7.2f}")
+            path = os.path.join(tmp, f'receipt{number}.png')
+            cv2.imwrite(path, render_receipt(lines, rng))
+            paths.append(path)
+            expected.append(items)
+
+        rates = {}
+        print(f"{'workers':>8} {'receipts':>9} {'receipts/s':>11} {'prices read':>12}")
+        for workers in sorted({1, os.cpu_count() or 1}):
+            start = time.perf_counter()
+            receipts = read_receipts(paths, workers)
+            rates[workers] = len(paths) / (time.perf_counter() - start)
+            found = sum(len({price for _, price in items} & {line.price for line in receipt.items})
+                        for items, receipt in zip(expected, receipts))
+            accuracy = found / sum(len(items) for items in expected)
+            print(f'{workers:>8} {len(paths):>9} {rates[workers]:>11.2f} {accuracy:>12.0%}')
+
+    if accuracy < 0.8:
+        print('FAIL: fewer than 80% of receipt prices were read')
+        return False
+    if len(rates) > 1 and max(rates.values()) < 1.5 * rates[1]:
+        print('FAIL: the process pool does not speed up batches')
+        return False
+    print('OK: receipts are read accurately and batches scale across processes')
+    return True
+
+
+def bench_claims(args) -> bool:
+    """Race both friends of every pair to claim the same items and check that each claim is made once."""
+    rng = random.Random(0)
+    users = [f'user{i}' for i in range(args.claim_pairs)]
+    # A ring, so most users claim with two friends and their pools are shared
+    pairs = [(users[i], users[(i + 1) % len(users)]) for i in range(len(users))]
+    items = [f'item{i}' for i in range(3)]
+    # Each friend presses "I'll Buy" twice, as an impatient user would
+    calls = [(item, me, friend) for user1, user2 in pairs for item in items
+             for me, friend in ((user1, user2), (user2, user1)) for _ in range(2)]
+    rng.shuffle(calls)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'claims.db')
+        # Two managers stand for the app and the API writing the same file
+        managers = [DatabaseManager(path, max_connections=args.claim_threads) for _ in range(2)]
+        with managers[0].pool.transaction() as conn:
+            conn.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                             [(user, 'x', f'{user}@example.com') for user in users])
+
+        def claim(number, item, me, friend):
+            return managers[number % 2].track_matched_item_purchase(item, me, friend, me)
+
+        start = time.perf_counter()
+        errors = []
+        pool_ids = {}
+        with ThreadPoolExecutor(args.claim_threads) as executor:
+            futures = [(call, executor.submit(claim, number, *call)) for number, call in enumerate(calls)]
+            for (item, me, friend), future in futures:
+                try:
+                    pool_ids.setdefault((item, *sorted((me, friend))), set()).add(future.result())
+                except sqlite3.Error as e:
+                    errors.append(e)
+        elapsed = time.perf_counter() - start
+
+        with managers[0].pool.connection() as conn:
+            claims = dict(((item, user1, user2), buyer) for item, user1, user2, buyer in
+                          conn.execute('SELECT item, user1, user2, buyer FROM pool_claims'))
+            # Open pools holding both friends of a pair, bought by one of them
+            shared = conn.execute('''
+                SELECT c.item, c.user1, c.user2, COUNT(*)
+                FROM pool_claims c
+                JOIN purchase_pools p ON p.item = c.item AND p.buyer IN (c.user1, c.user2) AND p.is_purchased = 0
+                JOIN pool_members m1 ON m1.pool_id = p.pool_id AND m1.username = c.user1
+                JOIN pool_members m2 ON m2.pool_id = p.pool_id AND m2.username = c.user2
+                GROUP BY c.item, c.user1, c.user2
+            ''').fetchall()
+            open_pools = conn.execute('SELECT COUNT(*) FROM purchase_pools WHERE is_purchased = 0').fetchone()[0]
+        for db in managers:
+            db.close_connection()
+
+    expected = {(item, *sorted(pair)) for pair in pairs for item in items}
+    lost = expected - claims.keys()
+    duplicated = [key for key, *_, count in shared if count != 1]
+    unshared = expected - {(item, user1, user2) for item, user1, user2, _ in shared}
+    split = [key for key, ids in pool_ids.items() if len(ids) != 1]
+    print(f'{len(calls)} claims on {len(expected)} (pair, item) keys from {args.claim_threads} threads '
+          f'in {elapsed:.2f} s: {len(claims)} claims, {open_pools} open pools, {len(errors)} errors')
+    problems = []
+    if errors:
+        problems.append(f'{len(errors)} claims failed, the first with {errors[0]!r}')
+    if lost or unshared:
+        problems.append(f'{len(lost | unshared)} pairs have no pool they share')
+    if duplicated:
+        problems.append(f'{len(duplicated)} pairs share more than one pool')
+    if split:
+        problems.append(f'{len(split)} pairs were told different pools')
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    if not problems:
+        print('OK: every pair claimed each item exactly once')
+    return not problems
+
+
+def seed_communities(router: ShardRouter, communities, users: int, rng: random.Random):
+    """Register ``users`` users in each community, befriend their neighbours and give each a few items.
+
+    The first user of each community is also friends with the first user of
+    the next, so every community has friends elsewhere.
+    """
+    members = {community: [f'{community}-user{i}' for i in range(users)] for community in communities}
+    for community, names in members.items():
+        for name in names:
+            router.register_user(name, 'x', f'{name}@example.com', community)
+    for community, names in members.items():
+        for i, name in enumerate(names):
+            router.add_friend(name, names[(i + 1) % len(names)])
+            router.for_user(name).add_grocery_items(name, [(item, float(rng.randint(1, 5)), 'kg')
+                                                           for item in rng.sample(_PRODUCTS, 5)])
+    firsts = [names[0] for names in members.values()]
+    for i, name in enumerate(firsts):
+        router.for_user(name).add_grocery_item(name, 'coffee', 1, 'kg')
+        if i:
+            router.add_friend(firsts[i - 1], name)
+    return members
+
+
+def write_communities(router: ShardRouter, members, writes: int, stop: threading.Event = None,
+                      latencies: list = None):
+    """Add items for each community's users from a thread per community; return the (user, item) written.
+
+    Writes ``writes`` items per community, or until ``stop`` is set, and
+    appends each write's time in ms to ``latencies`` if given.
+    """
+    written = []
+
+    def writer(number, names):
+        for n in range(writes):
+            if stop is not None and stop.is_set():
+                break
+            name = names[n % len(names)]
+            item = f'written {number}-{n}'
+            start = time.perf_counter()
+            with router.session(name) as db:
+                db.add_grocery_item(name, item, 1, 'kg')
+            if latencies is not None:
+                latencies.append((time.perf_counter() - start) * 1000)
+            written.append((name, item))
+
+    with ThreadPoolExecutor(len(members)) as executor:
+        for future in [executor.submit(writer, number, names) for number, names in enumerate(members.values())]:
+            future.result()
+    return written
+
+
+def bench_shards(args) -> bool:
+    """Check communities on their own shards do not wait on each other's write lock, then move one while it writes.
+
+    One community holds its write lock, as a bulk import or a writer in
+    another process would, while the others write. Raw throughput is not
+    compared: on one host the writes share the same CPUs and disk either way.
+    """
+    rng = random.Random(0)
+    communities = [f'campus{i}' for i in range(args.shard_communities)]
+    with tempfile.TemporaryDirectory() as tmp:
+        slowest = {}
+        for layout in ('single', 'sharded'):
+            router = ShardRouter(os.path.join(tmp, f'{layout}.db'))
+            for community in communities:
+                shard = community if layout == 'sharded' else 'all'
+                if shard not in router.shards():
+                    router.add_shard(shard, os.path.join(tmp, f'{layout}-{shard}.db'))
+                router.add_community(community, shard)
+            members = seed_communities(router, communities, args.community_users, rng)
+            holder = members[communities[0]][0]
+            held, latencies = threading.Event(), []
+
+            def hold():
+                with router.session(holder) as db, db.pool.transaction():
+                    db.add_grocery_item(holder, 'held', 1, 'kg')
+                    held.set()
+                    time.sleep(args.shard_hold_ms / 1000)
+
+            with ThreadPoolExecutor(1) as executor:
+                holding = executor.submit(hold)
+                held.wait()
+                others = {community: names for community, names in members.items() if names[0] != holder}
+                write_communities(router, others, args.shard_writes, latencies=latencies)
+                holding.result()
+            slowest[layout] = max(latencies)
+            router.close()
+        print(f"{args.shard_writes} writes from each of {len(communities) - 1} communities while another holds "
+              f"its write lock for {args.shard_hold_ms:.0f} ms: slowest write {slowest['single']:.1f} ms on one "
+              f"file, {slowest['sharded']:.1f} ms on a file each")
+
+        # Two communities share a shard; the first moves to an empty one while both keep writing
+        router = ShardRouter(os.path.join(tmp, 'move.db'))
+        router.add_shard('old', os.path.join(tmp, 'old.db'))
+        router.add_shard('new', os.path.join(tmp, 'new.db'))
+        for community in communities[:2]:
+            router.add_community(community, 'old')
+        members = seed_communities(router, communities[:2], args.community_users, rng)
+        moving, staying = communities[:2]
+        old, new = router.manager('old'), router.manager('new')
+        stayed = old.get_grocery_items(members[staying][1])
+        stop = threading.Event()
+        with ThreadPoolExecutor(1) as executor:
+            writes = executor.submit(write_communities, router, members, 1_000_000, stop)
+            time.sleep(0.2)
+            report = router.move_community(moving, 'new', drain_seconds=args.drain_seconds)
+            time.sleep(0.2)
+            stop.set()
+            written = writes.result()
+
+        moved = set(members[moving])
+        missing = [(name, item) for name, item in written if name in moved and
+                   item not in {grocery.item for grocery in new.get_grocery_items(name)}]
+        with old.pool.connection() as conn:
+            left_behind = conn.execute('''
+                SELECT (SELECT COUNT(*) FROM users WHERE username IN (SELECT value FROM json_each(:names))) +
+                       (SELECT COUNT(*) FROM grocery_lists WHERE username IN (SELECT value FROM json_each(:names)))
+            ''', {'names': json.dumps(sorted(moved))}).fetchone()[0]
+        remote = router.find_remote_matches(members[moving][0])
+        diffs = [db.check_matches() for db in (old, new)]
+        still_there = old.get_grocery_items(members[staying][1])
+        router.close()
+
+    print(f'moved {report.users} users in {report.total_ms:.0f} ms over {report.rounds} copies while '
+          f'{len(written)} writes were made; writes were held back for {report.paused_ms:.0f} ms')
+    problems = []
+    if slowest['sharded'] * args.min_shard_speedup > slowest['single']:
+        problems.append(f"other communities' writes waited on the held lock "
+                        f"(less than {args.min_shard_speedup}x faster than on one file)")
+    if missing:
+        problems.append(f'{len(missing)} writes to the moved community are missing from its new shard')
+    if left_behind:
+        problems.append(f'{left_behind} rows of the moved community are left on its old shard')
+    if any(diff.missing or diff.unexpected for diff in diffs):
+        problems.append('the matches table is out of date on a shard')
+    if members[staying][0] not in remote:
+        problems.append('matches with a friend left on the old shard are not found')
+    if not {grocery.item for grocery in stayed} <= {grocery.item for grocery in still_there}:
+        problems.append('the community that stayed lost rows')
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    if not problems:
+        print("OK: communities did not wait on each other's lock, and one moved with every write and nothing left behind")
+    return not problems
+
+
+def bench_write_behind(args) -> bool:
+    """Compare committing each write with group commits from a write-behind queue.
+
+    Sessions write in bursts, as a user clicking through a page would, and
+    read their list back after each burst.
+    """
+    users = [f'user{i}' for i in range(args.write_threads)]
+    rates, blocked, stale = {}, {}, {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('per call', 'write-behind'):
+            db = DatabaseManager(os.path.join(tmp, f"{mode.replace(' ', '-')}.db"),
+                                 max_connections=args.write_threads)
+            for user in users:
+                db.register_user(user, 'x', f'{user}@example.com')
+            for user, friend in zip(users, users[1:]):
+                db.add_friend(user, friend)
+            writes = WriteBehind(db, args.write_window_ms) if mode == 'write-behind' else None
+
+            def session(user):
+                waits, misses = [], 0
+                for burst in range(0, args.write_calls, args.write_burst):
+                    items = [f'item{n}' for n in range(burst, min(burst + args.write_burst, args.write_calls))]
+                    for item in items:
+                        start = time.perf_counter()
+                        if writes is None:
+                            db.add_grocery_item(user, item, 1, 'kg')
+                        else:
+                            writes.submit('add_grocery_item', user, item, 1, 'kg')
+                        waits.append(time.perf_counter() - start)
+                    if writes is not None:
+                        writes.flush(user)
+                    misses += not set(items) <= {grocery.item for grocery in db.get_grocery_items(user)}
+                return waits, misses
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(args.write_threads) as executor:
+                results = [future.result() for future in [executor.submit(session, user) for user in users]]
+            rates[mode] = args.write_threads * args.write_calls / (time.perf_counter() - start)
+            blocked[mode] = statistics.median(wait for waits, _ in results for wait in waits) * 1000
+            stale[mode] = sum(misses for _, misses in results)
+
+            if writes is not None:
+                # A failed write fails alone
+                failed = writes.submit('update_grocery_item', users[0], -1, 'item0', 1, 'kg')
+                added = writes.submit('add_grocery_item', users[0], 'after failure', 1, 'kg')
+                writes.flush()
+                batches = writes.batches
+                writes.close()
+            counts = [len(db.get_grocery_items(user)) for user in users]
+            diff = db.check_matches()
+            db.close_connection()
+
+    print(f"{args.write_threads} sessions writing {args.write_calls} items in bursts of {args.write_burst}: "
+          f"{rates['per call']:.0f} writes/s committing each, {rates['write-behind']:.0f} writes/s "
+          f"written behind in {batches} batches ({rates['write-behind'] / rates['per call']:.1f}x)")
+    print(f"median time a write blocks its session: {blocked['per call']:.3f} ms committing each, "
+          f"{blocked['write-behind']:.3f} ms written behind")
+    problems = []
+    if counts != [args.write_calls + (user == users[0]) for user in users]:
+        problems.append('writes are missing')
+    if not isinstance(failed.exception(), ValueError) or added.exception() is not None:
+        problems.append('a failed write did not fail alone')
+    if stale['write-behind']:
+        problems.append(f"{stale['write-behind']} reads after flush() missed the session's writes")
+    if diff.missing or diff.unexpected:
+        problems.append('the matches table is out of date')
+    if blocked['write-behind'] * args.min_write_speedup > blocked['per call']:
+        problems.append(f'writes block their session less than {args.min_write_speedup}x shorter')
+    if rates['write-behind'] < rates['per call'] * 0.8:
+        problems.append('write-behind has less than 80% of the per-call throughput')
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    if not problems:
+        print('OK: writes return without waiting for a commit and every read sees its own writes')
+    return not problems
+
+BENCHMARKS = {
+    'bulk_import': bench_bulk_import,
+    'changes': bench_changes,
+    'claims': bench_claims,
+    'export': bench_export,
+    'feeds': bench_feeds,
+    'fuzzy': bench_fuzzy,
+    'instrumentation': bench_instrumentation,
+    'ledger': bench_ledger,
+    'materialized': bench_materialized,
+    'matching': bench_matching,
+    'network': bench_network,
+    'pools': bench_pools,
+    'receipts': bench_receipts,
+    'records': bench_records,
+    'shards': bench_shards,
+    'snapshot': bench_snapshot,
+    'write_behind': bench_write_behind,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f"one of {', '.join(sorted(BENCHMARKS))} (default: all)")
+    parser.add_argument('--max-friends', type=int, default=200)
+    parser.add_argument('--max-items', type=int, default=100)
+    parser.add_argument('--import-rows', type=int, default=100_000)
+    parser.add_argument('--loop-rows', type=int, default=2_000)
+    parser.add_argument('--export-rows', type=int, default=100_000)
+    parser.add_argument('--fuzzy-friends', type=int, default=100, help='friends with 100 items each')
+    parser.add_argument('--fuzzy-budget-ms', type=float, default=50.0)
+    parser.add_argument('--graph-users', type=int, default=100_000)
+    parser.add_argument('--graph-edges', type=int, default=1_000_000, help='rows in friends (two per friendship)')
+    parser.add_argument('--max-hops', type=int, default=3)
+    parser.add_argument('--network-budget-ms', type=float, default=100.0)
+    parser.add_argument('--pool-members', type=int, default=10_000)
+    parser.add_argument('--ledger-purchases', type=int, default=1_000_000)
+    parser.add_argument('--ledger-users', type=int, default=1_000)
+    parser.add_argument('--feed-history', type=int, default=1_000_000)
+    parser.add_argument('--receipts', type=int, default=64, help='synthetic receipt images to read')
+    parser.add_argument('--record-friends', type=int, default=200, help='friends sharing 500 items each')
+    parser.add_argument('--max-instrumentation-overhead', type=float, default=0.25,
+                        help='allowed slowdown of a rerun with instrumentation on, as a fraction')
+    parser.add_argument('--materialized-users', type=int, default=10_000)
+    parser.add_argument('--change-users', type=int, default=10_000)
+    parser.add_argument('--change-log-rows', type=int, default=1_000_000)
+    parser.add_argument('--materialized-writes', type=int, default=2_000)
+    parser.add_argument('--claim-pairs', type=int, default=500, help='friend pairs racing to claim items')
+    parser.add_argument('--claim-threads', type=int, default=8)
+    parser.add_argument('--shard-communities', type=int, default=4)
+    parser.add_argument('--community-users', type=int, default=200)
+    parser.add_argument('--shard-writes', type=int, default=50, help='writes per community while one holds its lock')
+    parser.add_argument('--shard-hold-ms', type=float, default=200.0)
+    parser.add_argument('--min-shard-speedup', type=float, default=5.0,
+                        help="how much sooner the slowest write must finish when the held lock is on another shard")
+    parser.add_argument('--drain-seconds', type=float, default=0.1,
+                        help='wait for writers in other processes while moving a community')
+    parser.add_argument('--write-threads', type=int, default=32, help='sessions writing at once')
+    parser.add_argument('--write-calls', type=int, default=200, help='writes per session')
+    parser.add_argument('--write-burst', type=int, default=10, help='writes between reads of the list')
+    parser.add_argument('--write-window-ms', type=float, default=1.0)
+    parser.add_argument('--min-write-speedup', type=float, default=10.0,
+                        help='how much shorter writes must block their session when written behind')
+    args = parser.parse_args()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmark(s): {', '.join(sorted(unknown))}")
+
+    ok = True
+    for name in args.benchmarks or sorted(BENCHMARKS):
+        print(f'== {name}')
+        ok = BENCHMARKS[name](args) and ok
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""In-process read cache for DatabaseManager with write-driven invalidation.
+
+Every username has a generation counter. Mutating methods bump the
+generations of the users they touch, and each cached read remembers the
+generations of the users its result depends on. A cached value is served
+only while all of those generations are unchanged, so a rerun that changes
+nothing is answered without touching SQLite.
+"""
+import functools
+import threading
+from collections import OrderedDict
+from typing import Callable, Hashable, Iterable, Tuple
+
+
+class QueryCache:
+    def __init__(self, max_entries: int = 1024):
+        """Create an LRU cache holding at most ``max_entries`` results."""
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def bump(self, usernames: Iterable[str]):
+        """Invalidate every cached result that depends on any of ``usernames``."""
+        with self._lock:
+            for username in usernames:
+                self._generations[username] = self._generations.get(username, 0) + 1
+            self._epoch += 1
+
+    def epoch(self) -> int:
+        """Return a counter that changes whenever any generation is bumped."""
+        return self._epoch
+
+    def get(self, key: Hashable) -> Tuple[bool, object]:
+        """Return ``(True, value)`` for a fresh entry, else ``(False, None)``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, generations = entry
+                if all(self._generations.get(user, 0) == generation
+                       for user, generation in generations.items()):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+            return False, None
+
+    def put(self, key: Hashable, value, usernames: Iterable[str], epoch: int):
+        """Cache ``value`` as depending on ``usernames``.
+
+        ``epoch`` is the value of :meth:`epoch` taken before the value was
+        read; if a write happened in between, the value may already be stale
+        and is not cached.
+        """
+        with self._lock:
+            if epoch != self._epoch:
+                return
+            generations = {user: self._generations.get(user, 0) for user in usernames}
+            self._entries[key] = (value, generations)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every cached entry, e.g. after a write that affects all users."""
+        with self._lock:
+            self._entries.clear()
+            self._epoch += 1
+
+
+# Dependency functions take (db, args, result) and return usernames.
+Dependencies = Callable[[object, tuple, object], Iterable[str]]
+
+
+def cached_read(depends_on: Dependencies):
+    """Memoize a DatabaseManager read in ``self.cache``.
+
+    ``depends_on(self, args, result)`` returns the usernames whose writes
+    should invalidate the cached result. Results are shared between callers
+    and must not be mutated. Methods must be called with positional
+    arguments to be cached.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = self.cache
+            if cache is None or kwargs:
+                return method(self, *args, **kwargs)
+
+            key = (method.__name__,) + args
+            hit, value = cache.get(key)
+            if hit:
+                return value
+            epoch = cache.epoch()
+            value = method(self, *args)
+            cache.put(key, value, depends_on(self, args, value), epoch)
+            return value
+        return wrapper
+    return decorator
+
+
+def invalidates(affected: Dependencies):
+    """Bump the generations of ``affected(self, args, result)`` after a write."""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            result = method(self, *args, **kwargs)
+            if self.cache is not None:
+                self.cache.bump(affected(self, args, result))
+            return result
+        return wrapper
+    return decorator
+
+
+def first_user(db, args, result) -> Tuple[str]:
+    return (args[0],)
+
+
+def first_two_users(db, args, result) -> Tuple[str, str]:
+    return (args[0], args[1])
+
+
+def user_and_friends(db, args, result) -> Iterable[str]:
+    return (args[0], *db.get_friends(args[0]))
+
+
+# An added or removed edge can only change a user's extended network when one
+# of its endpoints is already in that network, so depending on every member
+# is enough for add_friend / remove_friend to invalidate it.
+def user_and_network(db, args, result) -> Iterable[str]:
+    return (args[0], *(member for member, _ in result))
+
+
+def user_and_extended_network(db, args, result) -> Iterable[str]:
+    return (args[0], *(member for member, _ in db.get_extended_network(*args)))
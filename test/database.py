@@ -1,332 +1,1247 @@
+import json
 import sqlite3
-from typing import List, Dict
+import sys
+import threading
+import time
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+
+from fuzzy import DEFAULT_THRESHOLD, item_key, item_trigrams
+from cache import (QueryCache, cached_read, first_two_users, first_user, invalidates, user_and_extended_network,
+                   user_and_friends, user_and_network)
+from instrumentation import QueryStats
+from migrations import migrate
+from models import Change, FuzzyMatch, GroceryItem, Match, MatchesDiff, MatchesSnapshot, Page, Purchase
+from pool import ConnectionPool
+from settlement import simplify_debts
+
+# Users within :max_hops friendship edges of :username, at their shortest
+# distance. UNION drops repeated (user, hops) rows, so each level is expanded
+# once per user however many paths lead to it.
+_EXTENDED_NETWORK = '''
+    WITH RECURSIVE network(username, hops) AS (
+        SELECT :username, 0
+        UNION
+        SELECT f.user2, network.hops + 1
+        FROM network
+        JOIN friends f ON f.user1 = network.username
+        WHERE network.hops < :max_hops
+    ),
+    nearest AS (
+        SELECT username, MIN(hops) AS hops FROM network
+        WHERE username != :username
+        GROUP BY username
+    )
+'''
+
+# Rows per page of the keyset-paginated purchase feeds
+PAGE_SIZE = 20
+
+# Most changes returned by one get_changes poll
+CHANGES_LIMIT = 200
+# Item names kept in the change log entry of a batch of grocery items
+CHANGED_ITEMS = 10
+
+# Open pools the user is a member of and someone else is buying, newest
+# first, starting below the :before pool_id
+_ONGOING_PAGE = '''
+    SELECT p.pool_id, p.buyer, p.item
+    FROM pool_members m
+    JOIN purchase_pools p ON p.pool_id = m.pool_id
+    WHERE m.username = :username AND
+        m.is_purchased = 0 AND
+        m.pool_id < :before AND
+        p.buyer IS NOT NULL AND
+        p.buyer != :username
+    ORDER BY m.pool_id DESC
+    LIMIT :limit
+'''
+
+
+# Every friend match recomputed from grocery_lists, in the same columns as
+# the materialized matches table that migration 8's triggers maintain
+_MATCHES_FROM_SCRATCH = '''
+    SELECT f.user1, f.user2, g1.item, g1.id, g1.quantity,
+           g2.base_quantity * g1.quantity / NULLIF(g1.base_quantity, 0), g1.unit
+    FROM friends f
+    JOIN grocery_lists g1 ON g1.username = f.user1
+    JOIN grocery_lists g2 ON g2.rowid = (
+        SELECT MIN(rowid) FROM grocery_lists
+        WHERE username = f.user2 AND item = g1.item AND dimension = g1.dimension
+    )
+'''
+_MATCHES_COLUMNS = 'username, friend, item, grocery_id, user_quantity, friend_quantity, unit'
+# Item names in the :items JSON array
+_IN_ITEMS = 'IN (SELECT value FROM json_each(:items))'
+
+
+def _record(record):
+    """Row factory that builds ``record`` NamedTuples straight from result rows."""
+    return lambda cursor, row: record._make(row)
+
+
+def _matches_by_friend(rows: Iterable[tuple]) -> Dict[str, List[Match]]:
+    """Group (friend, item, user_quantity, friend_quantity, unit) rows into Match records by friend."""
+    matches = {}
+    # The user's item names and units repeat for every friend; keep one copy of each
+    names = {}
+    for friend, item, user_quantity, friend_quantity, unit in rows:
+        matches.setdefault(friend, []).append(
+            Match(names.setdefault(item, item), user_quantity, friend_quantity, names.setdefault(unit, unit)))
+    return matches
+
+
+def _cursor(before: Optional[int]) -> int:
+    """Keyset bound for a page: pool ids below ``before``, or all of them for the first page."""
+    return before if before is not None else sys.maxsize
 
 class DatabaseManager:
-    def __init__(self, db_path: str = 'grocery_share.db'):
-        """Initialize database connection"""
+    def __init__(self, db_path: str = 'grocery_share.db', max_connections: int = 8, cache_size: int = 0,
+                 stats: Optional[QueryStats] = None):
+        """Initialize the database connection pool.
+
+        A positive ``cache_size`` memoizes per-user reads in an LRU cache that
+        this manager's own writes invalidate. When other processes write the
+        same database, call sync_cache regularly to pick up their changes.
+        ``stats`` records
+        every statement's latency and rows (see instrumentation.py); cache
+        hits run no statements and are not recorded.
+        """
+        self.cache = QueryCache(cache_size) if cache_size > 0 else None
+        self.stats = stats
+        self._key_ids = {}
+        # The change_log seq up to which other writers' changes are reflected in the cache
+        self._synced_seq = 0
+        self._synced_at = float('-inf')
+        self._sync_lock = threading.Lock()
         try:
-            self.conn = sqlite3.connect(db_path, check_same_thread=False)
+            self.pool = ConnectionPool(db_path, max_connections=max_connections, stats=stats)
             self.create_tables()
-            self.cursor = self.conn.cursor()
+            self._synced_seq = self.get_change_seq()
         except Exception as e:
             print(e)
-            self.conn = None
-            self.cursor = None
+            self.pool = None
 
     def create_tables(self):
-        """Create necessary database tables if they don't exist."""
-        cursor = self.conn.cursor()
-        
-        # Users table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                username TEXT PRIMARY KEY,
-                password TEXT NOT NULL,
-                email TEXT UNIQUE
-            )
-        ''')
-        
-        # Friends table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS friends (
-                user1 TEXT,
-                user2 TEXT,
-                FOREIGN KEY(user1) REFERENCES users(username),
-                FOREIGN KEY(user2) REFERENCES users(username),
-                PRIMARY KEY(user1, user2)
-            )
-        ''')
-        
-        # Grocery lists table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS grocery_lists (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT,
-                item TEXT,
-                quantity REAL,
-                unit TEXT,
-                FOREIGN KEY(username) REFERENCES users(username)
-            )
-        ''')
-
-        # Purchase tracking table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS purchase_tracking (
-                match_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                item TEXT,
-                buyer TEXT,
-                total_price REAL,
-                is_purchased BOOLEAN DEFAULT 0,
-                user1 TEXT,
-                user2 TEXT,
-                user1_share REAL,
-                user2_share REAL,
-                FOREIGN KEY(user1) REFERENCES users(username),
-                FOREIGN KEY(user2) REFERENCES users(username)
-            )
-        ''')
-
-        self.conn.commit()
+        """Create or upgrade the database tables to the current schema version."""
+        with self.pool.connection() as conn:
+            migrate(conn)
 
     def register_user(self, username: str, hashed_password: str, email: str) -> bool:
         """Register a new user."""
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
-                           (username, hashed_password, email))
-            self.conn.commit()
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                               (username, hashed_password, email))
+                self._log_change(cursor, 'user_registered', [username])
             return True
         except sqlite3.IntegrityError:
             return False
 
     def login_user(self, username: str, hashed_password: str) -> bool:
         """Authenticate user login."""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?',
-                       (username, hashed_password))
-        return cursor.fetchone() is not None
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT * FROM users WHERE username = ? AND password = ?',
+                           (username, hashed_password))
+            return cursor.fetchone() is not None
+
+    def user_exists(self, username: str) -> bool:
+        """Return whether a user is registered under ``username``."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM users WHERE username = ?', (username,))
+            return cursor.fetchone() is not None
+
+    @staticmethod
+    def _log_change(cursor: sqlite3.Cursor, kind: str, usernames: Iterable[Optional[str]], **data):
+        """Append a ``kind`` change to the change log for each of ``usernames``.
+
+        Call it inside the transaction that makes the change. A username of
+        None records a change that affects every user.
+        """
+        payload = json.dumps(data)
+        cursor.executemany('INSERT INTO change_log (username, kind, data) VALUES (?, ?, ?)',
+                           [(username, kind, payload) for username in usernames])
+
+    def get_change_seq(self) -> int:
+        """Return the ``seq`` of the latest change, to start polling get_changes from."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log')
+            return cursor.fetchone()[0]
+
+    def sync_cache(self, max_age: float = 0.0):
+        """Invalidate cached reads that changes logged by other writers have made stale.
+
+        The cache only sees this manager's own writes. When the API or
+        another process writes the same database, call this periodically:
+        every user with a newer change_log entry is invalidated, and a change
+        for everyone clears the cache. The change log is not read again until
+        ``max_age`` seconds after the last sync, so callers on a hot path can
+        call this for every request and reads lag other writers by at most
+        that long.
+        """
+        if self.cache is None or time.monotonic() - self._synced_at < max_age:
+            return
+        # Another thread is already syncing
+        if not self._sync_lock.acquire(blocking=False):
+            return
+        try:
+            self._synced_at = time.monotonic()
+            with self.pool.connection() as conn:
+                rows = conn.execute('SELECT username, MAX(seq) FROM change_log WHERE seq > ? GROUP BY username',
+                                    (self._synced_seq,)).fetchall()
+            if not rows:
+                return
+            usernames = {username for username, _ in rows}
+            if None in usernames:
+                self.cache.clear()
+            else:
+                self.cache.bump(usernames)
+            self._synced_seq = max(seq for _, seq in rows)
+        finally:
+            self._sync_lock.release()
 
+    def get_changes(self, username: str, since: int, limit: int = CHANGES_LIMIT) -> List[Change]:
+        """Return the changes after ``since`` that affect what ``username`` sees, oldest first.
+
+        That is changes to the user's own data, to their friends' data and to
+        everyone's. Pass the last ``seq`` returned as the next ``since``; a
+        full page of ``limit`` changes means more may be waiting.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = lambda cursor, row: Change(row[0], row[1], row[2], json.loads(row[3]))
+            cursor.execute('''
+                SELECT seq, username, kind, data FROM change_log
+                WHERE username IN (SELECT user2 FROM friends WHERE user1 = :username) AND seq > :since
+                UNION ALL
+                SELECT seq, username, kind, data FROM change_log
+                WHERE username = :username AND seq > :since
+                UNION ALL
+                SELECT seq, username, kind, data FROM change_log
+                WHERE username IS NULL AND seq > :since
+                ORDER BY seq
+                LIMIT :limit
+            ''', {'username': username, 'since': since, 'limit': limit})
+            return cursor.fetchall()
+
+    @invalidates(first_two_users)
     def add_friend(self, current_user: str, friend_username: str) -> bool:
         """Add a friend connection between two users."""
-        cursor = self.conn.cursor()
         try:
-            cursor.execute('INSERT INTO friends (user1, user2) VALUES (?, ?)',
-                           (current_user, friend_username))
-            cursor.execute('INSERT INTO friends (user1, user2) VALUES (?, ?)',
-                           (friend_username, current_user))
-            self.conn.commit()
+            with self.pool.transaction() as conn:
+                cursor = conn.cursor()
+                cursor.execute('INSERT INTO friends (user1, user2) VALUES (?, ?)',
+                               (current_user, friend_username))
+                cursor.execute('INSERT INTO friends (user1, user2) VALUES (?, ?)',
+                               (friend_username, current_user))
+                self._log_change(cursor, 'friend_added', [current_user], friend=friend_username)
+                self._log_change(cursor, 'friend_added', [friend_username], friend=current_user)
             return True
         except sqlite3.IntegrityError:
             return False
 
+    @cached_read(first_user)
     def get_friends(self, username: str) -> List[str]:
         """Retrieve list of friends for a user."""
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT user2 FROM friends WHERE user1 = ?', (username,))
-        return [friend[0] for friend in cursor.fetchall()]
-
-    def add_grocery_item(self, username: str, item: str, quantity: float, unit: str):
-        """Add an item to user's grocery list."""
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT INTO grocery_lists (username, item, quantity, unit) VALUES (?, ?, ?, ?)',
-                       (username, item, quantity, unit))
-        self.conn.commit()
-
-    def find_matching_groceries(self, username: str) -> Dict[str, List[Dict]]:
-        """Find matching grocery items among friends."""
-        friends = self.get_friends(username)
-        cursor = self.conn.cursor()
-
-        # Get current user's grocery items
-        cursor.execute('SELECT item, quantity, unit FROM grocery_lists WHERE username = ?', (username,))
-        user_items = cursor.fetchall()
-
-        matching_items = {}
-        for friend in friends:
-            friend_matches = []
-            for item, quantity, unit in user_items:
-                # Check if friend has same item
-                cursor.execute('''
-                    SELECT username, quantity, unit 
-                    FROM grocery_lists 
-                    WHERE username = ? AND item = ?
-                ''', (friend, item))
-                friend_item = cursor.fetchone()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT user2 FROM friends WHERE user1 = ?', (username,))
+            return [friend[0] for friend in cursor.fetchall()]
+
+    @cached_read(user_and_network)
+    def get_extended_network(self, username: str, max_hops: int = 2) -> List[Tuple[str, int]]:
+        """Return (user, hops) for everyone within ``max_hops`` friendship edges.
+
+        Direct friends are at 1 hop, friends of friends at 2 and so on; users
+        are ordered by distance, then name.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_EXTENDED_NETWORK + 'SELECT username, hops FROM nearest ORDER BY hops, username',
+                           {'username': username, 'max_hops': max_hops})
+            return cursor.fetchall()
+
+    @cached_read(user_and_extended_network)
+    def find_network_matches(self, username: str, max_hops: int = 2) -> List[Dict]:
+        """Rank users within ``max_hops`` edges by distance and shared items.
+
+        Returns one entry per user with at least one matching item, nearest
+        first and then by the number of shared items. Each entry has
+        ``username``, ``hops``, ``overlap`` and ``items`` shaped like
+        find_matching_groceries.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(_EXTENDED_NETWORK + '''
+                SELECT nearest.username, nearest.hops, g1.item, g1.quantity,
+                       g2.base_quantity * g1.quantity / NULLIF(g1.base_quantity, 0), g1.unit
+                FROM nearest
+                JOIN grocery_lists g1 ON g1.username = :username
+                JOIN grocery_lists g2 ON g2.rowid = (
+                    SELECT MIN(rowid) FROM grocery_lists
+                    WHERE username = nearest.username AND item = g1.item AND dimension = g1.dimension
+                )
+            ''', {'username': username, 'max_hops': max_hops})
+            rows = cursor.fetchall()
+
+        candidates = {}
+        for member, hops, item, quantity, member_quantity, unit in rows:
+            candidate = candidates.setdefault(member, {'username': member, 'hops': hops, 'items': []})
+            candidate['items'].append(Match(item, quantity, member_quantity, unit))
+        for candidate in candidates.values():
+            candidate['overlap'] = len(candidate['items'])
+        return sorted(candidates.values(), key=lambda c: (c['hops'], -c['overlap'], c['username']))
+
+    @invalidates(first_user)
+    def add_grocery_item(self, username: str, item: str, quantity: float, unit: str) -> int:
+        """Add an item to user's grocery list and return the id of its row.
+
+        If the user already lists the item in the same unit, the quantity is
+        added to that row.
+        """
+        with self.pool.transaction() as conn:
+            key_id = self._item_key_ids([item])[item]
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO grocery_lists (username, item, quantity, unit, item_key_id) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (username, item, unit) DO UPDATE SET quantity = quantity + excluded.quantity
+                RETURNING id
+            ''', (username, item, quantity, unit, key_id))
+            grocery_id = cursor.fetchone()[0]
+            self._log_change(cursor, 'grocery_added', [username],
+                             id=grocery_id, item=item, quantity=quantity, unit=unit)
+        return grocery_id
+
+    @invalidates(first_user)
+    def add_grocery_items(self, username: str,
+                          items: Iterable[Tuple[str, float, str]]) -> List[Tuple[int, str]]:
+        """Add many items to a user's grocery list in a single transaction.
+
+        Rows are written with one ``executemany``. If the batch is rejected,
+        it is retried row by row inside savepoints so that one bad row does not
+        abort the rest. Returns ``(index, error)`` for every row that failed.
+        Items the user already lists in the same unit, including repeats
+        within the batch, are added to the existing row's quantity.
+        """
+        items = list(items)
+        key_ids = self._item_key_ids(item for item, _, _ in items)
+        # Merged rows get the base_quantity grocery_lists_canonical_update would
+        # compute, so its UPDATE changes nothing and matches are refreshed once
+        query = '''
+            INSERT INTO grocery_lists (username, item, quantity, unit, dimension, base_quantity, item_key_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (username, item, unit) DO UPDATE
+            SET quantity = quantity + excluded.quantity, base_quantity = base_quantity + excluded.base_quantity
+        '''
+        try:
+            with self.pool.transaction() as conn:
+                self._begin_bulk_load(conn, username)
+                conn.executemany(query, self._canonical_rows(conn, username, items, key_ids))
+                self._end_bulk_load(conn, username, items)
+                if items:
+                    self._log_change(conn.cursor(), 'groceries_added', [username], count=len(items),
+                                     items=[item for item, _, _ in items[:CHANGED_ITEMS]])
+            return []
+        except sqlite3.IntegrityError:
+            pass
 
-                if friend_item:
-                    friend_matches.append({
-                        'item': item,
-                        'user_quantity': quantity,
-                        'friend_quantity': friend_item[1],
-                        'unit': unit
-                    })
+        errors = []
+        with self.pool.transaction() as conn:
+            self._begin_bulk_load(conn, username)
+            for index, row in enumerate(self._canonical_rows(conn, username, items, key_ids)):
+                try:
+                    with self.pool.transaction():
+                        conn.execute(query, row)
+                except sqlite3.IntegrityError as e:
+                    errors.append((index, str(e)))
+            self._end_bulk_load(conn, username, items)
+            if len(errors) < len(items):
+                failed = {index for index, _ in errors}
+                added = [item for index, (item, _, _) in enumerate(items) if index not in failed]
+                self._log_change(conn.cursor(), 'groceries_added', [username], count=len(added),
+                                 items=added[:CHANGED_ITEMS])
+        return errors
 
-            if friend_matches:
-                matching_items[friend] = friend_matches
+    @staticmethod
+    def _begin_bulk_load(conn: sqlite3.Connection, username: str):
+        """Skip the per-row canonical and matches triggers for ``username`` until _end_bulk_load.
 
-        return matching_items
+        The rows written meanwhile must carry their canonical columns.
+        """
+        conn.execute('INSERT INTO bulk_loads (username) VALUES (?)', (username,))
+
+    @staticmethod
+    def _end_bulk_load(conn: sqlite3.Connection, username: str, items: List[Tuple[str, float, str]]):
+        """Turn the triggers back on and refresh the matches of every item written, both ways, at once."""
+        conn.execute('DELETE FROM bulk_loads WHERE username = ?', (username,))
+        params = {'username': username, 'items': json.dumps(list({item for item, _, _ in items}))}
+        conn.execute(f'DELETE FROM matches WHERE username = :username AND item {_IN_ITEMS}', params)
+        conn.execute(f'''
+            INSERT INTO matches ({_MATCHES_COLUMNS}) {_MATCHES_FROM_SCRATCH}
+            WHERE f.user1 = :username AND g1.item {_IN_ITEMS}
+        ''', params)
+        conn.execute(f'''
+            DELETE FROM matches
+            WHERE username IN (SELECT user1 FROM friends WHERE user2 = :username) AND
+                friend = :username AND item {_IN_ITEMS}
+        ''', params)
+        conn.execute(f'''
+            INSERT INTO matches ({_MATCHES_COLUMNS}) {_MATCHES_FROM_SCRATCH}
+            WHERE f.user2 = :username AND g1.item {_IN_ITEMS}
+        ''', params)
+
+    def _item_key_ids(self, items: Iterable[str]) -> Dict[str, int]:
+        """Map item names to their item_keys ids, indexing keys not seen before.
+
+        Keys are never deleted, so ids are remembered for the life of this
+        manager once they are committed. Called outside a transaction, new
+        keys are committed on their own before the caller writes its rows; an
+        orphaned key is harmless.
+        """
+        items = set(items)
+        missing = items - self._key_ids.keys()
+        if missing:
+            keys = {item: item_key(str(item)) for item in missing}
+            distinct = set(keys.values())
+            # Inside a caller's transaction the new keys may still be rolled back
+            nested = self.pool.in_transaction()
+            with self.pool.transaction() as conn:
+                key_ids = dict(conn.execute(
+                    'SELECT key, key_id FROM item_keys WHERE key IN (SELECT value FROM json_each(?))',
+                    (json.dumps(list(distinct)),)))
+                postings = []
+                for key in distinct - key_ids.keys():
+                    trigrams = item_trigrams(key)
+                    key_ids[key] = conn.execute('INSERT INTO item_keys (key, trigram_count) VALUES (?, ?)',
+                                                (key, len(trigrams))).lastrowid
+                    postings.extend((trigram, key_ids[key]) for trigram in trigrams)
+                conn.executemany('INSERT INTO key_trigrams (trigram, key_id) VALUES (?, ?)', postings)
+            found = {item: key_ids[key] for item, key in keys.items()}
+            if nested:
+                return {**{item: self._key_ids[item] for item in items - missing}, **found}
+            if len(self._key_ids) > 100_000:
+                self._key_ids.clear()
+            self._key_ids.update(found)
+        return {item: self._key_ids[item] for item in items}
+
+    @staticmethod
+    def _canonical_rows(conn: sqlite3.Connection, username: str,
+                        items: List[Tuple[str, float, str]], key_ids: Dict[str, int]) -> List[tuple]:
+        """Compute dimension, base_quantity and item_key_id in Python for a batch insert.
+
+        Mirrors the grocery_lists_canonical_insert trigger, which would
+        otherwise rewrite every freshly inserted row and its index entries.
+        """
+        conversions = {(unit, item): (dimension, factor) for item, unit, dimension, factor
+                       in conn.execute('SELECT item, unit, dimension, factor FROM unit_conversions')}
+        rows = []
+        for item, quantity, unit in items:
+            dimension, factor = (conversions.get((unit, str(item).lower()))
+                                 or conversions.get((unit, ''))
+                                 or (unit, 1.0))
+            rows.append((username, item, quantity, unit, dimension, quantity * factor, key_ids[item]))
+        return rows
+
+    @cached_read(user_and_friends)
+    def find_matching_groceries(self, username: str) -> Dict[str, List[Match]]:
+        """Find matching grocery items among friends.
+
+        Matches for every friend are one range of the materialized
+        ``matches`` table (see iter_matches).
+        """
+        return _matches_by_friend(self.iter_matches(username))
+
+    def _iter_rows(self, query: str, params: tuple, batch_size: int, record=None) -> Iterator[tuple]:
+        """Stream the rows of ``query`` in ``fetchmany`` batches of ``batch_size``.
+
+        Rows are built as ``record`` NamedTuples when one is given.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            if record is not None:
+                cursor.row_factory = _record(record)
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield from rows
+
+    def iter_grocery_items(self, username: str, batch_size: int = 500) -> Iterator[GroceryItem]:
+        """Stream the items of a user's grocery list."""
+        return self._iter_rows('SELECT item, quantity, unit, id FROM grocery_lists WHERE username = ?',
+                               (username,), batch_size, GroceryItem)
+
+    def iter_matches(self, username: str, batch_size: int = 500) -> Iterator[tuple]:
+        """Stream (friend, item, user_quantity, friend_quantity, unit) match rows.
+
+        Items match when they measure the same dimension, and the friend's
+        quantity is converted into the user's unit. When a friend lists the
+        same item more than once, their earliest row is used. Rows are read
+        from the materialized ``matches`` table, by friend and then item.
+        """
+        return self._iter_rows('''
+            SELECT friend, item, user_quantity, friend_quantity, unit
+            FROM matches
+            WHERE username = ?
+            ORDER BY friend, item, grocery_id
+        ''', (username,), batch_size)
+
+    def iter_purchase_history(self, username: str, batch_size: int = 500) -> Iterator[tuple]:
+        """Stream every pool the user is a member of, oldest first."""
+        # Open and settled pools are separate ranges of the member index;
+        # ORDER BY on the compound merges them without sorting the history
+        return self._iter_rows('''
+            SELECT m.pool_id, p.item, p.buyer, p.total_price, p.is_purchased,
+                   p.member_count, m.quantity, m.share
+            FROM pool_members m
+            JOIN purchase_pools p ON p.pool_id = m.pool_id
+            WHERE m.username = ? AND m.is_purchased = 0
+            UNION ALL
+            SELECT m.pool_id, p.item, p.buyer, p.total_price, p.is_purchased,
+                   p.member_count, m.quantity, m.share
+            FROM pool_members m
+            JOIN purchase_pools p ON p.pool_id = m.pool_id
+            WHERE m.username = ? AND m.is_purchased = 1
+            ORDER BY 1
+        ''', (username, username), batch_size)
+
+    def iter_open_pools(self, buyer: str, batch_size: int = 500) -> Iterator[Tuple[int, str]]:
+        """Stream (pool_id, item) for every unsettled pool a user is buying."""
+        return self._iter_rows('''
+            SELECT pool_id, item FROM purchase_pools
+            WHERE buyer = ? AND is_purchased = 0
+            ORDER BY pool_id
+        ''', (buyer,), batch_size)
+
+    def _page(self, query: str, params: dict, limit: int) -> Page:
+        """Run a keyset query ordered by ``pool_id DESC`` and return one page of it.
+
+        ``query`` selects ``pool_id`` first and takes ``:before`` and
+        ``:limit`` parameters; one extra row is fetched to tell whether
+        another page follows.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(query, {**params, 'limit': limit + 1})
+            rows = cursor.fetchall()
+        if len(rows) > limit:
+            return Page(rows[:limit], rows[limit - 1][0])
+        return Page(rows, None)
+
+    @cached_read(first_user)
+    def get_purchase_history_page(self, username: str, before: Optional[int] = None,
+                                  limit: int = PAGE_SIZE) -> Page:
+        """Return one page of a user's settled purchases, newest first.
+
+        Rows are (pool_id, item, buyer, total_price, share, member_count).
+        Pass the returned ``next_cursor`` as ``before`` for the next page.
+        """
+        return self._page('''
+            SELECT p.pool_id, p.item, p.buyer, p.total_price, m.share, p.member_count
+            FROM pool_members m
+            JOIN purchase_pools p ON p.pool_id = m.pool_id
+            WHERE m.username = :username AND m.is_purchased = 1 AND m.pool_id < :before
+            ORDER BY m.pool_id DESC
+            LIMIT :limit
+        ''', {'username': username, 'before': _cursor(before)}, limit)
+
+    @cached_read(first_user)
+    def get_ongoing_purchases_page(self, username: str, before: Optional[int] = None,
+                                   limit: int = PAGE_SIZE) -> Page:
+        """Return one page of the open pools a friend is buying for the user, newest first.
+
+        Rows are (pool_id, buyer, item).
+        """
+        return self._page(_ONGOING_PAGE, {'username': username, 'before': _cursor(before)}, limit)
+
+    def get_open_pools_page(self, buyer: str, before: Optional[int] = None,
+                            limit: int = PAGE_SIZE) -> Page:
+        """Return one page of the unsettled pools a user is buying, newest first.
+
+        Rows are (pool_id, item, member_count).
+        """
+        return self._page('''
+            SELECT pool_id, item, member_count FROM purchase_pools
+            WHERE buyer = :buyer AND is_purchased = 0 AND pool_id < :before
+            ORDER BY pool_id DESC
+            LIMIT :limit
+        ''', {'buyer': buyer, 'before': _cursor(before)}, limit)
+
+    @cached_read(lambda db, args, units: ())
+    def get_units(self) -> List[str]:
+        """Return every unit with a known conversion, built-in units first."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT unit FROM unit_conversions
+                GROUP BY unit
+                ORDER BY MIN(rowid)
+            ''')
+            return [unit[0] for unit in cursor.fetchall()]
+
+    def add_unit_conversion(self, unit: str, amount: float, base_unit: str, item: str = ''):
+        """Define ``1 unit = amount base_unit``, optionally for one item only.
+
+        For example ``add_unit_conversion('pack', 12, 'pieces', 'eggs')`` lets
+        a pack of eggs match eggs listed in pieces. Existing grocery rows in
+        that unit are re-canonicalized in the same transaction.
+
+        Conversions are shared by every user, so one that exists is never
+        replaced, and a unit that already converts on its own (kg, lbs,
+        pieces, or a custom unit such as dozen) cannot be redefined for one
+        item; both raise ValueError. Repeating an existing conversion does
+        nothing.
+        """
+        item = item.strip().lower()
+        unit = unit.strip()
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT dimension, factor FROM unit_conversions
+                WHERE unit = ? AND item IN ('', ?)
+                ORDER BY item DESC LIMIT 1
+            ''', (base_unit, item))
+            base = cursor.fetchone()
+            if not base:
+                raise ValueError(f"Unknown unit: {base_unit}")
+            dimension, factor = base
+
+            cursor.execute("SELECT item, dimension, factor FROM unit_conversions WHERE unit = ? AND item IN ('', ?)",
+                           (unit, item))
+            existing = {row[0]: row[1:] for row in cursor.fetchall()}
+            if item in existing:
+                if existing[item] == (dimension, amount * factor):
+                    return
+                scope = f' of {item}' if item else ''
+                raise ValueError(f"1 {unit}{scope} is already defined")
+            # Built-in placeholders such as pack only match themselves until given a conversion per item
+            if item and '' in existing and existing[''][0] != unit:
+                raise ValueError(f"{unit} already has a conversion and cannot be redefined for {item}")
+
+            cursor.execute('''
+                INSERT INTO unit_conversions (item, unit, dimension, factor) VALUES (?, ?, ?, ?)
+            ''', (item, unit, dimension, amount * factor))
+            # Fires grocery_lists_canonical_update for every affected row
+            if item:
+                cursor.execute('UPDATE grocery_lists SET unit = unit WHERE unit = ? AND lower(item) = ?',
+                               (unit, item))
+            else:
+                cursor.execute('UPDATE grocery_lists SET unit = unit WHERE unit = ?', (unit,))
+            self._log_change(cursor, 'unit_conversion_added', [None],
+                             unit=unit, amount=amount, base_unit=base_unit, item=item)
+
+        if self.cache is not None:
+            self.cache.clear()
 
     def close_connection(self):
-        """Close database connection."""
-        self.conn.close()
+        """Close every pooled database connection."""
+        self.pool.close()
 
+    @invalidates(first_two_users)
     def remove_friend(self, username, friend_username):
         """Remove a friend connection between two users."""
-        cursor = self.conn.cursor()
-        query = "DELETE FROM friends WHERE user1 = ? AND user2 = ?"
-        cursor.execute(query, (username, friend_username))
-        self.conn.commit()
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            query = "DELETE FROM friends WHERE user1 = ? AND user2 = ?"
+            cursor.execute(query, (username, friend_username))
+            if cursor.rowcount:
+                self._log_change(cursor, 'friend_removed', [username], friend=friend_username)
         return True
 
-    def get_grocery_items(self, username):
+    @cached_read(first_user)
+    def get_grocery_items(self, username) -> List[GroceryItem]:
         """Retrieve grocery list for a user."""
-        query = "SELECT item, quantity, unit FROM grocery_lists WHERE username = ?"
-        self.cursor.execute(query, (username,))
-        return self.cursor.fetchall()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _record(GroceryItem)
+            query = "SELECT item, quantity, unit, id FROM grocery_lists WHERE username = ?"
+            cursor.execute(query, (username,))
+            return cursor.fetchall()
+
+    @invalidates(first_user)
+    def update_grocery_item(self, username: str, grocery_id: int, item: str, quantity: float, unit: str) -> int:
+        """Change a row of the user's grocery list in place; return the id of the row now holding the item.
+
+        The row keeps its id, and its canonical quantity and item key are
+        recomputed. If the user already lists ``item`` in ``unit`` in another
+        row, the quantity is added to that row and this one is removed, as
+        adding the item would. Raises ValueError if the row is not on the
+        user's list.
+        """
+        with self.pool.transaction() as conn:
+            key_id = self._item_key_ids([item])[item]
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1 FROM grocery_lists WHERE id = ? AND username = ?', (grocery_id, username))
+            if not cursor.fetchone():
+                raise ValueError("Invalid grocery item ID")
+            cursor.execute('''
+                SELECT id FROM grocery_lists WHERE username = ? AND item = ? AND unit = ? AND id != ?
+            ''', (username, item, unit, grocery_id))
+            existing = cursor.fetchone()
+            if existing:
+                cursor.execute('DELETE FROM grocery_lists WHERE id = ?', (grocery_id,))
+                grocery_id = existing[0]
+                cursor.execute('UPDATE grocery_lists SET quantity = quantity + ? WHERE id = ?',
+                               (quantity, grocery_id))
+            else:
+                # grocery_lists_canonical_update recomputes dimension and base_quantity
+                cursor.execute('''
+                    UPDATE grocery_lists SET item = ?, quantity = ?, unit = ?, item_key_id = ? WHERE id = ?
+                ''', (item, quantity, unit, key_id, grocery_id))
+            self._log_change(cursor, 'grocery_updated', [username],
+                             id=grocery_id, item=item, quantity=quantity, unit=unit)
+        return grocery_id
+
+    @invalidates(first_user)
+    def remove_grocery_item_by_id(self, username: str, grocery_id: int) -> bool:
+        """Remove one row of the user's grocery list; return whether it was there."""
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM grocery_lists WHERE id = ? AND username = ? RETURNING item',
+                           (grocery_id, username))
+            row = cursor.fetchone()
+            if row:
+                self._log_change(cursor, 'grocery_removed', [username], id=grocery_id, item=row[0])
+        return row is not None
 
+    @invalidates(first_user)
     def remove_grocery_item(self, username, item):
-        """Remove an item from the user's grocery list."""
-        query = "DELETE FROM grocery_lists WHERE username = ? AND item = ?"
-        self.cursor.execute(query, (username, item))
-        self.conn.commit()
+        """Remove an item from the user's grocery list, in every unit it is listed in."""
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            query = "DELETE FROM grocery_lists WHERE username = ? AND item = ?"
+            cursor.execute(query, (username, item))
+            if cursor.rowcount:
+                self._log_change(cursor, 'grocery_removed', [username], item=item)
 
-    def track_matched_item_purchase(self, item, user1, user2, buyer=None):
-        """Track a matched item for potential purchase."""
-        cursor = self.conn.cursor()
-        
-        # First, check if this match already exists
-        cursor.execute('''
-            SELECT match_id FROM purchase_tracking 
-            WHERE item = ? AND 
-            ((user1 = ? AND user2 = ?) OR (user1 = ? AND user2 = ?))
-        ''', (item, user1, user2, user2, user1))
-        
-        existing_match = cursor.fetchone()
-        if existing_match:
-            # Update existing match
-            match_id = existing_match[0]
+    @invalidates(lambda db, args, pool_id: tuple(args[1:2]))
+    def create_pool(self, item: str, buyer: str = None) -> int:
+        """Open a purchase pool for an item and return its pool_id.
+
+        A buyer has at most one open pool per item; if they already have one
+        its pool_id is returned instead.
+        """
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                INSERT INTO purchase_pools (item, buyer) VALUES (?, ?)
+                ON CONFLICT (item, COALESCE(buyer, '')) WHERE is_purchased = 0 DO NOTHING
+                RETURNING pool_id
+            ''', (item, buyer))
+            created = cursor.fetchone()
+            if not created:
+                cursor.execute('''
+                    SELECT pool_id FROM purchase_pools
+                    WHERE item = ? AND COALESCE(buyer, '') = COALESCE(?, '') AND is_purchased = 0
+                ''', (item, buyer))
+                return cursor.fetchone()[0]
+            pool_id = created[0]
+            # A pool without a buyer is open to everyone
+            self._log_change(cursor, 'pool_opened', [buyer], pool_id=pool_id, item=item)
+            return pool_id
+
+    @invalidates(lambda db, args, result: (args[1],))
+    def join_pool(self, pool_id: int, username: str, quantity: float = None):
+        """Add a member to an open pool, or update their quantity if already a member.
+
+        ``quantity`` is in the item's base unit (grams, pieces, ...). When it
+        is omitted the member's own grocery list quantity of the item is used.
+        """
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            item = self._open_pool_item(cursor, pool_id)
+            if quantity is None:
+                cursor.execute('''
+                    SELECT COALESCE(SUM(base_quantity), 0) FROM grocery_lists
+                    WHERE username = ? AND item = ?
+                ''', (username, item))
+                quantity = cursor.fetchone()[0]
+            # Triggers keep purchase_pools.total_quantity and member_count current
+            cursor.execute('''
+                INSERT INTO pool_members (pool_id, username, quantity) VALUES (?, ?, ?)
+                ON CONFLICT (pool_id, username) DO UPDATE SET quantity = excluded.quantity
+            ''', (pool_id, username, quantity))
+            self._log_change(cursor, 'pool_joined', [username], pool_id=pool_id, item=item, quantity=quantity)
+
+    @invalidates(lambda db, args, result: (args[1],))
+    def leave_pool(self, pool_id: int, username: str):
+        """Remove a member from an open pool."""
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            item = self._open_pool_item(cursor, pool_id)
+            cursor.execute('DELETE FROM pool_members WHERE pool_id = ? AND username = ?',
+                           (pool_id, username))
+            if cursor.rowcount:
+                self._log_change(cursor, 'pool_left', [username], pool_id=pool_id, item=item)
+
+    @staticmethod
+    def _open_pool_item(cursor: sqlite3.Cursor, pool_id: int) -> str:
+        """Return the item of an open pool, raising ValueError if it is missing or settled."""
+        cursor.execute('SELECT item, is_purchased FROM purchase_pools WHERE pool_id = ?', (pool_id,))
+        pool = cursor.fetchone()
+        if not pool:
+            raise ValueError("Invalid pool ID")
+        if pool[1]:
+            raise ValueError("Pool is already settled")
+        return pool[0]
+
+    @invalidates(lambda db, args, purchase: (*filter(None, (purchase.buyer,)), *purchase.shares))
+    def settle_pool(self, pool_id: int, total_price: float) -> Purchase:
+        """Record the price of a pool's purchase and split it between its members.
+
+        Each member pays in proportion to their quantity; if no quantities
+        were recorded the price is split equally. A single UPDATE writes
+        every member's share and a single upsert adds it to their balance
+        with the buyer, so settling is linear in the pool size.
+        """
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT item, buyer, total_quantity, member_count, is_purchased
+                FROM purchase_pools WHERE pool_id = ?
+            ''', (pool_id,))
+            pool = cursor.fetchone()
+            if not pool:
+                raise ValueError("Invalid pool ID")
+            item, buyer, total_quantity, member_count, is_purchased = pool
+            if is_purchased:
+                raise ValueError("Pool is already settled")
+            if not member_count:
+                raise ValueError("Pool has no members")
+
+            total_price = float(total_price)
+            cursor.execute('''
+                UPDATE purchase_pools SET is_purchased = 1, total_price = ? WHERE pool_id = ?
+            ''', (total_price, pool_id))
+            cursor.execute('''
+                UPDATE pool_members
+                SET share = CASE WHEN :total_quantity > 0
+                                 THEN :total_price * quantity / :total_quantity
+                                 ELSE :total_price / :member_count END
+                WHERE pool_id = :pool_id
+                RETURNING username, share
+            ''', {'total_price': total_price, 'total_quantity': total_quantity,
+                  'member_count': member_count, 'pool_id': pool_id})
+            shares = dict(cursor.fetchall())
+
+            # Every other member now owes the buyer their share
+            cursor.execute('''
+                INSERT INTO balances (user1, user2, amount)
+                SELECT MIN(username, :buyer), MAX(username, :buyer),
+                       CASE WHEN username < :buyer THEN share ELSE -share END
+                FROM pool_members
+                WHERE pool_id = :pool_id AND username != :buyer
+                ON CONFLICT (user1, user2) DO UPDATE SET amount = amount + excluded.amount
+            ''', {'buyer': buyer, 'pool_id': pool_id})
+            # One change for every member and the buyer, however large the pool
             cursor.execute('''
-                UPDATE purchase_tracking 
-                SET buyer = ?, is_purchased = 0, total_price = NULL 
-                WHERE match_id = ?
-            ''', (buyer, match_id))
-        else:
-            # Create new match tracking
+                INSERT INTO change_log (username, kind, data)
+                SELECT username, 'pool_settled', :data FROM (
+                    SELECT username FROM pool_members WHERE pool_id = :pool_id
+                    UNION
+                    SELECT :buyer WHERE :buyer IS NOT NULL
+                )
+            ''', {'pool_id': pool_id, 'buyer': buyer, 'data': json.dumps(
+                {'pool_id': pool_id, 'item': item, 'buyer': buyer, 'total_price': total_price})})
+
+        return Purchase(pool_id, item, buyer, total_price, shares)
+
+    def get_pool(self, pool_id: int) -> Dict:
+        """Return a pool's details and its members' (quantity, share) pairs."""
+        with self.pool.transaction(immediate=False) as conn:
+            cursor = conn.cursor()
             cursor.execute('''
-                INSERT INTO purchase_tracking 
-                (item, user1, user2, buyer, is_purchased) 
-                VALUES (?, ?, ?, ?, 0)
-            ''', (item, user1, user2, buyer))
-            match_id = cursor.lastrowid
-        
-        self.conn.commit()
-        return match_id
-
-    def complete_item_purchase(self, match_id, total_price):
-        """Complete the purchase and record the total price."""
-        cursor = self.conn.cursor()
-        
-        # Retrieve match details
-        cursor.execute('''
-            SELECT item, user1, user2, buyer 
-            FROM purchase_tracking 
-            WHERE match_id = ?
-        ''', (match_id,))
-        
-        match_details = cursor.fetchone()
-        if not match_details:
-            raise ValueError("Invalid match ID")
-        
-        item, user1, user2, buyer = match_details
-        
-        # Determine users involved in the purchase
-        if buyer == user1:
-            other_user = user2
-        else:
-            other_user = user1
-        
-        # Basic split: equal halves
-        user1_share = total_price / 2
-        user2_share = total_price / 2
-        
-        # Update the purchase tracking
-        cursor.execute('''
-            UPDATE purchase_tracking
-            SET is_purchased = 1, 
-                total_price = ?, 
-                user1_share = ?, 
-                user2_share = ?
-            WHERE match_id = ?
-        ''', (total_price, user1_share, user2_share, match_id))
-        
-        self.conn.commit()
-        
+                SELECT item, buyer, total_price, total_quantity, is_purchased
+                FROM purchase_pools WHERE pool_id = ?
+            ''', (pool_id,))
+            pool = cursor.fetchone()
+            if not pool:
+                raise ValueError("Invalid pool ID")
+            cursor.execute('SELECT username, quantity, share FROM pool_members WHERE pool_id = ?',
+                           (pool_id,))
+            members = {username: (quantity, share) for username, quantity, share in cursor.fetchall()}
+
+        item, buyer, total_price, total_quantity, is_purchased = pool
         return {
+            'pool_id': pool_id,
             'item': item,
             'buyer': buyer,
             'total_price': total_price,
-            'user1': user1,
-            'user2': user2,
-            'user1_share': user1_share,
-            'user2_share': user2_share
+            'total_quantity': total_quantity,
+            'is_purchased': bool(is_purchased),
+            'members': members
         }
 
+    @invalidates(lambda db, args, pool_id: tuple(filter(None, args[1:4])))
+    def track_matched_item_purchase(self, item, user1, user2, buyer=None):
+        """Track a matched item for potential purchase.
+
+        Both users join the buyer's open pool for the item, which is created
+        on first use, so a bulk item shared with several friends is one pool
+        rather than one row per pair. The first claim on an item by a pair
+        wins: if the other user already chose a buyer for it, both join that
+        buyer's pool instead. Returns the pool_id.
+        """
+        low, high = sorted((user1, user2))
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            # Keeps an existing claim's buyer, so RETURNING gives it; fills it in if it has none
+            cursor.execute('''
+                INSERT INTO pool_claims (item, user1, user2, buyer) VALUES (?, ?, ?, ?)
+                ON CONFLICT (item, user1, user2) DO UPDATE SET buyer = COALESCE(buyer, excluded.buyer)
+                RETURNING buyer
+            ''', (item, low, high, buyer))
+            buyer = cursor.fetchone()[0]
+            pool_id = self.create_pool(item, buyer)
+            self.join_pool(pool_id, user1)
+            self.join_pool(pool_id, user2)
+
+        return pool_id
+
+    def complete_item_purchase(self, pool_id, total_price):
+        """Complete the purchase and record the total price. See settle_pool."""
+        return self.settle_pool(pool_id, total_price)
+
+    @cached_read(first_two_users)
+    def get_balance(self, username: str, other: str) -> float:
+        """Return what ``username`` owes ``other``; negative when ``other`` owes ``username``."""
+        user1, user2 = sorted((username, other))
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('SELECT amount FROM balances WHERE user1 = ? AND user2 = ?', (user1, user2))
+            row = cursor.fetchone()
+        amount = row[0] if row else 0.0
+        return amount if username == user1 else -amount
+
+    @cached_read(first_user)
+    def get_balances(self, username: str) -> Dict[str, float]:
+        """Return {other user: what ``username`` owes them} for every non-zero balance."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user2, amount FROM balances WHERE user1 = ?
+                UNION ALL
+                SELECT user1, -amount FROM balances WHERE user2 = ?
+            ''', (username, username))
+            # Half a cent either way is settled
+            return {other: amount for other, amount in cursor.fetchall() if abs(amount) >= 0.005}
+
+    @invalidates(first_two_users)
+    def record_payment(self, payer: str, payee: str, amount: float):
+        """Record that ``payer`` paid ``payee`` and reduce what ``payer`` owes them."""
+        if amount <= 0:
+            raise ValueError("Payment amount must be positive")
+        if payer == payee:
+            raise ValueError("Cannot pay yourself")
+        user1, user2 = sorted((payer, payee))
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('INSERT INTO payments (payer, payee, amount) VALUES (?, ?, ?)',
+                           (payer, payee, amount))
+            cursor.execute('''
+                INSERT INTO balances (user1, user2, amount) VALUES (?, ?, ?)
+                ON CONFLICT (user1, user2) DO UPDATE SET amount = amount + excluded.amount
+            ''', (user1, user2, -amount if payer == user1 else amount))
+            self._log_change(cursor, 'payment_recorded', [payer, payee], payer=payer, payee=payee, amount=amount)
+
+    def rebuild_balances(self) -> int:
+        """Recompute every balance from settled pools and payments; return the number of pairs.
+
+        Balances are maintained incrementally, so this is only needed to
+        repair or verify them. It reads the whole purchase history.
+        """
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM balances')
+            cursor.execute('''
+                INSERT INTO balances (user1, user2, amount)
+                SELECT user1, user2, SUM(amount) FROM (
+                    SELECT MIN(m.username, p.buyer) AS user1, MAX(m.username, p.buyer) AS user2,
+                           CASE WHEN m.username < p.buyer THEN m.share ELSE -m.share END AS amount
+                    FROM purchase_pools p
+                    JOIN pool_members m ON m.pool_id = p.pool_id
+                    WHERE p.is_purchased = 1 AND m.username != p.buyer AND m.share IS NOT NULL
+                    UNION ALL
+                    SELECT MIN(payer, payee), MAX(payer, payee),
+                           CASE WHEN payer < payee THEN -amount ELSE amount END
+                    FROM payments
+                )
+                GROUP BY user1, user2
+            ''')
+            pairs = cursor.rowcount
+            self._log_change(cursor, 'balances_rebuilt', [None])
+        if self.cache is not None:
+            self.cache.clear()
+        return pairs
+
+    def settle_up(self, usernames: Iterable[str]) -> List[Tuple[str, str, float]]:
+        """Return the fewest (payer, payee, amount) transfers that clear the balances within a group.
+
+        Only balances between two members of the group are considered.
+        """
+        group = sorted(set(usernames))
+        net = dict.fromkeys(group, 0.0)
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT user1, user2, amount FROM balances
+                WHERE user1 IN (SELECT value FROM json_each(:group))
+                    AND user2 IN (SELECT value FROM json_each(:group))
+            ''', {'group': json.dumps(group)})
+            for user1, user2, amount in cursor.fetchall():
+                net[user1] -= amount
+                net[user2] += amount
+        return simplify_debts(net)
+
+    @cached_read(first_user)
     def get_purchase_history(self, username):
-        """Retrieve purchase history for a user."""
-        cursor = self.conn.cursor()
-        
-        cursor.execute('''
-            SELECT item, buyer, total_price, user1_share, user2_share
-            FROM purchase_tracking
-            WHERE (user1 = ? OR user2 = ?) AND is_purchased = 1
-        ''', (username, username))
-        
-        return cursor.fetchall()
+        """Retrieve purchase history for a user.
+
+        Returns a list of tuples: [(item, buyer, total_price, share, member_count), ...]
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute('''
+                SELECT p.item, p.buyer, p.total_price, m.share, p.member_count
+                FROM pool_members m
+                JOIN purchase_pools p ON p.pool_id = m.pool_id
+                WHERE m.username = ? AND m.is_purchased = 1
+            ''', (username,))
+
+            return cursor.fetchall()
 
 
-    def find_matching_items(self, username1, username2):
+    @cached_read(user_and_friends)
+    def find_fuzzy_matches(self, username: str, threshold: float = DEFAULT_THRESHOLD) -> Dict[str, List[FuzzyMatch]]:
+        """Find friends' items whose names are similar to the user's, keyed by friend.
+
+        Candidate pairs come from the key_trigrams inverted index, which holds
+        each distinct normalized item name once. ``threshold`` is the minimum
+        Dice similarity of the two trigram sets (see fuzzy.py), so a match
+        shares at least ``threshold * size / (2 - threshold)`` of the user
+        key's ``size`` trigrams and hence one outside its most common few:
+        only the postings of the rarer trigrams are read, and the common ones
+        are looked up afterwards for the pairs that can still reach the
+        threshold. Friends' rows are then read once each from the covering
+        (username, ...) index and probed against the scored pairs.
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute('''
+                WITH mine AS (
+                    SELECT DISTINCT item_key_id AS key_id FROM grocery_lists WHERE username = :username
+                ),
+                -- ``common`` is one less than the trigrams a match must share
+                ranked AS (
+                    SELECT t1.key_id AS key_id, k1.trigram_count AS size, t1.trigram AS trigram,
+                           CAST(:threshold * k1.trigram_count / (2 - :threshold) - 1e-9 AS INTEGER) AS common,
+                           ROW_NUMBER() OVER (
+                               PARTITION BY t1.key_id ORDER BY COALESCE(tc.key_count, 0) DESC, t1.trigram
+                           ) AS position
+                    FROM mine
+                    JOIN item_keys k1 ON k1.key_id = mine.key_id
+                    JOIN key_trigrams t1 ON t1.key_id = k1.key_id
+                    LEFT JOIN trigram_counts tc ON tc.trigram = t1.trigram
+                ),
+                mine_trigrams AS MATERIALIZED (
+                    SELECT key_id, size, trigram, common, position > common AS rare FROM ranked
+                ),
+                candidates AS (
+                    SELECT mine_trigrams.key_id AS key_id, t2.key_id AS friend_key_id, size, COUNT(*) AS shared,
+                           (SELECT trigram_count FROM item_keys WHERE key_id = t2.key_id) AS friend_size
+                    FROM mine_trigrams
+                    JOIN key_trigrams t2 ON t2.trigram = mine_trigrams.trigram
+                    WHERE rare
+                    GROUP BY mine_trigrams.key_id, t2.key_id
+                    -- sharing every common trigram too would still fall short
+                    HAVING 2.0 * (COUNT(*) + common) / (size + friend_size) >= :threshold
+                ),
+                scored AS MATERIALIZED (
+                    SELECT key_id, friend_key_id, 2.0 * (shared + (
+                               SELECT COUNT(*) FROM mine_trigrams m
+                               JOIN key_trigrams t2 ON t2.trigram = m.trigram AND t2.key_id = candidates.friend_key_id
+                               WHERE m.key_id = candidates.key_id AND NOT m.rare
+                           )) / (size + friend_size) AS score
+                    FROM candidates
+                ),
+                -- the user's rows paired with every similar key, probed once per friend row below
+                pairs AS MATERIALIZED (
+                    SELECT scored.friend_key_id AS friend_key_id, scored.score AS score, g1.id AS id,
+                           g1.item AS item, g1.quantity AS quantity, g1.base_quantity AS base_quantity,
+                           g1.unit AS unit, g1.dimension AS dimension
+                    FROM grocery_lists g1
+                    CROSS JOIN scored ON scored.key_id = g1.item_key_id
+                    WHERE g1.username = :username AND scored.score >= :threshold
+                )
+                SELECT g2.username, pairs.item, g2.item, pairs.score, pairs.quantity,
+                       g2.base_quantity * pairs.quantity / NULLIF(pairs.base_quantity, 0), pairs.unit
+                FROM friends f
+                CROSS JOIN grocery_lists g2 ON g2.username = f.user2
+                CROSS JOIN pairs ON pairs.friend_key_id = g2.item_key_id AND pairs.dimension = g2.dimension
+                WHERE f.user1 = :username
+                ORDER BY g2.username, pairs.score DESC, pairs.id
+            ''', {'username': username, 'threshold': threshold})
+            rows = cursor.fetchall()
+
+        matches = {}
+        for friend, item, friend_item, score, user_quantity, friend_quantity, unit in rows:
+            matches.setdefault(friend, []).append(
+                FuzzyMatch(item, user_quantity, friend_quantity, unit, friend_item, score))
+        return matches
+
+    @cached_read(first_two_users)
+    def find_matching_items(self, username1, username2) -> List[Match]:
         """
         Find grocery items that both users want, including quantities and units.
+
+        Items in different units of the same dimension (kg and lbs, or packs
+        with an item-specific conversion to pieces) match; user2's quantity is
+        converted into user1's unit. Matches are kept between friends only,
+        so this is empty unless user1 has added user2 as a friend.
         """
         query = """
-            SELECT 
-                g1.item, 
-                g1.quantity AS user1_quantity, 
-                g2.quantity AS user2_quantity, 
-                g1.unit
-            FROM grocery_lists g1
-            INNER JOIN grocery_lists g2 
-                ON g1.item = g2.item AND g1.unit = g2.unit
-            WHERE g1.username = ? AND g2.username = ?
-        """
-        if not self.cursor:
-            raise ValueError("Database cursor is not initialized. Check your database connection.")
-
-        self.cursor.execute(query, (username1, username2))
-        matches = self.cursor.fetchall()
-
-        return [
-            {"item": row[0], "user1_quantity": row[1], "user2_quantity": row[2], "unit": row[3]}
-            for row in matches
-        ]
+            SELECT item, user_quantity, friend_quantity, unit
+            FROM matches
+            WHERE username = ? AND friend = ?
+            ORDER BY item, grocery_id
+        """
+        if not self.pool:
+            raise ValueError("Database connection pool is not initialized. Check your database connection.")
+
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _record(Match)
+            cursor.execute(query, (username1, username2))
+            return cursor.fetchall()
+
+    def check_matches(self, username: Optional[str] = None) -> MatchesDiff:
+        """Diff the materialized ``matches`` table against a rebuild from scratch.
+
+        Checks one user's matches, or every user's when ``username`` is
+        None. Both sides are read in one transaction; an empty diff means
+        the triggers kept the table current.
+        """
+        scratch, materialized = _MATCHES_FROM_SCRATCH, f'SELECT {_MATCHES_COLUMNS} FROM matches'
+        params = ()
+        if username is not None:
+            scratch += ' WHERE f.user1 = ?'
+            materialized += ' WHERE username = ?'
+            params = (username,)
+        with self.pool.transaction(immediate=False) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f'{scratch} EXCEPT {materialized}', params + params)
+            missing = cursor.fetchall()
+            cursor.execute(f'{materialized} EXCEPT {scratch}', params + params)
+            unexpected = cursor.fetchall()
+        return MatchesDiff(missing, unexpected)
+
+    def rebuild_matches(self) -> int:
+        """Recompute the whole materialized ``matches`` table; return its number of rows.
+
+        The table is maintained by triggers, so this is only needed to
+        repair it after check_matches reports a difference.
+        """
+        with self.pool.transaction() as conn:
+            cursor = conn.cursor()
+            cursor.execute('DELETE FROM matches')
+            cursor.execute(f'INSERT INTO matches ({_MATCHES_COLUMNS}) {_MATCHES_FROM_SCRATCH}')
+            rows = cursor.rowcount
+            self._log_change(cursor, 'matches_rebuilt', [None])
+        if self.cache is not None:
+            self.cache.clear()
+        return rows
+
+    @cached_read(lambda db, args, snapshot: (args[0], *snapshot.friends))
+    def get_matches_snapshot(self, username: str) -> MatchesSnapshot:
+        """Load everything the Matches page needs in one read transaction.
+
+        Issues five statements regardless of how many friends the user has;
+        matches against every friend are one range of the ``matches`` table.
+        """
+        with self.pool.transaction(immediate=False) as conn:
+            cursor = conn.cursor()
 
+            cursor.row_factory = _record(GroceryItem)
+            cursor.execute('SELECT item, quantity, unit, id FROM grocery_lists WHERE username = ?',
+                           (username,))
+            grocery_items = cursor.fetchall()
+            cursor.row_factory = None
+
+            # First page only; later pages come from get_ongoing_purchases_page
+            cursor.execute(_ONGOING_PAGE, {'username': username, 'before': _cursor(None),
+                                           'limit': PAGE_SIZE + 1})
+            ongoing_purchases = cursor.fetchall()
+            ongoing_cursor = ongoing_purchases[PAGE_SIZE - 1][0] if len(ongoing_purchases) > PAGE_SIZE else None
+            ongoing_purchases = ongoing_purchases[:PAGE_SIZE]
+
+            cursor.execute('SELECT user2 FROM friends WHERE user1 = ?', (username,))
+            friends = [friend[0] for friend in cursor.fetchall()]
+
+            cursor.execute('''
+                SELECT DISTINCT item
+                FROM purchase_pools
+                WHERE buyer = ? AND is_purchased = 0
+            ''', (username,))
+            tracked_purchase_items = [item[0] for item in cursor.fetchall()]
+
+            cursor.execute('''
+                SELECT friend, item, user_quantity, friend_quantity, unit
+                FROM matches
+                WHERE username = ?
+                ORDER BY friend, item, grocery_id
+            ''', (username,))
+            matches = _matches_by_friend(cursor.fetchall())
+
+        return MatchesSnapshot(grocery_items, Page(ongoing_purchases, ongoing_cursor), friends,
+                               tracked_purchase_items, matches)
+
+    @cached_read(first_user)
     def get_ongoing_purchases(self, username):
-            """
-            Retrieve ongoing purchases involving the user where a friend is buying.
-            
-            Returns a list of tuples: [(buyer, item), ...]
-            """
-            cursor = self.conn.cursor()
-            
+        """
+        Retrieve ongoing purchases involving the user where a friend is buying.
+
+        Returns a list of tuples: [(buyer, item), ...]
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
             # Find purchases where the user is involved and a buyer is selected
             cursor.execute('''
-                SELECT buyer, item
-                FROM purchase_tracking
-                WHERE (user1 = ? OR user2 = ?) AND 
-                    buyer IS NOT NULL AND 
-                    buyer != ? AND 
-                    is_purchased = 0
-            ''', (username, username, username))
-            
+                SELECT p.buyer, p.item
+                FROM pool_members m
+                JOIN purchase_pools p ON p.pool_id = m.pool_id
+                WHERE m.username = ? AND
+                    m.is_purchased = 0 AND
+                    p.buyer IS NOT NULL AND
+                    p.buyer != ?
+            ''', (username, username))
+
             return cursor.fetchall()
-            
+
+    @cached_read(first_user)
     def get_tracked_purchase_items(self, username):
-            """
-            Retrieve items that are currently being tracked for purchase by the user.
-            
-            Args:
-                username (str): Username to check for tracked purchases
-            
-            Returns:
-                List[str]: List of items being purchased
-            """
-            cursor = self.conn.cursor()
-            
+        """
+        Retrieve items that are currently being tracked for purchase by the user.
+
+        Args:
+            username (str): Username to check for tracked purchases
+
+        Returns:
+            List[str]: List of items being purchased
+        """
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
             # Find items where the user is the buyer and purchase is not completed
             cursor.execute('''
                 SELECT DISTINCT item
-                FROM purchase_tracking
+                FROM purchase_pools
                 WHERE buyer = ? AND is_purchased = 0
             ''', (username,))
-            
-            return [item[0] for item in cursor.fetchall()]
\ No newline at end of file
+
+            return [item[0] for item in cursor.fetchall()]
@@ -0,0 +1,101 @@
+"""Streaming CSV / JSON Lines export of a user's data.
+
+Exports are generators of encoded chunks fed by ``DatabaseManager`` row
+iterators, so memory use stays constant however long the history is.
+``api.py`` streams them to clients as they are generated; a browser can
+download one from there through a link signed with a secret the app and
+the API share (see export_link).
+"""
+import csv
+import hashlib
+import hmac
+import io
+import json
+import time
+from typing import IO, Iterable, Iterator, Sequence
+from urllib.parse import quote, urlencode
+
+from database import DatabaseManager
+
+# export name -> (column names, DatabaseManager row iterator)
+EXPORTS = {
+    'grocery_list': (('item', 'quantity', 'unit', 'id'), DatabaseManager.iter_grocery_items),
+    'matches': (('friend', 'item', 'your_quantity', 'friend_quantity', 'unit'),
+                DatabaseManager.iter_matches),
+    'purchases': (('pool_id', 'item', 'buyer', 'total_price', 'is_purchased',
+                   'member_count', 'quantity', 'share'),
+                  DatabaseManager.iter_purchase_history),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def iter_csv(columns: Sequence[str], rows: Iterable[tuple], rows_per_chunk: int = 500) -> Iterator[bytes]:
+    """Encode rows as CSV, yielding one chunk per ``rows_per_chunk`` rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    pending = 0
+    for row in rows:
+        writer.writerow(row)
+        pending += 1
+        if pending >= rows_per_chunk:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+            pending = 0
+    yield buffer.getvalue().encode('utf-8')
+
+
+def iter_jsonl(columns: Sequence[str], rows: Iterable[tuple], rows_per_chunk: int = 500) -> Iterator[bytes]:
+    """Encode rows as newline-delimited JSON objects."""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, row))))
+        if len(lines) >= rows_per_chunk:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def export_rows(db: DatabaseManager, username: str, export: str, fmt: str) -> Iterator[bytes]:
+    """Stream one of ``EXPORTS`` for ``username`` in one of ``FORMATS``."""
+    if export not in EXPORTS:
+        raise ValueError(f'Unknown export: {export}')
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported export format: {fmt}')
+
+    columns, iter_rows = EXPORTS[export]
+    rows = iter_rows(db, username)
+    return iter_csv(columns, rows) if fmt == 'csv' else iter_jsonl(columns, rows)
+
+
+def write_export(db: DatabaseManager, username: str, export: str, fmt: str, fileobj: IO[bytes]) -> int:
+    """Write an export to a binary file object and return the bytes written."""
+    written = 0
+    for chunk in export_rows(db, username, export, fmt):
+        fileobj.write(chunk)
+        written += len(chunk)
+    return written
+
+
+def sign_export(secret: str, username: str, export: str, fmt: str, expires: int) -> str:
+    """Return the signature that lets a link download ``export`` for ``username`` until ``expires``."""
+    message = '\n'.join((username, export, fmt, str(expires))).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+def export_link(api_url: str, secret: str, username: str, export: str, fmt: str, ttl: int = 300) -> str:
+    """Return a ``GET /export`` URL on the API that downloads an export without logging in.
+
+    The link is valid for ``ttl`` seconds and only for this user, export
+    and format.
+    """
+    expires = int(time.time()) + ttl
+    query = urlencode({'user': username, 'expires': expires,
+                       'signature': sign_export(secret, username, export, fmt, expires)})
+    return f"{api_url.rstrip('/')}/export/{quote(export)}.{quote(fmt)}?{query}"
@@ -0,0 +1,34 @@
+"""Capability checks for optional features with heavy dependencies.
+
+Modules such as OpenCV are imported only by the code that uses them, never
+while the app starts. ``missing`` reports what a feature lacks without
+importing anything, so pages can offer or explain a feature cheaply.
+"""
+import functools
+import importlib.util
+import shutil
+from typing import Tuple
+
+# feature -> ((module, pip package), ...), (external programs, ...)
+OPTIONAL_FEATURES = {
+    'receipts': (
+        (('cv2', 'opencv-python'), ('numpy', 'numpy'), ('pytesseract', 'pytesseract')),
+        ('tesseract',),
+    ),
+}
+
+
+def optional_modules() -> Tuple[str, ...]:
+    """Every module that only optional features import."""
+    return tuple(module for modules, _ in OPTIONAL_FEATURES.values() for module, _ in modules)
+
+
+@functools.lru_cache(maxsize=None)
+def missing(feature: str) -> Tuple[str, ...]:
+    """Return the pip packages and programs ``feature`` needs that are not installed.
+
+    Cached for the life of the process; restart after installing them.
+    """
+    modules, programs = OPTIONAL_FEATURES[feature]
+    absent = tuple(package for module, package in modules if importlib.util.find_spec(module) is None)
+    return absent + tuple(program for program in programs if shutil.which(program) is None)
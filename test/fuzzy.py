@@ -0,0 +1,47 @@
+"""Fuzzy item-name similarity for matching grocery lists.
+
+Item names are folded (case, punctuation, whitespace) and split into
+tokens. Each token is padded with one space on either side and cut into
+trigrams, so "2% milk" and "Milk 2%" have identical trigram sets and a typo
+only disturbs the trigrams around it. Similarity is the Dice coefficient of
+the two trigram sets.
+
+``DatabaseManager`` stores the trigrams of every distinct item key in the
+``key_trigrams`` inverted index, so candidates are found by index lookups
+on shared trigrams instead of comparing every pair of items.
+"""
+import functools
+import re
+from typing import FrozenSet, List
+
+DEFAULT_THRESHOLD = 0.6
+
+_NON_WORD = re.compile(r'[^\w%]+')
+
+
+def item_tokens(item: str) -> List[str]:
+    """Fold case, punctuation and whitespace and return the distinct tokens, sorted."""
+    return sorted(set(_NON_WORD.sub(' ', item.casefold()).split()))
+
+
+@functools.lru_cache(maxsize=65536)
+def item_key(item: str) -> str:
+    """Return the normalized key under which an item name is indexed."""
+    return ' '.join(item_tokens(item))
+
+
+def item_trigrams(item: str) -> FrozenSet[str]:
+    """Return the set of per-token trigrams of an item name."""
+    trigrams = set()
+    for token in item_tokens(item):
+        padded = f' {token} '
+        trigrams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(trigrams)
+
+
+def similarity(item1: str, item2: str) -> float:
+    """Dice coefficient of the two items' trigram sets, from 0.0 to 1.0."""
+    trigrams1, trigrams2 = item_trigrams(item1), item_trigrams(item2)
+    if not trigrams1 or not trigrams2:
+        return 0.0
+    return 2 * len(trigrams1 & trigrams2) / (len(trigrams1) + len(trigrams2))
@@ -0,0 +1,94 @@
+"""Fail if starting the app gets slower, heavier or loads optional modules.
+
+Imports ``main`` (and with it ``app`` and Streamlit) in a fresh interpreter,
+as every cold start of the app does, and checks the import time, the peak
+resident memory and that none of the modules behind optional features
+(see features.py) were loaded. On failure the slowest imports reported by
+``python -X importtime`` are listed. Run from the ``test`` directory::
+
+    python import_budget.py [--max-seconds 3] [--max-rss-mb 250]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from typing import List, Tuple
+
+from features import optional_modules
+
+# Runs in the child interpreter; ru_maxrss is KiB on Linux and bytes on macOS
+_CHILD = '''
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{"seconds": seconds, "rss_mb": rss / (1024 ** 2 if sys.platform == "darwin" else 1024),
+                  "modules": sorted(sys.modules)}}))
+'''
+# "import time: self [us] | cumulative | imported package"
+_IMPORT_TIME = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def measure(module: str) -> dict:
+    """Import ``module`` in a fresh interpreter and return its import time, peak RSS and modules."""
+    result = subprocess.run([sys.executable, '-c', _CHILD.format(module=module)],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if result.returncode:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'import failed')
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def slowest_imports(module: str, count: int = 10) -> List[Tuple[float, str]]:
+    """Return (cumulative ms, package) for the slowest top-level imports under ``module``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    timings = []
+    for line in result.stderr.splitlines():
+        match = _IMPORT_TIME.match(line)
+        # Packages indented by at most one level were imported by the module itself
+        if match and len(match.group(3)) <= 3:
+            timings.append((int(match.group(2)) / 1000, match.group(4)))
+    return sorted(timings, reverse=True)[:count]
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--module', default='main', help='module whose import is measured')
+    parser.add_argument('--max-seconds', type=float, default=3.0)
+    parser.add_argument('--max-rss-mb', type=float, default=250.0)
+    parser.add_argument('--runs', type=int, default=3, help='best of this many cold imports is timed')
+    args = parser.parse_args()
+
+    try:
+        runs = [measure(args.module) for _ in range(args.runs)]
+    except RuntimeError as e:
+        print(f'FAIL: importing {args.module} failed: {e}')
+        return 1
+    seconds = min(run['seconds'] for run in runs)
+    rss_mb = min(run['rss_mb'] for run in runs)
+    loaded = sorted(set(optional_modules()) & set(runs[0]['modules']))
+    print(f'import {args.module}: {seconds:.2f} s, peak RSS {rss_mb:.0f} MB, {len(runs[0]["modules"])} modules')
+
+    problems = []
+    if loaded:
+        problems.append(f"optional modules loaded at start-up: {', '.join(loaded)}")
+    if seconds > args.max_seconds:
+        problems.append(f'import takes more than {args.max_seconds} s')
+    if rss_mb > args.max_rss_mb:
+        problems.append(f'peak RSS is more than {args.max_rss_mb} MB')
+    if problems:
+        print('slowest imports:')
+        for milliseconds, package in slowest_imports(args.module):
+            print(f'{milliseconds:>10.1f} ms  {package}')
+        for problem in problems:
+            print(f'FAIL: {problem}')
+        return 1
+    print('OK: start-up is within its time and memory budget')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
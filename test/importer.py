@@ -0,0 +1,139 @@
+"""Bulk import of grocery lists from CSV or JSON files.
+
+Rows are read lazily from the input stream, validated one at a time and
+written in chunks through ``DatabaseManager.add_grocery_items`` so that a
+large file costs one transaction per chunk instead of one per row.
+
+CSV files need an ``item,quantity,unit`` header. JSON files are either JSON
+Lines (one object per line, streamed) or a single array of objects.
+"""
+import csv
+import json
+import math
+from typing import IO, Iterator, List, NamedTuple, Sequence, Tuple
+
+from database import DatabaseManager
+from models import UNITS
+
+MAX_ITEM_LENGTH = 100
+
+
+class ImportResult(NamedTuple):
+    inserted: int
+    error_count: int
+    # (row number, message) for the first ``max_errors`` rejected rows
+    errors: List[Tuple[int, str]]
+
+
+def iter_csv_rows(stream: IO[str]) -> Iterator[Tuple[int, dict]]:
+    """Yield (row number, raw row) pairs from a CSV file with a header line."""
+    reader = csv.reader(stream)
+    header = [name.strip().lower() for name in next(reader, [])]
+    for row in reader:
+        if row:
+            # cheaper than csv.DictReader, which matters on large files
+            yield reader.line_num, dict(zip(header, row))
+
+
+def iter_json_rows(stream: IO[str]) -> Iterator[Tuple[int, dict]]:
+    """Yield (row number, raw row) pairs from JSON Lines or a JSON array."""
+    first_line = stream.readline()
+    if first_line.lstrip().startswith('['):
+        # A plain JSON array can't be parsed incrementally with the stdlib
+        rows = json.loads(first_line + stream.read())
+        for number, row in enumerate(rows, start=1):
+            yield number, row
+        return
+
+    if first_line.strip():
+        yield 1, _parse_json_line(first_line)
+    for number, line in enumerate(stream, start=2):
+        if line.strip():
+            yield number, _parse_json_line(line)
+
+
+def _parse_json_line(line: str):
+    # Malformed lines are passed on as the error so they are reported per row
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return ValueError(f'invalid JSON: {e}')
+
+
+def validate_row(row, units: Sequence[str] = UNITS) -> Tuple[str, float, str]:
+    """Return a clean (item, quantity, unit) tuple or raise ValueError."""
+    if isinstance(row, Exception):
+        raise row
+    if not isinstance(row, dict):
+        raise ValueError('expected an object with item, quantity and unit')
+
+    item = str(row.get('item') or '').strip()
+    if not item:
+        raise ValueError('item is required')
+    if len(item) > MAX_ITEM_LENGTH:
+        raise ValueError(f'item is longer than {MAX_ITEM_LENGTH} characters')
+
+    try:
+        quantity = float(row.get('quantity'))
+    except (TypeError, ValueError):
+        raise ValueError(f"quantity {row.get('quantity')!r} is not a number") from None
+    if not math.isfinite(quantity) or quantity <= 0:
+        raise ValueError('quantity must be greater than 0')
+
+    unit = str(row.get('unit') or '').strip()
+    if unit not in units:
+        # Case-insensitive, but stored as the unit was defined, e.g. KG as kg and a custom Tray as Tray
+        unit = next((known for known in units if known.lower() == unit.lower()), None)
+        if unit is None:
+            raise ValueError(f"unit {row.get('unit')!r} is not one of {', '.join(units)}")
+
+    return item, quantity, unit
+
+
+def import_grocery_list(db: DatabaseManager, username: str, stream: IO[str], fmt: str,
+                        chunk_size: int = 5000, max_errors: int = 100) -> ImportResult:
+    """Validate and insert every row of ``stream`` into ``username``'s list.
+
+    ``fmt`` is ``'csv'`` or ``'json'``. Invalid rows are reported and skipped;
+    they never abort the rest of the import.
+    """
+    if fmt == 'csv':
+        rows = iter_csv_rows(stream)
+    elif fmt in ('json', 'jsonl'):
+        rows = iter_json_rows(stream)
+    else:
+        raise ValueError(f'Unsupported import format: {fmt}')
+
+    units = db.get_units()
+    inserted = 0
+    error_count = 0
+    errors = []
+
+    def report(number, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < max_errors:
+            errors.append((number, message))
+
+    def flush(chunk, numbers):
+        nonlocal inserted
+        failed = db.add_grocery_items(username, chunk)
+        for index, message in failed:
+            report(numbers[index], message)
+        inserted += len(chunk) - len(failed)
+
+    chunk, numbers = [], []
+    for number, row in rows:
+        try:
+            chunk.append(validate_row(row, units))
+            numbers.append(number)
+        except ValueError as e:
+            report(number, str(e))
+            continue
+        if len(chunk) >= chunk_size:
+            flush(chunk, numbers)
+            chunk, numbers = [], []
+    if chunk:
+        flush(chunk, numbers)
+
+    return ImportResult(inserted, error_count, errors)
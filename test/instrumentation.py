@@ -0,0 +1,270 @@
+"""Opt-in per-statement SQL statistics, a slow-query log and page render timings.
+
+Pass a ``QueryStats`` to ``DatabaseManager`` (or ``ConnectionPool``) and its
+connections are opened as ``InstrumentedConnection``, whose cursors time
+every statement from ``execute`` until its last row is fetched. Without
+one the pool opens plain ``sqlite3.Connection`` objects, so instrumentation
+costs nothing unless it is enabled.
+
+Statements are keyed by their SQL text with whitespace collapsed, so every
+call of the same query in ``DatabaseManager`` is aggregated together.
+Percentiles are computed over each statement's most recent calls.
+"""
+import collections
+import functools
+import sqlite3
+import threading
+import time
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional
+
+# Latencies kept per statement and page for percentiles
+WINDOW = 1000
+# Slow statements kept in the log
+SLOW_LOG_SIZE = 100
+
+# Only these can be EXPLAINed; transaction control and PRAGMAs have no plan
+_EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+
+class StatementSummary(NamedTuple):
+    sql: str
+    calls: int
+    total_ms: float
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    rows: int
+
+
+class RenderSummary(NamedTuple):
+    page: str
+    calls: int
+    total_ms: float
+    p50_ms: float
+    p95_ms: float
+    # Time spent in SQL statements while the page rendered
+    sql_ms: float
+    statements: int
+
+
+class SlowQuery(NamedTuple):
+    sql: str
+    ms: float
+    rows: int
+    # EXPLAIN QUERY PLAN detail lines, or None if the statement has no plan
+    plan: Optional[List[str]]
+    # time.time() when the statement finished
+    at: float
+
+
+def _percentile(ordered: List[float], fraction: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+class _Timings:
+    """Call count, total and recent latencies of one statement or page."""
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.rows = 0
+        self.sql = 0.0
+        self.statements = 0
+        self.recent: Deque[float] = collections.deque(maxlen=WINDOW)
+
+    def add(self, seconds: float):
+        self.calls += 1
+        self.total += seconds
+        self.recent.append(seconds)
+
+
+class QueryStats:
+    def __init__(self, slow_ms: float = 50.0):
+        """Collect statistics; statements slower than ``slow_ms`` go to the slow-query log."""
+        self.slow_ms = slow_ms
+        self._statements: Dict[str, _Timings] = {}
+        self._pages: Dict[str, _Timings] = {}
+        self._slow: Deque[SlowQuery] = collections.deque(maxlen=SLOW_LOG_SIZE)
+        self._lock = threading.Lock()
+        # The page being rendered on this thread, and its SQL time so far
+        self._local = threading.local()
+
+    def record(self, conn: sqlite3.Connection, sql: str, parameters, seconds: float, rows: int):
+        """Record one finished statement; called by InstrumentedCursor."""
+        key = ' '.join(sql.split())
+        page = getattr(self._local, 'page', None)
+        if page is not None:
+            page.sql += seconds
+            page.statements += 1
+        plan = None
+        slow = seconds * 1000 >= self.slow_ms
+        if slow and parameters is not None and key.upper().startswith(_EXPLAINABLE):
+            plan = _explain(conn, sql, parameters)
+        with self._lock:
+            timings = self._statements.get(key)
+            if timings is None:
+                timings = self._statements[key] = _Timings()
+            timings.add(seconds)
+            timings.rows += rows
+            if slow:
+                self._slow.append(SlowQuery(key, seconds * 1000, rows, plan, time.time()))
+
+    def timed(self, page: str, render: Callable) -> Callable:
+        """Wrap a page's render function to record its duration and the SQL it ran."""
+        @functools.wraps(render)
+        def wrapper(*args, **kwargs):
+            outer = getattr(self._local, 'page', None)
+            current = self._local.page = _Timings()
+            start = time.perf_counter()
+            try:
+                return render(*args, **kwargs)
+            finally:
+                # st.rerun() and st.stop() leave a page by raising
+                elapsed = time.perf_counter() - start
+                self._local.page = outer
+                with self._lock:
+                    timings = self._pages.get(page)
+                    if timings is None:
+                        timings = self._pages[page] = _Timings()
+                    timings.add(elapsed)
+                    timings.sql += current.sql
+                    timings.statements += current.statements
+        return wrapper
+
+    def statements(self) -> List[StatementSummary]:
+        """Per-statement statistics, the most total time first."""
+        with self._lock:
+            items = [(sql, t.calls, t.total, t.rows, sorted(t.recent)) for sql, t in self._statements.items()]
+        summaries = [StatementSummary(sql, calls, total * 1000, total * 1000 / calls,
+                                      _percentile(recent, 0.5) * 1000, _percentile(recent, 0.95) * 1000,
+                                      _percentile(recent, 0.99) * 1000, rows)
+                     for sql, calls, total, rows, recent in items]
+        return sorted(summaries, key=lambda summary: -summary.total_ms)
+
+    def pages(self) -> List[RenderSummary]:
+        """Per-page render statistics, the most total time first."""
+        with self._lock:
+            items = [(page, t.calls, t.total, sorted(t.recent), t.sql, t.statements)
+                     for page, t in self._pages.items()]
+        summaries = [RenderSummary(page, calls, total * 1000, _percentile(recent, 0.5) * 1000,
+                                   _percentile(recent, 0.95) * 1000, sql * 1000, statements)
+                     for page, calls, total, recent, sql, statements in items]
+        return sorted(summaries, key=lambda summary: -summary.total_ms)
+
+    def slow_queries(self) -> List[SlowQuery]:
+        """The slow-query log, newest first."""
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def reset(self):
+        with self._lock:
+            self._statements.clear()
+            self._pages.clear()
+            self._slow.clear()
+
+
+def _explain(conn: sqlite3.Connection, sql: str, parameters) -> Optional[List[str]]:
+    # A plain cursor, so the EXPLAIN is not itself recorded
+    try:
+        cursor = sqlite3.Cursor(conn)
+        return [row[3] for row in cursor.execute(f'EXPLAIN QUERY PLAN {sql}', parameters)]
+    except sqlite3.Error:
+        return None
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor that reports each statement's latency and rows to its connection's QueryStats.
+
+    A statement is finished when its rows run out, when the cursor runs
+    another statement or when the cursor is closed or collected.
+    """
+    _sql = None
+
+    def _start(self, sql: str, parameters):
+        self._finish()
+        self._sql = sql
+        self._parameters = parameters
+        self._rows = 0
+        self._elapsed = 0.0
+
+    def _finish(self):
+        if self._sql is not None:
+            sql, self._sql = self._sql, None
+            self.connection.stats.record(self.connection, sql, self._parameters, self._elapsed, self._rows)
+
+    def _fetched(self, start: float, rows: int, done: bool):
+        self._elapsed += time.perf_counter() - start
+        self._rows += rows
+        if done:
+            self._finish()
+
+    def execute(self, sql, parameters=()):
+        self._start(sql, parameters)
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._fetched(start, 0, self.description is None)
+
+    def executemany(self, sql, seq_of_parameters):
+        # The parameters are usually a one-shot iterator, so there is nothing to EXPLAIN with
+        self._start(sql, None)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self._fetched(start, 0, self.description is None)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, row is not None, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows), not rows)
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows), True)
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(start, 0, True)
+            raise
+        self._fetched(start, 1, False)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    """A connection whose statements are recorded in ``stats``; set it right after connecting."""
+    stats: QueryStats
+
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection's shortcuts do not go through cursor()
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
@@ -0,0 +1,218 @@
+"""Load-test the JSON API and report throughput and latency percentiles.
+
+Seeds a temporary database with users, friendships and grocery lists, starts
+``api.py`` on it in a separate process and drives it with concurrent
+keep-alive clients, each logged in as a different user and issuing a mix of
+reads and writes like the app's. Run from the ``test`` directory::
+
+    python load_test.py [--clients 8] [--requests 5000] [--max-p99-ms 250]
+
+Compare the ``changes`` row of a run with ``--history 1000000`` against one
+without to see that polling for changes does not slow down as the change
+log grows.
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from database import DatabaseManager
+from models import UNITS, User
+
+PASSWORD = 'load-test'
+
+# (weight, name, method, path); {friend} and {item} are filled per request
+_MIX = [
+    (30, 'matches', 'GET', '/matches'),
+    (15, 'groceries', 'GET', '/groceries'),
+    (10, 'friends', 'GET', '/friends'),
+    (10, 'ongoing', 'GET', '/purchases/ongoing'),
+    (5, 'history', 'GET', '/purchases/history'),
+    (10, 'balances', 'GET', '/balances'),
+    (10, 'add item', 'POST', '/groceries'),
+    (5, 'track', 'POST', '/pools'),
+    (5, 'open pools', 'GET', '/pools'),
+    # Open dashboards poll for changes more often than anything else
+    (40, 'changes', 'GET', '/changes'),
+]
+
+
+def seed(db: DatabaseManager, users: int, friends: int, items: int, seed_value: int = 0):
+    """Register ``users`` users, each with about ``friends`` friends and ``items`` grocery items."""
+    rng = random.Random(seed_value)
+    names = [f'user{i}' for i in range(users)]
+    with db.pool.transaction() as conn:
+        conn.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                         [(name, User.hash_password(PASSWORD), f'{name}@example.com') for name in names])
+        pairs = set()
+        for index, name in enumerate(names):
+            for other in rng.sample(names, min(friends, users - 1)):
+                if other != name:
+                    pairs.add((name, other))
+                    pairs.add((other, name))
+        conn.executemany('INSERT INTO friends (user1, user2) VALUES (?, ?)', sorted(pairs))
+    catalog = [f'item{i}' for i in range(items * 4)]
+    for name in names:
+        db.add_grocery_items(name, [(item, float(rng.randint(1, 5)), rng.choice(UNITS[:2]))
+                                    for item in rng.sample(catalog, items)])
+
+
+def seed_history(db: DatabaseManager, users: int, rows: int, seed_value: int = 0):
+    """Append ``rows`` old entries to the change log, spread over every user."""
+    rng = random.Random(seed_value)
+    with db.pool.transaction() as conn:
+        conn.executemany('INSERT INTO change_log (username, kind, data) VALUES (?, ?, ?)',
+                         ((f'user{rng.randrange(users)}', 'grocery_added',
+                           json.dumps({'item': f'item{n % 100}', 'quantity': 1, 'unit': 'kg'}))
+                          for n in range(rows)))
+
+
+def start_server(db_path: str, workers: int) -> Tuple[subprocess.Popen, int]:
+    """Run api.py on an ephemeral port and return the process and its port."""
+    server = subprocess.Popen([sys.executable, 'api.py', '--db', db_path, '--port', '0',
+                               '--workers', str(workers)],
+                              stdout=subprocess.PIPE, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    line = server.stdout.readline()
+    if not line.startswith('Serving on'):
+        server.kill()
+        raise RuntimeError('api.py did not start')
+    return server, int(line.rsplit(':', 1)[1])
+
+
+def request(conn: http.client.HTTPConnection, method: str, path: str,
+            body: dict = None, token: str = None) -> Tuple[int, dict]:
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Bearer {token}'
+    conn.request(method, path, json.dumps(body) if body is not None else None, headers)
+    response = conn.getresponse()
+    return response.status, json.loads(response.read() or b'{}')
+
+
+def run_client(port: int, username: str, count: int, seed_value: int,
+               results: List[Tuple[str, int, float]]):
+    """Log in as ``username`` and issue ``count`` requests, appending (name, status, seconds)."""
+    rng = random.Random(seed_value)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    samples = []
+    try:
+        status, body = request(conn, 'POST', '/login', {'username': username, 'password': PASSWORD})
+        if status != 200:
+            results.append(('login', status, 0.0))
+            return
+        token = body['token']
+        friends = request(conn, 'GET', '/friends', token=token)[1]['friends']
+        since = request(conn, 'GET', '/changes', token=token)[1]['seq']
+        weights = [weight for weight, *_ in _MIX]
+        for number in range(count):
+            _, name, method, path = rng.choices(_MIX, weights)[0]
+            payload = None
+            if name == 'add item':
+                payload = {'item': f'extra{rng.randrange(1000)}', 'quantity': 1, 'unit': 'kg'}
+            elif name == 'track':
+                if not friends:
+                    continue
+                payload = {'item': f'item{rng.randrange(100)}', 'friend': rng.choice(friends)}
+            elif name == 'changes':
+                path = f'{path}?since={since}'
+            start = time.perf_counter()
+            try:
+                status, body = request(conn, method, path, payload, token)
+                if name == 'changes' and status == 200:
+                    since = body['seq']
+            except (OSError, http.client.HTTPException, ValueError):
+                status = 0
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            samples.append((name, status, time.perf_counter() - start))
+    finally:
+        conn.close()
+        results.extend(samples)
+
+
+def percentiles(seconds: List[float]) -> Dict[str, float]:
+    """Return p50, p95 and p99 of ``seconds`` in milliseconds."""
+    if len(seconds) < 2:
+        value = seconds[0] * 1000 if seconds else 0.0
+        return {'p50': value, 'p95': value, 'p99': value}
+    cuts = statistics.quantiles(seconds, n=100, method='inclusive')
+    return {'p50': cuts[49] * 1000, 'p95': cuts[94] * 1000, 'p99': cuts[98] * 1000}
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--friends', type=int, default=10, help='friends each user adds')
+    parser.add_argument('--items', type=int, default=30, help='grocery items per user')
+    parser.add_argument('--workers', type=int, default=8, help='server worker threads')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent keep-alive clients; each holds a worker while connected')
+    parser.add_argument('--requests', type=int, default=5000, help='total requests across clients')
+    parser.add_argument('--history', type=int, default=0,
+                        help='old change-log entries to seed; polls should cost the same however many')
+    parser.add_argument('--max-p99-ms', type=float, default=250.0)
+    parser.add_argument('--min-rps', type=float, default=100.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'load.db')
+        db = DatabaseManager(db_path)
+        seed(db, args.users, args.friends, args.items)
+        seed_history(db, args.users, args.history)
+        db.close_connection()
+        server, port = start_server(db_path, args.workers)
+        try:
+            results = []
+            per_client = args.requests // args.clients
+            clients = [threading.Thread(target=run_client,
+                                        args=(port, f'user{i % args.users}', per_client, i, results))
+                       for i in range(args.clients)]
+            start = time.perf_counter()
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+
+    by_name = {}
+    for name, status, seconds in results:
+        by_name.setdefault(name, []).append((status, seconds))
+    print(f"{'endpoint':<12} {'requests':>8} {'errors':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for name, samples in sorted(by_name.items()):
+        errors = sum(1 for status, _ in samples if not 200 <= status < 300)
+        cuts = percentiles([seconds for _, seconds in samples])
+        print(f"{name:<12} {len(samples):>8} {errors:>7} {cuts['p50']:>8.2f} {cuts['p95']:>8.2f} {cuts['p99']:>8.2f}")
+
+    errors = sum(1 for _, status, _ in results if not 200 <= status < 300)
+    overall = percentiles([seconds for _, _, seconds in results])
+    throughput = len(results) / elapsed if elapsed else 0.0
+    print(f'{len(results)} requests from {args.clients} clients in {elapsed:.2f} s: {throughput:.0f} req/s, '
+          f"p50 {overall['p50']:.2f} ms, p95 {overall['p95']:.2f} ms, p99 {overall['p99']:.2f} ms")
+
+    problems = []
+    if errors:
+        problems.append(f'{errors} requests failed')
+    if overall['p99'] > args.max_p99_ms:
+        problems.append(f'p99 latency is above {args.max_p99_ms} ms')
+    if throughput < args.min_rps:
+        problems.append(f'throughput is below {args.min_rps} req/s')
+    for problem in problems:
+        print(f'FAIL: {problem}')
+    if not problems:
+        print('OK: the API is within its latency and throughput budget')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,815 @@
+"""Versioned schema migrations keyed on ``PRAGMA user_version``.
+
+Each migration upgrades the schema by exactly one version and runs in its
+own transaction, so existing ``friends.db`` / ``grocery_share.db`` files are
+upgraded in place the next time ``DatabaseManager`` opens them. To upgrade
+files by hand, run from the ``test`` directory::
+
+    python migrations.py friends.db ../grocery_share.db
+"""
+import sqlite3
+import sys
+
+from fuzzy import item_key, item_trigrams
+
+
+def _create_base_tables(cursor):
+    """Version 1: the original users/friends/grocery_lists/purchase_tracking schema."""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            email TEXT UNIQUE
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS friends (
+            user1 TEXT,
+            user2 TEXT,
+            FOREIGN KEY(user1) REFERENCES users(username),
+            FOREIGN KEY(user2) REFERENCES users(username),
+            PRIMARY KEY(user1, user2)
+        )
+    ''')
+
+    # Databases created by groceryClass.py have no explicit id column, so
+    # rebuild them with one before relying on stable row ids.
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(grocery_lists)')]
+    if columns and 'id' not in columns:
+        cursor.execute('ALTER TABLE grocery_lists RENAME TO grocery_lists_legacy')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS grocery_lists (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            item TEXT,
+            quantity REAL,
+            unit TEXT,
+            FOREIGN KEY(username) REFERENCES users(username)
+        )
+    ''')
+    if columns and 'id' not in columns:
+        cursor.execute('''
+            INSERT INTO grocery_lists (username, item, quantity, unit)
+            SELECT username, item, quantity, unit FROM grocery_lists_legacy ORDER BY rowid
+        ''')
+        cursor.execute('DROP TABLE grocery_lists_legacy')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_tracking (
+            match_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item TEXT,
+            buyer TEXT,
+            total_price REAL,
+            is_purchased BOOLEAN DEFAULT 0,
+            user1 TEXT,
+            user2 TEXT,
+            user1_share REAL,
+            user2_share REAL,
+            FOREIGN KEY(user1) REFERENCES users(username),
+            FOREIGN KEY(user2) REFERENCES users(username)
+        )
+    ''')
+
+
+def _add_query_indexes(cursor):
+    """Version 2: covering indexes for the lookups DatabaseManager performs."""
+    # get_grocery_items, remove_grocery_item and both matching queries
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_grocery_lists_user_item
+        ON grocery_lists (username, item, unit, quantity)
+    ''')
+    # get_tracked_purchase_items
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_tracking_buyer
+        ON purchase_tracking (buyer, is_purchased, item)
+    ''')
+    # track_matched_item_purchase and the user1 side of the (user1 OR user2) lookups
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_tracking_user1
+        ON purchase_tracking (user1, user2, item)
+    ''')
+    # the user2 side of the (user1 OR user2) lookups
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_tracking_user2
+        ON purchase_tracking (user2, user1, item)
+    ''')
+
+
+# Recomputes a grocery row's canonical columns in a trigger. Unknown units
+# fall back to being their own dimension with factor 1.
+_CANONICALIZE = '''
+        UPDATE grocery_lists SET
+            dimension = COALESCE((
+                SELECT c.dimension FROM unit_conversions c
+                WHERE c.unit = NEW.unit AND c.item IN ('', lower(NEW.item))
+                ORDER BY c.item DESC LIMIT 1
+            ), NEW.unit),
+            base_quantity = NEW.quantity * COALESCE((
+                SELECT c.factor FROM unit_conversions c
+                WHERE c.unit = NEW.unit AND c.item IN ('', lower(NEW.item))
+                ORDER BY c.item DESC LIMIT 1
+            ), 1)
+        WHERE id = NEW.id;
+'''
+
+
+def _add_canonical_quantities(cursor):
+    """Version 3: store each item's quantity in a canonical base unit.
+
+    ``unit_conversions`` maps a unit to a dimension and a factor to that
+    dimension's base unit (grams for mass, single pieces for count). Rows
+    with a non-empty ``item`` override the generic conversion for that item
+    only, e.g. one pack of eggs = 12 pieces. Triggers keep
+    ``grocery_lists.dimension`` / ``base_quantity`` current on every write,
+    so matching across units is an indexed equality on ``dimension``.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS unit_conversions (
+            item TEXT NOT NULL DEFAULT '',
+            unit TEXT NOT NULL,
+            dimension TEXT NOT NULL,
+            factor REAL NOT NULL CHECK (factor > 0),
+            PRIMARY KEY (unit, item)
+        )
+    ''')
+    cursor.executemany('''
+        INSERT OR IGNORE INTO unit_conversions (item, unit, dimension, factor) VALUES ('', ?, ?, ?)
+    ''', [
+        ('kg', 'mass', 1000.0),
+        ('lbs', 'mass', 453.59237),
+        ('pieces', 'count', 1.0),
+        # Without an item-specific conversion these only match themselves
+        ('pack', 'pack', 1.0),
+        ('box', 'box', 1.0),
+        ('bottle', 'bottle', 1.0),
+    ])
+
+    cursor.execute('ALTER TABLE grocery_lists ADD COLUMN dimension TEXT')
+    cursor.execute('ALTER TABLE grocery_lists ADD COLUMN base_quantity REAL')
+
+    # Bulk inserts compute the columns up front and skip the extra UPDATE
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS grocery_lists_canonical_insert
+        AFTER INSERT ON grocery_lists
+        WHEN NEW.dimension IS NULL
+        BEGIN {_CANONICALIZE} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS grocery_lists_canonical_update
+        AFTER UPDATE OF item, quantity, unit ON grocery_lists
+        BEGIN {_CANONICALIZE} END
+    ''')
+    # Fires the update trigger for every existing row
+    cursor.execute('UPDATE grocery_lists SET unit = unit')
+
+    cursor.execute('DROP INDEX IF EXISTS idx_grocery_lists_user_item')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_grocery_lists_user_item_dimension
+        ON grocery_lists (username, item, dimension, base_quantity, quantity, unit)
+    ''')
+    # re-canonicalizing rows after a conversion changes
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_grocery_lists_unit ON grocery_lists (unit)')
+
+
+def _add_item_trigram_index(cursor):
+    """Version 4: trigram inverted index over item names for fuzzy matching.
+
+    Item names are folded into normalized keys (see fuzzy.item_key) and the
+    index is kept per distinct key rather than per grocery row, so popular
+    items such as "milk" are indexed once however many lists contain them.
+    Keys are never deleted, so writers may cache their ids.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS item_keys (
+            key_id INTEGER PRIMARY KEY,
+            key TEXT NOT NULL UNIQUE,
+            trigram_count INTEGER NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS key_trigrams (
+            trigram TEXT NOT NULL,
+            key_id INTEGER NOT NULL,
+            PRIMARY KEY (trigram, key_id)
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_key_trigrams_key ON key_trigrams (key_id)')
+
+    cursor.execute('ALTER TABLE grocery_lists ADD COLUMN item_key_id INTEGER REFERENCES item_keys(key_id)')
+    # Extend the covering per-user index rather than adding a second index
+    # that every grocery insert would have to maintain
+    cursor.execute('DROP INDEX IF EXISTS idx_grocery_lists_user_item_dimension')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_grocery_lists_user_item_key
+        ON grocery_lists (username, item, dimension, base_quantity, quantity, unit, item_key_id)
+    ''')
+    key_ids = {}
+    updates = []
+    for row_id, item in cursor.execute('SELECT id, item FROM grocery_lists').fetchall():
+        key = item_key(str(item or ''))
+        if key not in key_ids:
+            trigrams = item_trigrams(key)
+            cursor.execute('INSERT INTO item_keys (key, trigram_count) VALUES (?, ?)', (key, len(trigrams)))
+            key_ids[key] = cursor.lastrowid
+            cursor.executemany('INSERT INTO key_trigrams (trigram, key_id) VALUES (?, ?)',
+                               [(trigram, key_ids[key]) for trigram in trigrams])
+        updates.append((key_ids[key], row_id))
+    cursor.executemany('UPDATE grocery_lists SET item_key_id = ? WHERE id = ?', updates)
+
+
+def _add_purchase_pools(cursor):
+    """Version 5: replace pairwise purchase_tracking with N-member purchase pools.
+
+    A pool is one purchase of an item by one buyer, shared by any number of
+    members. Each member row holds the member's quantity in the item's base
+    unit and, once settled, their share of the price. Triggers keep the
+    pool's ``total_quantity`` and ``member_count`` current, so joining,
+    leaving and settling never re-aggregate the member table.
+
+    Open pairwise rows for the same item and buyer were one purchase split
+    across several pairs, so they are merged into a single pool; completed
+    rows become one pool each with their recorded shares.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purchase_pools (
+            pool_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            item TEXT NOT NULL,
+            buyer TEXT,
+            total_price REAL,
+            total_quantity REAL NOT NULL DEFAULT 0,
+            member_count INTEGER NOT NULL DEFAULT 0,
+            is_purchased BOOLEAN NOT NULL DEFAULT 0,
+            FOREIGN KEY(buyer) REFERENCES users(username)
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pool_members (
+            pool_id INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            quantity REAL NOT NULL DEFAULT 0,
+            share REAL,
+            PRIMARY KEY (pool_id, username),
+            FOREIGN KEY(pool_id) REFERENCES purchase_pools(pool_id),
+            FOREIGN KEY(username) REFERENCES users(username)
+        ) WITHOUT ROWID
+    ''')
+    # a member's pools: history, ongoing purchases and exports
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pool_members_user ON pool_members (username, pool_id)')
+    # get_tracked_purchase_items
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_pools_buyer
+        ON purchase_pools (buyer, is_purchased, item)
+    ''')
+    # finding the open pool for an item
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_pools_item
+        ON purchase_pools (item, is_purchased, buyer)
+    ''')
+
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pool_members_insert
+        AFTER INSERT ON pool_members
+        BEGIN
+            UPDATE purchase_pools SET
+                total_quantity = total_quantity + NEW.quantity,
+                member_count = member_count + 1
+            WHERE pool_id = NEW.pool_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pool_members_update
+        AFTER UPDATE OF quantity ON pool_members
+        BEGIN
+            UPDATE purchase_pools SET total_quantity = total_quantity - OLD.quantity + NEW.quantity
+            WHERE pool_id = NEW.pool_id;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pool_members_delete
+        AFTER DELETE ON pool_members
+        BEGIN
+            UPDATE purchase_pools SET
+                total_quantity = total_quantity - OLD.quantity,
+                member_count = member_count - 1
+            WHERE pool_id = OLD.pool_id;
+        END
+    ''')
+
+    pool_ids = {}
+    members = {}
+    for (match_id, item, buyer, total_price, is_purchased,
+         user1, user2, user1_share, user2_share) in cursor.execute('''
+            SELECT match_id, item, buyer, total_price, is_purchased,
+                   user1, user2, user1_share, user2_share
+            FROM purchase_tracking ORDER BY match_id
+    ''').fetchall():
+        key = ('settled', match_id) if is_purchased else ('open', item, buyer)
+        if key not in pool_ids:
+            # Keep the oldest match_id so existing references stay valid
+            cursor.execute('''
+                INSERT INTO purchase_pools (pool_id, item, buyer, total_price, is_purchased)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (match_id, item or '', buyer, total_price if is_purchased else None, bool(is_purchased)))
+            pool_ids[key] = match_id
+        for username, share in ((user1, user1_share), (user2, user2_share)):
+            if username is not None:
+                # Open pools take each member's quantity from their grocery list, as join_pool does
+                members.setdefault((pool_ids[key], username), (None if is_purchased else item, share))
+    cursor.executemany('''
+        INSERT INTO pool_members (pool_id, username, quantity, share)
+        VALUES (?, ?, (
+            SELECT COALESCE(SUM(base_quantity), 0) FROM grocery_lists WHERE username = ? AND item = ?
+        ), ?)
+    ''', [(pool_id, username, username, item, share)
+          for (pool_id, username), (item, share) in members.items()])
+
+    cursor.execute('DROP TABLE purchase_tracking')
+
+
+def _add_balance_ledger(cursor):
+    """Version 6: running balances between every pair of users.
+
+    Each pair is stored once, ordered so that ``user1 < user2``; ``amount``
+    is what user1 owes user2 and is negative when user2 owes user1.
+    Settling a pool adds every member's share to their balance with the
+    buyer and recording a payment subtracts it, so reading a balance never
+    looks at the purchase history. ``payments`` keeps the transfers made to
+    settle up.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS balances (
+            user1 TEXT NOT NULL,
+            user2 TEXT NOT NULL,
+            amount REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (user1, user2),
+            CHECK (user1 < user2),
+            FOREIGN KEY(user1) REFERENCES users(username),
+            FOREIGN KEY(user2) REFERENCES users(username)
+        ) WITHOUT ROWID
+    ''')
+    # the user2 side of a user's balances
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_balances_user2 ON balances (user2, user1, amount)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS payments (
+            payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            payer TEXT NOT NULL,
+            payee TEXT NOT NULL,
+            amount REAL NOT NULL CHECK (amount > 0),
+            FOREIGN KEY(payer) REFERENCES users(username),
+            FOREIGN KEY(payee) REFERENCES users(username)
+        )
+    ''')
+
+    cursor.execute('''
+        INSERT INTO balances (user1, user2, amount)
+        SELECT MIN(m.username, p.buyer), MAX(m.username, p.buyer),
+               SUM(CASE WHEN m.username < p.buyer THEN m.share ELSE -m.share END)
+        FROM purchase_pools p
+        JOIN pool_members m ON m.pool_id = p.pool_id
+        WHERE p.is_purchased = 1 AND m.username != p.buyer AND m.share IS NOT NULL
+        GROUP BY 1, 2
+    ''')
+
+
+def _add_feed_indexes(cursor):
+    """Version 7: indexes for keyset-paginated purchase feeds.
+
+    A member's settled and open pools are listed newest first, a page at a
+    time, by seeking to ``pool_id < cursor`` in an index. ``pool_members``
+    gets its own copy of ``is_purchased``, kept current by a trigger, so
+    that one index range holds exactly the pools a feed shows and the first
+    page does not read past years of settled history to find open pools.
+    """
+    cursor.execute('ALTER TABLE pool_members ADD COLUMN is_purchased BOOLEAN NOT NULL DEFAULT 0')
+    cursor.execute('''
+        UPDATE pool_members SET is_purchased = 1
+        WHERE pool_id IN (SELECT pool_id FROM purchase_pools WHERE is_purchased = 1)
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS purchase_pools_status
+        AFTER UPDATE OF is_purchased ON purchase_pools
+        BEGIN
+            UPDATE pool_members SET is_purchased = NEW.is_purchased WHERE pool_id = NEW.pool_id;
+        END
+    ''')
+
+    cursor.execute('DROP INDEX IF EXISTS idx_pool_members_user')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_pool_members_user_status
+        ON pool_members (username, is_purchased, pool_id)
+    ''')
+    cursor.execute('DROP INDEX IF EXISTS idx_purchase_pools_buyer')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_purchase_pools_buyer_status
+        ON purchase_pools (buyer, is_purchased, pool_id)
+    ''')
+
+
+def _refresh_matches(username: str, item: str) -> str:
+    """Trigger statements that recompute every ``matches`` row for one (username, item).
+
+    ``username`` and ``item`` are SQL expressions such as ``NEW.username``.
+    Rows are re-read from ``grocery_lists`` rather than taken from NEW, so
+    the result is the same whichever order this and the canonical-quantity
+    triggers fire in.
+    """
+    return f'''
+        -- The user's own rows, against each friend's earliest row
+        DELETE FROM matches
+        WHERE username = {username} AND item = {item} AND
+            friend IN (SELECT user2 FROM friends WHERE user1 = {username});
+        INSERT INTO matches (username, friend, item, grocery_id, user_quantity, friend_quantity, unit)
+        SELECT g1.username, f.user2, g1.item, g1.id, g1.quantity,
+               g2.base_quantity * g1.quantity / NULLIF(g1.base_quantity, 0), g1.unit
+        FROM grocery_lists g1
+        JOIN friends f ON f.user1 = g1.username
+        JOIN grocery_lists g2 ON g2.rowid = (
+            SELECT MIN(rowid) FROM grocery_lists
+            WHERE username = f.user2 AND item = g1.item AND dimension = g1.dimension
+        )
+        WHERE g1.username = {username} AND g1.item = {item};
+        -- Rows of everyone who has the user as a friend, against the user's earliest row
+        DELETE FROM matches
+        WHERE friend = {username} AND item = {item} AND
+            username IN (SELECT user1 FROM friends WHERE user2 = {username});
+        INSERT INTO matches (username, friend, item, grocery_id, user_quantity, friend_quantity, unit)
+        SELECT g1.username, f.user2, g1.item, g1.id, g1.quantity,
+               g2.base_quantity * g1.quantity / NULLIF(g1.base_quantity, 0), g1.unit
+        FROM friends f
+        JOIN grocery_lists g1 ON g1.username = f.user1 AND g1.item = {item}
+        JOIN grocery_lists g2 ON g2.rowid = (
+            SELECT MIN(rowid) FROM grocery_lists
+            WHERE username = f.user2 AND item = g1.item AND dimension = g1.dimension
+        )
+        WHERE f.user2 = {username};
+    '''
+
+
+def _add_materialized_matches(cursor):
+    """Version 8: a ``matches`` table holding every user's matches against each friend.
+
+    One row per (user, friend, grocery row of the user) whose item the
+    friend also lists in the same dimension, with the friend's quantity,
+    taken from their earliest such row, converted into the user's unit.
+    Triggers on ``grocery_lists`` and ``friends`` recompute only the
+    (user, item) and (user, friend) groups a write touches, so reading a
+    user's matches is one primary-key range scan.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS matches (
+            username TEXT NOT NULL,
+            friend TEXT NOT NULL,
+            item TEXT NOT NULL,
+            grocery_id INTEGER NOT NULL,
+            user_quantity REAL,
+            friend_quantity REAL,
+            unit TEXT,
+            PRIMARY KEY (username, friend, item, grocery_id)
+        ) WITHOUT ROWID
+    ''')
+    # Users who have a given user as a friend
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_friends_user2 ON friends (user2, user1)')
+
+    # Rows inserted without canonical columns are handled when
+    # grocery_lists_canonical_insert fills them in
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS grocery_lists_matches_insert
+        AFTER INSERT ON grocery_lists
+        WHEN NEW.dimension IS NOT NULL
+        BEGIN {_refresh_matches('NEW.username', 'NEW.item')} END
+    ''')
+    # Re-canonicalizing rows whose conversion did not change is a no-op
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS grocery_lists_matches_update
+        AFTER UPDATE OF username, item, quantity, unit, dimension, base_quantity ON grocery_lists
+        WHEN OLD.username IS NOT NEW.username OR OLD.item IS NOT NEW.item OR
+            OLD.quantity IS NOT NEW.quantity OR OLD.unit IS NOT NEW.unit OR
+            OLD.dimension IS NOT NEW.dimension OR OLD.base_quantity IS NOT NEW.base_quantity
+        BEGIN {_refresh_matches('NEW.username', 'NEW.item')} END
+    ''')
+    # A row renamed or moved to another user also leaves its old group
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS grocery_lists_matches_move
+        AFTER UPDATE OF username, item ON grocery_lists
+        WHEN OLD.username IS NOT NEW.username OR OLD.item IS NOT NEW.item
+        BEGIN {_refresh_matches('OLD.username', 'OLD.item')} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS grocery_lists_matches_delete
+        AFTER DELETE ON grocery_lists
+        BEGIN {_refresh_matches('OLD.username', 'OLD.item')} END
+    ''')
+
+    add_friend = '''
+        INSERT INTO matches (username, friend, item, grocery_id, user_quantity, friend_quantity, unit)
+        SELECT g1.username, NEW.user2, g1.item, g1.id, g1.quantity,
+               g2.base_quantity * g1.quantity / NULLIF(g1.base_quantity, 0), g1.unit
+        FROM grocery_lists g1
+        JOIN grocery_lists g2 ON g2.rowid = (
+            SELECT MIN(rowid) FROM grocery_lists
+            WHERE username = NEW.user2 AND item = g1.item AND dimension = g1.dimension
+        )
+        WHERE g1.username = NEW.user1;
+    '''
+    remove_friend = 'DELETE FROM matches WHERE username = OLD.user1 AND friend = OLD.user2;'
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS friends_matches_insert
+        AFTER INSERT ON friends
+        BEGIN {add_friend} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS friends_matches_update
+        AFTER UPDATE ON friends
+        BEGIN {remove_friend} {add_friend} END
+    ''')
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS friends_matches_delete
+        AFTER DELETE ON friends
+        BEGIN {remove_friend} END
+    ''')
+
+    cursor.execute('''
+        INSERT INTO matches (username, friend, item, grocery_id, user_quantity, friend_quantity, unit)
+        SELECT f.user1, f.user2, g1.item, g1.id, g1.quantity,
+               g2.base_quantity * g1.quantity / NULLIF(g1.base_quantity, 0), g1.unit
+        FROM friends f
+        JOIN grocery_lists g1 ON g1.username = f.user1
+        JOIN grocery_lists g2 ON g2.rowid = (
+            SELECT MIN(rowid) FROM grocery_lists
+            WHERE username = f.user2 AND item = g1.item AND dimension = g1.dimension
+        )
+    ''')
+
+
+def _add_change_log(cursor):
+    """Version 9: an append-only log of every change made through DatabaseManager.
+
+    Each mutating method adds one row per user whose data it changed, in
+    the same transaction as the change; ``username`` is NULL for changes
+    that affect every user, such as a new unit conversion. ``seq`` comes
+    from AUTOINCREMENT, so it only grows, and writers are serialized, so a
+    reader never sees a change before one with a lower ``seq``. Polling a
+    user's changes since a ``seq`` seeks one index range per friend, and
+    costs the same however long the log gets.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            kind TEXT NOT NULL,
+            data TEXT NOT NULL DEFAULT '{}',
+            FOREIGN KEY(username) REFERENCES users(username)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_change_log_user ON change_log (username, seq)')
+
+
+def _add_grocery_item_key(cursor):
+    """Version 10: at most one grocery row per (username, item, unit).
+
+    Adding an item the user already lists in the same unit now adds to its
+    quantity instead of inserting a second row, so rows have stable ids
+    that edits and removals can address. Existing duplicates are merged
+    into their oldest row, which keeps the summed quantity; the canonical
+    and matches triggers update the merged rows as usual.
+    """
+    cursor.execute('''
+        UPDATE grocery_lists SET quantity = (
+            SELECT SUM(g.quantity) FROM grocery_lists g
+            -- GROUP BY puts NULLs together, so compare the same way
+            WHERE g.username IS grocery_lists.username AND g.item IS grocery_lists.item AND
+                g.unit IS grocery_lists.unit
+        )
+        WHERE id IN (
+            SELECT MIN(id) FROM grocery_lists
+            GROUP BY username, item, unit
+            HAVING COUNT(*) > 1
+        )
+    ''')
+    cursor.execute('''
+        DELETE FROM grocery_lists
+        WHERE id NOT IN (SELECT MIN(id) FROM grocery_lists GROUP BY username, item, unit)
+    ''')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_grocery_lists_user_item_unit
+        ON grocery_lists (username, item, unit)
+    ''')
+
+
+def _add_pool_claims(cursor):
+    """Version 11: at most one open pool per item and buyer, and first-claimer-wins pair claims.
+
+    ``pool_claims`` records which buyer a pair of friends chose for an item,
+    stored once per pair with ``user1 <= user2`` like ``balances``. The
+    first claim of a pair sticks until that buyer's pool settles or either
+    friend leaves it, so two friends pressing "I'll Buy" at once end up in
+    one pool. A partial unique index lets a buyer's open pool for an item
+    be found or created in one upsert. Open pools that already share an
+    item and buyer are merged into the oldest, and claims are backfilled
+    from the buyer and members of each open pool, oldest pool first.
+    """
+    open_duplicates = '''
+        SELECT pool_id, (
+            SELECT MIN(o.pool_id) FROM purchase_pools o
+            WHERE o.item = p.item AND o.buyer IS p.buyer AND o.is_purchased = 0
+        ) AS keep
+        FROM purchase_pools p WHERE is_purchased = 0
+    '''
+    cursor.execute(f'''
+        INSERT INTO pool_members (pool_id, username, quantity)
+        SELECT d.keep, m.username, m.quantity
+        FROM ({open_duplicates}) d JOIN pool_members m ON m.pool_id = d.pool_id
+        WHERE d.pool_id != d.keep
+        ON CONFLICT (pool_id, username) DO UPDATE SET quantity = MAX(quantity, excluded.quantity)
+    ''')
+    cursor.execute(f'''
+        CREATE TEMP TABLE merged_pools AS
+        SELECT pool_id FROM ({open_duplicates}) WHERE pool_id != keep
+    ''')
+    cursor.execute('DELETE FROM pool_members WHERE pool_id IN (SELECT pool_id FROM temp.merged_pools)')
+    cursor.execute('DELETE FROM purchase_pools WHERE pool_id IN (SELECT pool_id FROM temp.merged_pools)')
+    cursor.execute('DROP TABLE temp.merged_pools')
+    cursor.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_purchase_pools_open
+        ON purchase_pools (item, COALESCE(buyer, '')) WHERE is_purchased = 0
+    ''')
+
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pool_claims (
+            item TEXT NOT NULL,
+            user1 TEXT NOT NULL,
+            user2 TEXT NOT NULL,
+            buyer TEXT,
+            PRIMARY KEY (item, user1, user2),
+            CHECK (user1 <= user2),
+            FOREIGN KEY(user1) REFERENCES users(username),
+            FOREIGN KEY(user2) REFERENCES users(username),
+            FOREIGN KEY(buyer) REFERENCES users(username)
+        ) WITHOUT ROWID
+    ''')
+    # releasing the claims on a buyer's pool
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_pool_claims_buyer ON pool_claims (buyer, item)')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pool_claims_settle
+        AFTER UPDATE OF is_purchased ON purchase_pools
+        WHEN NEW.is_purchased
+        BEGIN
+            DELETE FROM pool_claims WHERE buyer IS NEW.buyer AND item = NEW.item;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS pool_claims_leave
+        AFTER DELETE ON pool_members
+        BEGIN
+            DELETE FROM pool_claims
+            WHERE buyer IS (SELECT buyer FROM purchase_pools WHERE pool_id = OLD.pool_id) AND
+                item = (SELECT item FROM purchase_pools WHERE pool_id = OLD.pool_id) AND
+                OLD.username IN (user1, user2);
+        END
+    ''')
+    cursor.execute('''
+        INSERT OR IGNORE INTO pool_claims (item, user1, user2, buyer)
+        SELECT p.item, MIN(p.buyer, m.username), MAX(p.buyer, m.username), p.buyer
+        FROM purchase_pools p JOIN pool_members m ON m.pool_id = p.pool_id
+        WHERE p.is_purchased = 0 AND m.username != p.buyer
+        ORDER BY p.pool_id
+    ''')
+
+
+def _add_bulk_loads(cursor):
+    """Version 12: let bulk inserts skip the per-row canonical and matches triggers.
+
+    A writer adding many rows for one user inserts the user into
+    ``bulk_loads``, computes the canonical columns itself, and refreshes
+    the matches of every item it touched with one set-based statement per
+    direction before removing the user again. Rows only ever exist inside
+    that writer's transaction, so every other write still fires the
+    triggers, which now check the (empty) table first.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bulk_loads (
+            username TEXT PRIMARY KEY
+        ) WITHOUT ROWID
+    ''')
+    skip = 'NEW.username NOT IN (SELECT username FROM bulk_loads)'
+    cursor.execute('DROP TRIGGER IF EXISTS grocery_lists_canonical_update')
+    cursor.execute(f'''
+        CREATE TRIGGER grocery_lists_canonical_update
+        AFTER UPDATE OF item, quantity, unit ON grocery_lists
+        WHEN {skip}
+        BEGIN {_CANONICALIZE} END
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS grocery_lists_matches_insert')
+    cursor.execute(f'''
+        CREATE TRIGGER grocery_lists_matches_insert
+        AFTER INSERT ON grocery_lists
+        WHEN NEW.dimension IS NOT NULL AND {skip}
+        BEGIN {_refresh_matches('NEW.username', 'NEW.item')} END
+    ''')
+    cursor.execute('DROP TRIGGER IF EXISTS grocery_lists_matches_update')
+    cursor.execute(f'''
+        CREATE TRIGGER grocery_lists_matches_update
+        AFTER UPDATE OF username, item, quantity, unit, dimension, base_quantity ON grocery_lists
+        WHEN (OLD.username IS NOT NEW.username OR OLD.item IS NOT NEW.item OR
+            OLD.quantity IS NOT NEW.quantity OR OLD.unit IS NOT NEW.unit OR
+            OLD.dimension IS NOT NEW.dimension OR OLD.base_quantity IS NOT NEW.base_quantity) AND {skip}
+        BEGIN {_refresh_matches('NEW.username', 'NEW.item')} END
+    ''')
+
+
+def _add_trigram_counts(cursor):
+    """Version 13: count the keys each trigram appears in.
+
+    Fuzzy matching looks candidates up through a key's rarer trigrams only
+    and skips the postings of its most common ones, which make up most of
+    the index. A trigger keeps the counts in step with ``key_trigrams``;
+    they only order the lookups, so a count that drifts costs speed, never
+    a match.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS trigram_counts (
+            trigram TEXT PRIMARY KEY,
+            key_count INTEGER NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+        INSERT INTO trigram_counts (trigram, key_count)
+        SELECT trigram, COUNT(*) FROM key_trigrams GROUP BY trigram
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS key_trigrams_count_insert
+        AFTER INSERT ON key_trigrams
+        BEGIN
+            INSERT INTO trigram_counts (trigram, key_count) VALUES (NEW.trigram, 1)
+            ON CONFLICT (trigram) DO UPDATE SET key_count = key_count + 1;
+        END
+    ''')
+
+
+# (version, upgrade) pairs in ascending order. Never edit a migration that
+# has shipped; append a new one instead.
+MIGRATIONS = [
+    (1, _create_base_tables),
+    (2, _add_query_indexes),
+    (3, _add_canonical_quantities),
+    (4, _add_item_trigram_index),
+    (5, _add_purchase_pools),
+    (6, _add_balance_ledger),
+    (7, _add_feed_indexes),
+    (8, _add_materialized_matches),
+    (9, _add_change_log),
+    (10, _add_grocery_item_key),
+    (11, _add_pool_claims),
+    (12, _add_bulk_loads),
+    (13, _add_trigram_counts),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    """Return the schema version recorded in the database file."""
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn: sqlite3.Connection) -> int:
+    """Apply every pending migration and return the resulting schema version."""
+    version = get_schema_version(conn)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'Database schema version {version} is newer than '
+                           f'this application supports ({SCHEMA_VERSION})')
+
+    for target, upgrade in MIGRATIONS:
+        if target <= version:
+            continue
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            upgrade(cursor)
+            # PRAGMA does not accept bound parameters
+            cursor.execute(f'PRAGMA user_version = {int(target)}')
+            cursor.execute('COMMIT')
+        except Exception:
+            if conn.in_transaction:
+                cursor.execute('ROLLBACK')
+            raise
+        version = target
+
+    return version
+
+
+def main(paths):
+    for path in paths:
+        conn = sqlite3.connect(path)
+        try:
+            before = get_schema_version(conn)
+            after = migrate(conn)
+        finally:
+            conn.close()
+        print(f'{path}: schema version {before} -> {after}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit(f'usage: {sys.argv[0]} DATABASE [DATABASE ...]')
+    main(sys.argv[1:])
@@ -1,8 +1,101 @@
-from typing import List, Dict
+from typing import List, Dict, NamedTuple, Optional
 import hashlib
 
+# Units offered on the Grocery List page and accepted by bulk imports
+UNITS = ['kg', 'lbs', 'pieces', 'pack', 'box', 'bottle']
+
 class User:
     @staticmethod
     def hash_password(password: str) -> str:
         """Hash password for secure storage."""
         return hashlib.sha256(password.encode()).hexdigest()
+
+
+# Rows are NamedTuples: immutable, typed and, having no per-instance
+# __dict__, no bigger than the plain tuples sqlite3 returns
+
+class GroceryItem(NamedTuple):
+    item: str
+    quantity: float
+    unit: str
+    # grocery_lists.id, for editing or removing this row
+    id: int
+
+
+class Match(NamedTuple):
+    """An item the user and a friend both want, in the user's unit."""
+    item: str
+    user_quantity: float
+    friend_quantity: float
+    unit: str
+
+
+class FuzzyMatch(NamedTuple):
+    """A Match between similarly named items; the first four fields are Match's."""
+    item: str
+    user_quantity: float
+    friend_quantity: float
+    unit: str
+    # The friend's name for the item
+    friend_item: str
+    similarity: float
+
+
+class MatchesDiff(NamedTuple):
+    """Differences between the materialized matches table and a rebuild from scratch.
+
+    Rows are (username, friend, item, grocery_id, user_quantity,
+    friend_quantity, unit), as stored in ``matches``.
+    """
+    # Rows a rebuild would add
+    missing: List[tuple]
+    # Rows a rebuild would remove
+    unexpected: List[tuple]
+
+class Purchase(NamedTuple):
+    """A settled purchase pool."""
+    pool_id: int
+    item: str
+    buyer: Optional[str]
+    total_price: float
+    # member -> their share of total_price
+    shares: Dict[str, float]
+
+
+class Change(NamedTuple):
+    """One entry of the change log, as from DatabaseManager.get_changes."""
+    seq: int
+    # The user whose data changed; None when it affects every user
+    username: Optional[str]
+    kind: str
+    data: Dict
+
+class Page(NamedTuple):
+    """One page of a keyset-paginated feed, newest first."""
+    rows: List[tuple]
+    # Pass as ``before`` to fetch the next page; None on the last page
+    next_cursor: Optional[int]
+
+
+class MatchesSnapshot(NamedTuple):
+    """Everything the Matches page renders, read in one transaction."""
+    grocery_items: List[GroceryItem]
+    # First page of (pool_id, buyer, item), as from DatabaseManager.get_ongoing_purchases_page
+    ongoing_purchases: Page
+    friends: List[str]
+    tracked_purchase_items: List[str]
+    # friend -> their matches, as from DatabaseManager.find_matching_groceries
+    matches: Dict[str, List[Match]]
+
+
+class MoveReport(NamedTuple):
+    """The outcome of ShardRouter.move_community."""
+    community: str
+    source: str
+    target: str
+    users: int
+    # Copies made, including the last catch-up while writes were held back
+    rounds: int
+    total_ms: float
+    # How long the community's writes were held back
+    paused_ms: float
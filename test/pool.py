@@ -0,0 +1,146 @@
+"""Thread-safe SQLite connection pool.
+
+Connections are checked out per operation instead of being shared across
+Streamlit session threads. File databases run in WAL journal mode so that
+readers proceed in parallel with the single writer.
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Optional
+
+from instrumentation import InstrumentedConnection, QueryStats
+
+
+class ConnectionPool:
+    def __init__(self, db_path: str, max_connections: int = 8, busy_timeout_ms: int = 5000,
+                 synchronous: str = 'NORMAL', checkout_timeout: float = 30.0,
+                 stats: Optional[QueryStats] = None):
+        """Create a pool of at most ``max_connections`` connections to ``db_path``.
+
+        ``synchronous = NORMAL`` is durable across application crashes in WAL
+        mode and only fsyncs at checkpoints, which is the recommended setting
+        for WAL databases. With ``stats``, every statement run on the pool's
+        connections is recorded there (see instrumentation.py).
+        """
+        self.db_path = db_path
+        self.in_memory = db_path == ':memory:' or 'mode=memory' in db_path
+        # Every connection to ':memory:' is a separate database, so an
+        # in-memory pool hands out one shared connection.
+        self.max_connections = 1 if self.in_memory else max_connections
+        self.busy_timeout_ms = busy_timeout_ms
+        self.synchronous = synchronous
+        self.checkout_timeout = checkout_timeout
+        self.stats = stats
+
+        self._idle = queue.LifoQueue()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._trace_callback = None
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None leaves transaction control to transaction()
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                               timeout=self.busy_timeout_ms / 1000,
+                               factory=sqlite3.Connection if self.stats is None else InstrumentedConnection)
+        if self.stats is not None:
+            conn.stats = self.stats
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        if not self.in_memory:
+            conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.set_trace_callback(self._trace_callback)
+        return conn
+
+    def _checkout(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if len(self._connections) < self.max_connections:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+
+        try:
+            return self._idle.get(timeout=self.checkout_timeout)
+        except queue.Empty:
+            raise sqlite3.OperationalError('Timed out waiting for a database connection') from None
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection for the duration of the ``with`` block.
+
+        Re-entrant: nested calls on the same thread reuse the connection that
+        is already checked out, so helpers can be composed inside a
+        transaction.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._checkout()
+        self._local.conn = conn
+        self._local.depth = 0
+        try:
+            yield conn
+        finally:
+            self._local.conn = None
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put(conn)
+
+    @contextmanager
+    def transaction(self, immediate: bool = True):
+        """Run the ``with`` block in a transaction and commit it on success.
+
+        Writers take the write lock up front (``BEGIN IMMEDIATE``) so that they
+        wait on ``busy_timeout`` instead of failing on lock upgrade. Pass
+        ``immediate=False`` for a read-only snapshot. Nested transactions
+        become savepoints of the enclosing one.
+        """
+        with self.connection() as conn:
+            depth = self._local.depth
+            savepoint = f'sp_{depth}'
+            if depth == 0:
+                conn.execute('BEGIN IMMEDIATE' if immediate else 'BEGIN')
+            else:
+                conn.execute(f'SAVEPOINT {savepoint}')
+            self._local.depth = depth + 1
+            try:
+                yield conn
+            except BaseException:
+                if depth == 0:
+                    conn.rollback()
+                else:
+                    conn.execute(f'ROLLBACK TO {savepoint}')
+                    conn.execute(f'RELEASE {savepoint}')
+                raise
+            else:
+                conn.execute('COMMIT' if depth == 0 else f'RELEASE {savepoint}')
+            finally:
+                self._local.depth = depth
+
+    def in_transaction(self) -> bool:
+        """Return whether this thread is inside a ``transaction()`` block."""
+        return getattr(self._local, 'depth', 0) > 0
+
+    def set_trace_callback(self, callback):
+        """Install ``callback`` as the SQL trace callback on every connection."""
+        with self._lock:
+            self._trace_callback = callback
+            for conn in self._connections:
+                conn.set_trace_callback(callback)
+
+    def close(self):
+        """Close every connection owned by the pool."""
+        with self._lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+            self._idle = queue.LifoQueue()
@@ -0,0 +1,114 @@
+"""Fail if any query issued by DatabaseManager falls back to a table scan.
+
+Every public ``DatabaseManager`` method is exercised against a small
+in-memory database while the executed statements are traced. Each traced
+statement is then run through ``EXPLAIN QUERY PLAN``. Run from the ``test``
+directory::
+
+    python query_plans.py
+"""
+import re
+import sys
+from typing import List, Tuple
+
+from database import DatabaseManager
+
+# Plan steps that read a whole table (or a whole index) instead of seeking.
+# Scans of subquery and CTE results are checked through their own steps.
+_SCAN = re.compile(r'^SCAN (?!CONSTANT ROW|\(subquery-)(\w+)')
+_CTE_NAME = re.compile(r'(\w+)\s*(?:\([^)]*\))?\s+AS\s*(?:MATERIALIZED\s*)?\(', re.I)
+# Small configuration tables that are meant to be read in full, and
+# table-valued functions over a bound parameter.
+_SCANNABLE = re.compile(r'^SCAN (unit_conversions\b|json_each VIRTUAL TABLE)')
+_EXPLAINABLE = re.compile(r'^\s*(SELECT|UPDATE|DELETE|WITH|INSERT\b.*\bSELECT\b)', re.I | re.S)
+
+
+def exercise(db: DatabaseManager):
+    """Call every query-issuing DatabaseManager method at least once."""
+    db.register_user('alice', 'x', 'alice@example.com')
+    db.register_user('bob', 'x', 'bob@example.com')
+    db.login_user('alice', 'x')
+    db.user_exists('bob')
+    db.add_friend('alice', 'bob')
+    db.get_friends('alice')
+    db.add_grocery_item('alice', 'apple', 1.0, 'kg')
+    db.add_grocery_item('bob', 'apple', 2.0, 'kg')
+    db.add_grocery_items('bob', [('pear', 1.0, 'kg')])
+    grocery_id = db.add_grocery_item('alice', 'pear', 1.0, 'kg')
+    grocery_id = db.update_grocery_item('alice', grocery_id, 'pear', 2.0, 'lbs')
+    db.add_grocery_item('alice', 'plum', 1.0, 'kg')
+    grocery_id = db.update_grocery_item('alice', grocery_id, 'plum', 1.0, 'kg')
+    db.get_grocery_items('alice')
+    db.find_matching_groceries('alice')
+    db.find_matching_items('alice', 'bob')
+    db.check_matches('alice')
+    db.find_fuzzy_matches('alice', 0.5)
+    db.get_extended_network('alice', 3)
+    db.find_network_matches('alice', 3)
+    pool_id = db.track_matched_item_purchase('apple', 'alice', 'bob', 'alice')
+    db.track_matched_item_purchase('apple', 'bob', 'alice', 'bob')
+    db.join_pool(pool_id, 'carol', 500.0)
+    db.leave_pool(pool_id, 'carol')
+    db.get_ongoing_purchases('bob')
+    db.get_tracked_purchase_items('bob')
+    db.get_matches_snapshot('alice')
+    db.get_pool(pool_id)
+    db.get_open_pools_page('alice')
+    list(db.iter_open_pools('alice'))
+    page = db.get_ongoing_purchases_page('bob', None, 1)
+    db.get_ongoing_purchases_page('bob', page.next_cursor, 1)
+    db.settle_pool(pool_id, 4.0)
+    db.get_balance('bob', 'alice')
+    db.get_balances('alice')
+    db.settle_up(['alice', 'bob'])
+    db.record_payment('bob', 'alice', 2.0)
+    db.get_purchase_history('alice')
+    db.get_purchase_history_page('alice', 10)
+    list(db.iter_grocery_items('bob'))
+    list(db.iter_purchase_history('alice'))
+    db.add_unit_conversion('pack', 12, 'pieces', 'eggs')
+    db.get_units()
+    db.remove_grocery_item('alice', 'apple')
+    db.remove_grocery_item_by_id('alice', grocery_id)
+    db.remove_friend('alice', 'bob')
+    db.get_changes('bob', db.get_change_seq() - 10)
+
+
+def find_table_scans() -> List[Tuple[str, str]]:
+    """Return (statement, plan step) pairs for every scanning plan step."""
+    db = DatabaseManager(':memory:')
+    statements = []
+    db.pool.set_trace_callback(statements.append)
+    try:
+        exercise(db)
+    finally:
+        db.pool.set_trace_callback(None)
+
+    problems = []
+    with db.pool.connection() as conn:
+        for statement in dict.fromkeys(statements):
+            if not _EXPLAINABLE.match(statement):
+                continue
+            ctes = set(_CTE_NAME.findall(statement))
+            for row in conn.execute('EXPLAIN QUERY PLAN ' + statement):
+                detail = row[-1]
+                scan = _SCAN.match(detail)
+                if scan and scan.group(1) not in ctes and not _SCANNABLE.match(detail):
+                    problems.append((' '.join(statement.split()), detail))
+    db.close_connection()
+    return problems
+
+
+def main() -> int:
+    problems = find_table_scans()
+    for statement, detail in problems:
+        print(f'{detail}\n    in: {statement}\n')
+    if problems:
+        print(f'FAIL: {len(problems)} plan step(s) scan a table')
+        return 1
+    print('OK: every DatabaseManager query uses an index')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
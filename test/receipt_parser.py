@@ -0,0 +1,131 @@
+"""Parse OCR'd receipt text and match its line items to open purchase pools.
+
+This module is plain Python; turning receipt images into text lives in
+``receipts.py``. Receipt lines look like::
+
+    ORGANIC BANANAS        1.99 F
+    2 @ 0.99
+    AVOCADO                1.98
+    COUPON                -0.50
+    TOTAL                  3.47
+
+A line ending in a price is an item unless its name is a known summary or
+payment line. Quantity lines ("2 @ 0.99", "1.52 lb @ 1.29") belong to the
+adjacent item whose price they multiply out to, and negative amounts are
+discounts on the item above them.
+"""
+import re
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+
+from fuzzy import similarity
+
+# Receipt names are abbreviated and OCR'd, so match more loosely than the
+# grocery-list fuzzy matching default
+RECEIPT_MATCH_THRESHOLD = 0.5
+
+# OCR reads decimal points as commas now and then
+_PRICE = r'-?\$?\s?\d{1,5}[.,]\d{2}'
+_PRICED_LINE = re.compile(rf'^(?P<name>.*?)\s*(?P<price>{_PRICE})\s*[A-Z*]{{0,2}}\s*$')
+_QUANTITY_LINE = re.compile(
+    rf'^\s*(?P<quantity>\d+(?:[.,]\d+)?)\s*(?P<unit>lbs?|kg|g|oz)?\s*(?:@|x|X)\s*(?P<unit_price>{_PRICE})'
+    r'\s*(?:/\s*\w+)?\s*(?:ea)?\s*')
+_TOTAL = re.compile(r'\b(?:total|amount due|balance due)\b', re.IGNORECASE)
+_NOT_AN_ITEM = re.compile(
+    r'\b(?:sub\s?total|tax|change|cash|visa|mastercard|amex|debit|credit|card|tender|'
+    r'balance(?!\s+due)|saving|saved|points|rounding)', re.IGNORECASE)
+
+
+class ReceiptLine(NamedTuple):
+    name: str
+    price: float
+    quantity: Optional[float] = None
+    unit: Optional[str] = None
+
+
+class ParsedReceipt(NamedTuple):
+    items: List[ReceiptLine]
+    total: Optional[float]
+    # Why the receipt could not be read, if it could not
+    error: Optional[str] = None
+
+
+class ReceiptMatch(NamedTuple):
+    pool_id: int
+    item: str
+    line: ReceiptLine
+    similarity: float
+
+
+def _amount(text: str) -> float:
+    return float(text.replace('$', '').replace(' ', '').replace(',', '.'))
+
+
+def parse_receipt_text(text: str) -> ParsedReceipt:
+    """Extract the priced line items and the total from a receipt's text."""
+    items = []
+    total = None
+    pending_quantity = None
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+
+        quantity_line = _QUANTITY_LINE.match(line)
+        if quantity_line:
+            quantity = _amount(quantity_line.group('quantity'))
+            unit = quantity_line.group('unit')
+            extended = quantity * _amount(quantity_line.group('unit_price'))
+            rest = line[quantity_line.end():]
+            priced = _PRICED_LINE.match(rest)
+            if priced and priced.group('name'):
+                # "2 @ 0.99 AVOCADO 1.98": the item follows on the same line
+                items.append(ReceiptLine(priced.group('name'), _amount(priced.group('price')), quantity, unit))
+            elif items and items[-1].quantity is None and abs(items[-1].price - round(extended, 2)) < 0.005:
+                items[-1] = items[-1]._replace(quantity=quantity, unit=unit)
+            else:
+                pending_quantity = (quantity, unit)
+            continue
+
+        priced = _PRICED_LINE.match(line)
+        if not priced:
+            continue
+        name, price = priced.group('name').strip(' .:-'), _amount(priced.group('price'))
+        if _TOTAL.search(name) and not _NOT_AN_ITEM.search(name):
+            total = price
+        elif _NOT_AN_ITEM.search(name) or not name:
+            continue
+        elif price < 0:
+            if items:
+                items[-1] = items[-1]._replace(price=round(items[-1].price + price, 2))
+        else:
+            quantity, unit = pending_quantity or (None, None)
+            items.append(ReceiptLine(name, price, quantity, unit))
+        pending_quantity = None
+
+    return ParsedReceipt(items, total)
+
+
+def match_receipt_items(receipts: Iterable[ParsedReceipt], pools: Iterable[Tuple[int, str]],
+                        threshold: float = RECEIPT_MATCH_THRESHOLD) -> List[ReceiptMatch]:
+    """Pair receipt lines with open (pool_id, item) pools by name similarity.
+
+    Pairs are assigned best first, so each pool and each receipt line is
+    used at most once.
+    """
+    lines = [line for receipt in receipts for line in receipt.items]
+    candidates = []
+    for pool_id, item in pools:
+        for index, line in enumerate(lines):
+            score = similarity(item, line.name)
+            if score >= threshold:
+                candidates.append((score, pool_id, item, index))
+
+    matches = []
+    used_pools, used_lines = set(), set()
+    for score, pool_id, item, index in sorted(candidates, key=lambda candidate: -candidate[0]):
+        if pool_id in used_pools or index in used_lines:
+            continue
+        used_pools.add(pool_id)
+        used_lines.add(index)
+        matches.append(ReceiptMatch(pool_id, item, lines[index], score))
+    return matches
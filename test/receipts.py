@@ -0,0 +1,116 @@
+"""Offline receipt reading: OpenCV preprocessing and local Tesseract OCR.
+
+Images are deskewed, binarized and cropped to the printed area before OCR,
+which is what Tesseract needs to read thermal-paper photos reliably. The
+text is parsed by ``receipt_parser``. Nothing leaves the machine.
+
+Needs ``opencv-python``, ``numpy`` and ``pytesseract`` plus the ``tesseract``
+binary on PATH. Importing this module loads OpenCV, so check
+``features.missing('receipts')`` and import it where it is used.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence, Union
+
+import cv2
+import numpy as np
+import pytesseract
+
+from receipt_parser import ParsedReceipt, parse_receipt_text
+
+# A path to an image file, or the encoded bytes of an upload
+ReceiptSource = Union[str, bytes]
+
+# Tesseract: assume a single uniform block of text, as receipts are
+_TESSERACT_CONFIG = '--psm 6'
+# Photos wider than this are scaled down before processing
+_MAX_WIDTH = 1600
+# Skew angles smaller than this (in degrees) are left alone
+_MIN_SKEW = 0.5
+
+
+def load_image(source: ReceiptSource) -> np.ndarray:
+    """Decode an image file or uploaded bytes to a grayscale array, or raise ValueError."""
+    if isinstance(source, (bytes, bytearray)):
+        image = cv2.imdecode(np.frombuffer(source, np.uint8), cv2.IMREAD_GRAYSCALE)
+    else:
+        image = cv2.imread(source, cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        raise ValueError('not a readable image')
+    if image.shape[1] > _MAX_WIDTH:
+        scale = _MAX_WIDTH / image.shape[1]
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image
+
+
+def preprocess(image: np.ndarray) -> np.ndarray:
+    """Deskew, binarize and crop a grayscale receipt photo to black text on white."""
+    # Adaptive thresholding copes with the uneven lighting of phone photos
+    blurred = cv2.GaussianBlur(image, (3, 3), 0)
+    binary = cv2.adaptiveThreshold(blurred, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
+                                   cv2.THRESH_BINARY, 31, 15)
+
+    # Text pixels, smeared horizontally into lines, give the skew angle
+    ink = cv2.bitwise_not(binary)
+    lines = cv2.morphologyEx(ink, cv2.MORPH_CLOSE, cv2.getStructuringElement(cv2.MORPH_RECT, (25, 1)))
+    points = cv2.findNonZero(lines)
+    if points is None:
+        return binary
+    angle = cv2.minAreaRect(points)[-1]
+    # minAreaRect reports angles in [0, 90) on OpenCV >= 4.5 and [-90, 0) before
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    if abs(angle) >= _MIN_SKEW:
+        height, width = binary.shape
+        rotation = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        binary = cv2.warpAffine(binary, rotation, (width, height), flags=cv2.INTER_NEAREST,
+                                borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+        ink = cv2.bitwise_not(binary)
+
+    # Crop to the printed area plus a margin; Tesseract reads margins as noise
+    points = cv2.findNonZero(ink)
+    if points is None:
+        return binary
+    x, y, w, h = cv2.boundingRect(points)
+    margin = 10
+    return binary[max(y - margin, 0):y + h + margin, max(x - margin, 0):x + w + margin]
+
+
+def ocr(image: np.ndarray) -> str:
+    """Run Tesseract on a preprocessed receipt image."""
+    return pytesseract.image_to_string(image, config=_TESSERACT_CONFIG)
+
+
+def read_receipt(source: ReceiptSource) -> ParsedReceipt:
+    """Read one receipt image; failures are reported in ``ParsedReceipt.error``."""
+    try:
+        return parse_receipt_text(ocr(preprocess(load_image(source))))
+    except (ValueError, cv2.error, pytesseract.TesseractError) as e:
+        return ParsedReceipt([], None, str(e))
+
+
+def _init_worker():
+    # One receipt per process already uses every core; Tesseract's own
+    # OpenMP threads would only contend with the other workers
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    cv2.setNumThreads(1)
+
+
+def read_receipts(sources: Sequence[ReceiptSource], workers: Optional[int] = None) -> List[ParsedReceipt]:
+    """Read a batch of receipt images in a process pool, in input order.
+
+    Every stage is CPU-bound, so receipts are spread over ``workers``
+    processes (default: one per CPU), each running preprocessing, OCR and
+    parsing end to end. A single receipt is read in the calling process.
+    """
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    if workers <= 1:
+        return [read_receipt(source) for source in sources]
+    # spawn rather than fork: the app's server threads and SQLite
+    # connections must not be copied into the workers
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker) as executor:
+        return list(executor.map(read_receipt, sources, chunksize=max(1, len(sources) // (workers * 4))))
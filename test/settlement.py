@@ -0,0 +1,78 @@
+"""Debt simplification for settling up a group of friends.
+
+Given each member's net balance (positive when the group owes them money),
+``simplify_debts`` returns the transfers that clear every balance. A group
+of n members with non-zero balances never needs more than n - 1 transfers,
+and needs one fewer for every way the members split into disjoint groups
+whose balances already sum to zero. Finding the most such groups is
+exponential, so it is done exactly for up to ``EXACT_LIMIT`` members and
+the largest-debtor-pays-largest-creditor greedy is used beyond that.
+
+Amounts are settled in whole cents.
+"""
+from typing import Dict, List, Tuple
+
+EXACT_LIMIT = 12
+
+
+def simplify_debts(balances: Dict[str, float]) -> List[Tuple[str, str, float]]:
+    """Return (payer, payee, amount) transfers that settle the net balances."""
+    cents = {user: round(amount * 100) for user, amount in balances.items()}
+    members = sorted((user for user, amount in cents.items() if amount), key=lambda user: -abs(cents[user]))
+    # Rounding can leave the group a few cents off zero; absorb it in the largest balance
+    residue = sum(cents[user] for user in members)
+    if residue and members:
+        cents[members[0]] -= residue
+        members = [user for user in members if cents[user]]
+
+    if len(members) <= EXACT_LIMIT:
+        groups = _zero_sum_groups(members, cents)
+    else:
+        groups = [members]
+    return [transfer for group in groups for transfer in _greedy_transfers(group, cents)]
+
+
+def _zero_sum_groups(members: List[str], cents: Dict[str, int]) -> List[List[str]]:
+    """Partition members into the largest number of groups whose balances sum to zero."""
+    count = len(members)
+    sums = [0] * (1 << count)
+    # groups[mask]: most zero-sum groups a sequence of exactly the members in mask can close
+    groups = [0] * (1 << count)
+    for mask in range(1, 1 << count):
+        low = (mask & -mask).bit_length() - 1
+        sums[mask] = sums[mask & (mask - 1)] + cents[members[low]]
+        best = max(groups[mask ^ (1 << i)] for i in range(count) if mask >> i & 1)
+        groups[mask] = best + (sums[mask] == 0)
+
+    # Walk back from the full set: each time the remaining set sums to zero,
+    # the members removed since the previous such point form one group
+    partition, current = [], []
+    mask = (1 << count) - 1
+    while mask:
+        closes = sums[mask] == 0
+        for i in range(count):
+            if mask >> i & 1 and groups[mask ^ (1 << i)] + closes == groups[mask]:
+                break
+        if closes and current:
+            partition.append(current)
+            current = []
+        current.append(members[i])
+        mask ^= 1 << i
+    if current:
+        partition.append(current)
+    return partition
+
+
+def _greedy_transfers(group: List[str], cents: Dict[str, int]) -> List[Tuple[str, str, float]]:
+    """Settle a zero-sum group by repeatedly paying the largest creditor from the largest debtor."""
+    remaining = {user: cents[user] for user in group}
+    transfers = []
+    while True:
+        payer = min(remaining, key=remaining.get, default=None)
+        payee = max(remaining, key=remaining.get, default=None)
+        if payer is None or remaining[payer] >= 0 or remaining[payee] <= 0:
+            return transfers
+        amount = min(-remaining[payer], remaining[payee])
+        remaining[payer] += amount
+        remaining[payee] -= amount
+        transfers.append((payer, payee, amount / 100))
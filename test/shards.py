@@ -0,0 +1,634 @@
+"""Route users to per-community database shards and move communities between them.
+
+A directory database maps each community (a campus or residence) to a
+shard, which is an ordinary database file with the usual schema, and each
+user to their home community. ``ShardRouter`` hands out the
+``DatabaseManager`` of a user's shard, so communities on different shards
+write to different files and never wait on each other's locks.
+
+Friend graphs and matching stay inside a shard. A friend homed on another
+shard can still be added: both shards record the friendship, but neither
+holds the other's grocery list, so matches with such friends come only
+from ``find_remote_matches``, which reads every shard involved and is
+correspondingly slower.
+
+``move_community`` copies a community to another shard while it stays
+online. It copies everything, re-copies the users the change log says
+were written meanwhile, and only pauses the community for the last, short
+catch-up before switching the directory over. Run from the ``test``
+directory::
+
+    python shards.py directory.db add-shard east east.db
+    python shards.py directory.db add-community campus-a east
+    python shards.py directory.db adopt east campus-a
+    python shards.py directory.db move campus-a west
+    python shards.py directory.db status
+"""
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from typing import Dict, List, Optional, Set, Tuple
+
+from database import DatabaseManager
+from instrumentation import QueryStats
+from models import Match, MoveReport
+from pool import ConnectionPool
+
+# A community's sessions wait this long between checks while it is being moved
+MOVE_POLL_SECONDS = 0.05
+
+# ``IN`` one of a JSON array of usernames
+_IN_NAMES = 'IN (SELECT value FROM json_each(:names))'
+
+
+class ShardRouter:
+    def __init__(self, directory_path: str, max_connections: int = 8, cache_size: int = 0,
+                 stats: Optional[QueryStats] = None):
+        """Open the directory at ``directory_path``, creating it if needed.
+
+        Each shard gets a ``DatabaseManager`` with ``max_connections``,
+        ``cache_size`` and ``stats``, opened on first use.
+        """
+        self.max_connections = max_connections
+        self.cache_size = cache_size
+        self.stats = stats
+        # One connection, so PRAGMA data_version tells when another process changed the directory
+        self.directory = ConnectionPool(directory_path, max_connections=1)
+        self._managers: Dict[str, DatabaseManager] = {}
+        self._communities: Dict[str, Tuple[str, bool]] = {}
+        self._homes: Dict[str, Optional[str]] = {}
+        self._data_version = None
+        self._lock = threading.Lock()
+        # Communities whose sessions are paused in this process, and open sessions per community
+        self._gate = threading.Condition()
+        self._paused: Set[str] = set()
+        self._sessions: Dict[str, int] = {}
+        with self.directory.transaction() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS shards (
+                    name TEXT PRIMARY KEY,
+                    path TEXT NOT NULL UNIQUE
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS communities (
+                    name TEXT PRIMARY KEY,
+                    shard TEXT NOT NULL,
+                    -- set while move_community holds the community's writers back
+                    moving BOOLEAN NOT NULL DEFAULT 0,
+                    FOREIGN KEY(shard) REFERENCES shards(name)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS homes (
+                    username TEXT PRIMARY KEY,
+                    community TEXT NOT NULL,
+                    FOREIGN KEY(community) REFERENCES communities(name)
+                )
+            ''')
+            # a community's users, for moves
+            conn.execute('CREATE INDEX IF NOT EXISTS idx_homes_community ON homes (community, username)')
+
+    # Directory
+
+    @contextmanager
+    def _directory(self, write: bool = False):
+        """The directory connection, with the lookup caches current for it."""
+        with (self.directory.transaction() if write else self.directory.connection()) as conn:
+            version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if write or version != self._data_version:
+                self._communities.clear()
+                self._homes.clear()
+                self._data_version = version
+            yield conn
+
+    def add_shard(self, name: str, path: str):
+        """Register a shard and create its database file if needed."""
+        self.manager_for_path(name, path)
+        with self._directory(write=True) as conn:
+            conn.execute('INSERT INTO shards (name, path) VALUES (?, ?)', (name, path))
+
+    def add_community(self, name: str, shard: str):
+        """Place a new community on ``shard``."""
+        with self._directory(write=True) as conn:
+            if not conn.execute('SELECT 1 FROM shards WHERE name = ?', (shard,)).fetchone():
+                raise ValueError(f'No shard named {shard}')
+            conn.execute('INSERT INTO communities (name, shard) VALUES (?, ?)', (name, shard))
+
+    def adopt(self, shard: str, community: str) -> int:
+        """Home every user of ``shard`` who has no community yet in ``community``; return how many.
+
+        For bringing an existing single-file database under the router.
+        """
+        usernames = [row[0] for row in self._shard_users(shard)]
+        with self._directory(write=True) as conn:
+            if conn.execute('SELECT shard FROM communities WHERE name = ?', (community,)).fetchone() != (shard,):
+                raise ValueError(f'{community} is not on shard {shard}')
+            before = conn.total_changes
+            conn.executemany('INSERT OR IGNORE INTO homes (username, community) VALUES (?, ?)',
+                             ((username, community) for username in usernames))
+            return conn.total_changes - before
+
+    def shards(self) -> Dict[str, str]:
+        """Return {shard: database path}."""
+        with self._directory() as conn:
+            return dict(conn.execute('SELECT name, path FROM shards'))
+
+    def communities(self) -> Dict[str, str]:
+        """Return {community: shard}."""
+        with self._directory() as conn:
+            return dict(conn.execute('SELECT name, shard FROM communities'))
+
+    def community_of(self, username: str) -> Optional[str]:
+        """Return the user's home community, or None if they are not registered."""
+        with self._directory() as conn:
+            if username not in self._homes:
+                row = conn.execute('SELECT community FROM homes WHERE username = ?', (username,)).fetchone()
+                self._homes[username] = row[0] if row else None
+            return self._homes[username]
+
+    def _community(self, community: str) -> Tuple[str, bool]:
+        """Return the community's (shard, moving)."""
+        with self._directory() as conn:
+            if community not in self._communities:
+                row = conn.execute('SELECT shard, moving FROM communities WHERE name = ?', (community,)).fetchone()
+                if not row:
+                    raise ValueError(f'No community named {community}')
+                self._communities[community] = (row[0], bool(row[1]))
+            return self._communities[community]
+
+    # Shards
+
+    def manager(self, shard: str) -> DatabaseManager:
+        """Return the DatabaseManager of ``shard``."""
+        with self._lock:
+            db = self._managers.get(shard)
+        if db is not None:
+            return db
+        with self._directory() as conn:
+            row = conn.execute('SELECT path FROM shards WHERE name = ?', (shard,)).fetchone()
+        if not row:
+            raise ValueError(f'No shard named {shard}')
+        return self.manager_for_path(shard, row[0])
+
+    def manager_for_path(self, shard: str, path: str) -> DatabaseManager:
+        with self._lock:
+            if shard not in self._managers:
+                self._managers[shard] = DatabaseManager(path, max_connections=self.max_connections,
+                                                        cache_size=self.cache_size, stats=self.stats)
+            return self._managers[shard]
+
+    def _shard_users(self, shard: str) -> List[tuple]:
+        with self.manager(shard).pool.connection() as conn:
+            return conn.execute('SELECT username FROM users').fetchall()
+
+    def shard_of(self, username: str) -> str:
+        """Return the shard holding the user's data, waiting while their community is being moved."""
+        community = self.community_of(username)
+        if community is None:
+            raise ValueError(f'No user named {username}')
+        return self._shard(community)
+
+    def _shard(self, community: str) -> str:
+        while True:
+            shard, moving = self._community(community)
+            if not moving:
+                return shard
+            time.sleep(MOVE_POLL_SECONDS)
+
+    def for_user(self, username: str) -> DatabaseManager:
+        """Return the DatabaseManager of the user's shard."""
+        return self.manager(self.shard_of(username))
+
+    @contextmanager
+    def session(self, username: str):
+        """Yield the DatabaseManager of the user's shard for the ``with`` block.
+
+        A move of the user's community waits for the sessions open in this
+        process to finish, and new sessions wait for the move, so a write
+        made in a session never lands on the shard the community just left.
+        """
+        community = self.community_of(username)
+        if community is None:
+            raise ValueError(f'No user named {username}')
+        with self._session(community):
+            yield self.for_user(username)
+
+    @contextmanager
+    def _session(self, community: str):
+        with self._gate:
+            while community in self._paused:
+                self._gate.wait()
+            self._sessions[community] = self._sessions.get(community, 0) + 1
+        try:
+            yield
+        finally:
+            with self._gate:
+                self._sessions[community] -= 1
+                self._gate.notify_all()
+
+    def close(self):
+        with self._lock:
+            for db in self._managers.values():
+                db.close_connection()
+            self._managers.clear()
+        self.directory.close()
+
+    # Accounts and friends
+
+    def register_user(self, username: str, hashed_password: str, email: str, community: str) -> bool:
+        """Register a new user in ``community``; False if the username or email is taken."""
+        with self._session(community):
+            shard = self._shard(community)
+            try:
+                with self._directory(write=True) as conn:
+                    conn.execute('INSERT INTO homes (username, community) VALUES (?, ?)', (username, community))
+                    # Committed together with the home, or not at all
+                    if not self.manager(shard).register_user(username, hashed_password, email):
+                        raise sqlite3.IntegrityError('email already exists')
+                return True
+            except sqlite3.IntegrityError:
+                return False
+
+    def login_user(self, username: str, hashed_password: str) -> bool:
+        """Authenticate user login."""
+        if self.community_of(username) is None:
+            return False
+        return self.for_user(username).login_user(username, hashed_password)
+
+    def user_exists(self, username: str) -> bool:
+        return self.community_of(username) is not None
+
+    def add_friend(self, current_user: str, friend_username: str) -> bool:
+        """Add a friend connection, in both users' shards if they differ.
+
+        Returns False if either user is unknown or they are already friends.
+        """
+        if not self.user_exists(friend_username):
+            return False
+        shard, friend_shard = self.shard_of(current_user), self.shard_of(friend_username)
+        if not self.manager(shard).add_friend(current_user, friend_username):
+            return False
+        if friend_shard != shard:
+            self.manager(friend_shard).add_friend(current_user, friend_username)
+        return True
+
+    def remove_friend(self, username: str, friend_username: str) -> bool:
+        """Remove a friend connection, in both users' shards if they differ."""
+        shard = self.shard_of(username)
+        self.manager(shard).remove_friend(username, friend_username)
+        if self.user_exists(friend_username):
+            friend_shard = self.shard_of(friend_username)
+            if friend_shard != shard:
+                self.manager(friend_shard).remove_friend(username, friend_username)
+        return True
+
+    def find_remote_matches(self, username: str) -> Dict[str, List[Match]]:
+        """Return {friend: matches} for the user's friends homed on other shards.
+
+        The cross-shard counterpart of ``find_matching_groceries``: it reads
+        the user's list from their shard and each remote friend's list from
+        theirs, one query per shard, and compares them here.
+        """
+        db = self.for_user(username)
+        by_shard: Dict[str, List[str]] = {}
+        for friend in db.get_friends(username):
+            if self.user_exists(friend):
+                friend_shard = self.shard_of(friend)
+                if friend_shard != self.shard_of(username):
+                    by_shard.setdefault(friend_shard, []).append(friend)
+        if not by_shard:
+            return {}
+
+        query = f'''
+            SELECT username, item, quantity, unit, dimension, base_quantity FROM grocery_lists
+            WHERE username {_IN_NAMES} ORDER BY id
+        '''
+        with db.pool.connection() as conn:
+            own = conn.execute(query, {'names': json.dumps([username])}).fetchall()
+        matches: Dict[str, List[Match]] = {}
+        for friend_shard, friends in by_shard.items():
+            with self.manager(friend_shard).pool.connection() as conn:
+                rows = conn.execute(query, {'names': json.dumps(friends)}).fetchall()
+            # Like the matches table, each friend's first row per item and dimension counts
+            wanted = {}
+            for friend, item, _, _, dimension, base_quantity in rows:
+                wanted.setdefault((friend, item, dimension), base_quantity)
+            for _, item, quantity, unit, dimension, base_quantity in own:
+                for friend in friends:
+                    friend_base = wanted.get((friend, item, dimension))
+                    if friend_base is not None and base_quantity:
+                        matches.setdefault(friend, []).append(
+                            Match(item, quantity, friend_base * quantity / base_quantity, unit))
+        return matches
+
+    # Moving communities
+
+    def move_community(self, community: str, shard: str, drain_seconds: float = 1.0,
+                       max_rounds: int = 5) -> MoveReport:
+        """Move a community's users and their data to ``shard`` while it stays online.
+
+        The community is copied while it keeps writing to its old shard, and
+        then up to ``max_rounds`` times more for the users whose change log
+        entries are newer than the last copy. Then the directory marks it as
+        moving, which holds back new writes from every router; sessions
+        already open in this process are waited for, and ``drain_seconds``
+        gives requests in other processes time to finish. The last catch-up
+        runs under the old shard's write lock, and the directory switches to
+        the new shard before the old copy is deleted.
+
+        Pools move with their buyer and get new pool_ids; grocery rows get
+        new ids. Friendships, balances, claims and payments with users who
+        stay behind are kept on both shards.
+        """
+        source_shard, _ = self._community(community)
+        if source_shard == shard:
+            raise ValueError(f'{community} is already on {shard}')
+        with self._directory() as conn:
+            usernames = {row[0] for row in conn.execute(
+                'SELECT username FROM homes WHERE community = ?', (community,))}
+        source, target = self.manager(source_shard), self.manager(shard)
+        copy = _CommunityCopy(source, target, usernames)
+
+        start = time.perf_counter()
+        seq = copy.copy(None)
+        rounds = 1
+        # Until the community's own users stop changing faster than they are copied
+        while rounds < max_rounds and not copy.changed_since(seq).isdisjoint(usernames | {None}):
+            seq = copy.copy(seq)
+            rounds += 1
+
+        paused = time.perf_counter()
+        with self._gate:
+            self._paused.add(community)
+            while self._sessions.get(community):
+                self._gate.wait()
+        try:
+            with self._directory(write=True) as conn:
+                conn.execute('UPDATE communities SET moving = 1 WHERE name = ?', (community,))
+            time.sleep(drain_seconds)
+            with self._directory() as conn:
+                # Including anyone who registered meanwhile
+                copy.usernames = {row[0] for row in conn.execute(
+                    'SELECT username FROM homes WHERE community = ?', (community,))}
+            with source.pool.transaction():
+                copy.copy(seq, final=True)
+                with self._directory(write=True) as conn:
+                    conn.execute('UPDATE communities SET shard = ?, moving = 0 WHERE name = ?',
+                                 (shard, community))
+                copy.delete_source()
+        except BaseException:
+            with self._directory(write=True) as conn:
+                conn.execute('UPDATE communities SET moving = 0 WHERE name = ?', (community,))
+            raise
+        finally:
+            with self._gate:
+                self._paused.discard(community)
+                self._gate.notify_all()
+        for db in (source, target):
+            if db.cache is not None:
+                db.cache.clear()
+        done = time.perf_counter()
+        return MoveReport(community, source_shard, shard, len(copy.usernames), rounds + 1,
+                          (done - start) * 1000, (done - paused) * 1000)
+
+
+class _CommunityCopy:
+    """Copies a community's rows from one shard to another, some users at a time.
+
+    Copying a user replaces everything the target holds for them, so users
+    can be copied again whenever they change. Pair rows (friends,
+    balances, claims) are copied if either user is in the community.
+    """
+
+    def __init__(self, source: DatabaseManager, target: DatabaseManager, usernames: Set[str]):
+        self.source = source
+        self.target = target
+        self.usernames = usernames
+        # source pool_id -> target pool_id of the pools copied so far
+        self.pool_ids: Dict[int, int] = {}
+        # payments are append-only; those up to this source payment_id are copied
+        self.payment_id = 0
+
+    def changed_since(self, seq: int, conn: Optional[sqlite3.Connection] = None) -> Set[Optional[str]]:
+        """Return the users with change log entries after ``seq``; None stands for every user."""
+        with (nullcontext(conn) if conn is not None else self.source.pool.connection()) as conn:
+            return {row[0] for row in conn.execute('SELECT DISTINCT username FROM change_log WHERE seq > ?',
+                                                   (seq,))}
+
+    def copy(self, since: Optional[int], final: bool = False) -> int:
+        """Copy the community's users changed after the source change ``since``, or all with None.
+
+        Returns the source change seq the target is now current to.
+        """
+        community = {'names': json.dumps(sorted(self.usernames))}
+        with self.source.pool.transaction(immediate=False) as src, self.target.pool.transaction() as dst:
+            seq = src.execute('SELECT COALESCE(MAX(seq), 0) FROM change_log').fetchone()[0]
+            # Read in the same snapshot as the rows, so no change falls between two copies
+            changed = self.changed_since(since, src) if since is not None else {None}
+            # An entry without a username, such as a balance rebuild, may affect anyone
+            usernames = self.usernames if None in changed else changed & self.usernames
+            names = {'names': json.dumps(sorted(usernames))}
+            self._copy_conversions(src, dst)
+
+            dst.execute(f'DELETE FROM users WHERE username {_IN_NAMES}', names)
+            dst.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)', src.execute(
+                f'SELECT username, password, email FROM users WHERE username {_IN_NAMES}', names).fetchall())
+
+            # Triggers keep the target's matches current
+            self._copy_pairs(src, dst, 'friends', 'user1, user2', names)
+            dst.execute(f'DELETE FROM grocery_lists WHERE username {_IN_NAMES}', names)
+            groceries = src.execute(f'''
+                SELECT username, item, quantity, unit FROM grocery_lists WHERE username {_IN_NAMES} ORDER BY id
+            ''', names).fetchall()
+            key_ids = self.target._item_key_ids(item for _, item, _, _ in groceries)
+            dst.executemany('''
+                INSERT INTO grocery_lists (username, item, quantity, unit, item_key_id) VALUES (?, ?, ?, ?, ?)
+            ''', ((*row, key_ids[row[1]]) for row in groceries))
+
+            # Users who stay can join or leave the community's pools
+            joined = {'names': json.dumps(sorted(filter(None, changed)))}
+            pools = self._copy_pools(src, dst, names, joined, community)
+            self._copy_claims(src, dst, names, pools)
+            self._copy_pairs(src, dst, 'balances', 'user1, user2, amount', names)
+
+            last_payment = src.execute('SELECT COALESCE(MAX(payment_id), 0) FROM payments').fetchone()[0]
+            dst.executemany('INSERT INTO payments (payer, payee, amount) VALUES (?, ?, ?)', src.execute(f'''
+                SELECT payer, payee, amount FROM payments
+                WHERE payment_id > :after AND payment_id <= :last AND
+                    (payer {_IN_NAMES} OR payee {_IN_NAMES})
+                ORDER BY payment_id
+            ''', {**community, 'after': self.payment_id, 'last': last_payment}).fetchall())
+            self.payment_id = last_payment
+
+            if final:
+                # Clients poll with sequence numbers from the old shard; keep them increasing
+                if not dst.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'change_log'",
+                                   (seq,)).rowcount:
+                    dst.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('change_log', ?)", (seq,))
+        return seq
+
+    @staticmethod
+    def _copy_conversions(src: sqlite3.Connection, dst: sqlite3.Connection):
+        conversions = set(src.execute('SELECT item, unit, dimension, factor FROM unit_conversions'))
+        for item, unit, dimension, factor in conversions - set(dst.execute(
+                'SELECT item, unit, dimension, factor FROM unit_conversions')):
+            dst.execute('''
+                INSERT INTO unit_conversions (item, unit, dimension, factor) VALUES (?, ?, ?, ?)
+                ON CONFLICT (unit, item) DO UPDATE SET dimension = excluded.dimension, factor = excluded.factor
+            ''', (item, unit, dimension, factor))
+            # Fires grocery_lists_canonical_update, as add_unit_conversion does
+            dst.execute('UPDATE grocery_lists SET unit = unit WHERE unit = ?', (unit,))
+
+    @staticmethod
+    def _copy_pairs(src: sqlite3.Connection, dst: sqlite3.Connection, table: str, columns: str, names: dict):
+        """Replace the target's rows of ``table`` that involve any of ``names`` with the source's."""
+        involving = f'user1 {_IN_NAMES} OR user2 {_IN_NAMES}'
+        dst.execute(f'DELETE FROM {table} WHERE {involving}', names)
+        rows = src.execute(f'SELECT {columns} FROM {table} WHERE {involving}', names).fetchall()
+        placeholders = ', '.join('?' * len(columns.split(',')))
+        dst.executemany(f'INSERT INTO {table} ({columns}) VALUES ({placeholders})', rows)
+
+    def _copy_pools(self, src: sqlite3.Connection, dst: sqlite3.Connection, names: dict, joined: dict,
+                    community: dict) -> List[Tuple[str, str]]:
+        """Copy the pools that ``names`` buy, and the community's pools that ``joined`` belong to.
+
+        Returns the (item, buyer) of the pools copied.
+        """
+        source_ids = {row[0] for row in src.execute(f'''
+            SELECT pool_id FROM purchase_pools WHERE buyer {_IN_NAMES}
+            UNION
+            SELECT p.pool_id FROM pool_members m JOIN purchase_pools p ON p.pool_id = m.pool_id
+            WHERE m.username IN (SELECT value FROM json_each(:joined)) AND
+                p.buyer IN (SELECT value FROM json_each(:community))
+        ''', {**names, 'joined': joined['names'], 'community': community['names']})}
+        # Pools they have left since the last copy
+        copied = {target_id: source_id for source_id, target_id in self.pool_ids.items()}
+        source_ids.update(copied[row[0]] for row in dst.execute(f'''
+            SELECT pool_id FROM pool_members
+            WHERE username {_IN_NAMES} OR username IN (SELECT value FROM json_each(:joined))
+        ''', {**names, 'joined': joined['names']}) if row[0] in copied)
+        if not source_ids:
+            return []
+        pools = {'names': json.dumps(sorted(source_ids))}
+        rows = src.execute('''
+            SELECT pool_id, item, buyer, total_price, is_purchased FROM purchase_pools
+            WHERE pool_id IN (SELECT value FROM json_each(:names))
+        ''', pools).fetchall()
+        members = src.execute('''
+            SELECT pool_id, username, quantity, share, is_purchased FROM pool_members
+            WHERE pool_id IN (SELECT value FROM json_each(:names))
+        ''', pools).fetchall()
+
+        replaced = [(self.pool_ids[source_id],) for source_id in source_ids if source_id in self.pool_ids]
+        dst.executemany('DELETE FROM pool_members WHERE pool_id = ?', replaced)
+        dst.executemany('DELETE FROM purchase_pools WHERE pool_id = ?', replaced)
+        for source_id in source_ids - self.pool_ids.keys():
+            self.pool_ids[source_id] = None
+        # Ids for new pools follow the target's; this transaction holds its write lock
+        next_id = dst.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'purchase_pools'"
+                              ).fetchone()[0]
+        for source_id in sorted(source_ids):
+            if self.pool_ids[source_id] is None:
+                next_id += 1
+                self.pool_ids[source_id] = next_id
+        # Totals start at zero; the pool_members triggers add the members back
+        dst.executemany('''
+            INSERT INTO purchase_pools (pool_id, item, buyer, total_price, is_purchased) VALUES (?, ?, ?, ?, ?)
+        ''', ((self.pool_ids[pool_id], *rest) for pool_id, *rest in rows))
+        dst.executemany('''
+            INSERT INTO pool_members (pool_id, username, quantity, share, is_purchased) VALUES (?, ?, ?, ?, ?)
+        ''', ((self.pool_ids[pool_id], *rest) for pool_id, *rest in members))
+        return [(item, buyer) for _, item, buyer, _, _ in rows]
+
+    @staticmethod
+    def _copy_claims(src: sqlite3.Connection, dst: sqlite3.Connection, names: dict,
+                     pools: List[Tuple[str, str]]):
+        """Copy the claims involving ``names``, and those on ``pools``.
+
+        Replacing a pool's members fires pool_claims_leave, which drops the
+        claims on it of members who are not being copied.
+        """
+        claims = f'''
+            user1 {_IN_NAMES} OR user2 {_IN_NAMES} OR
+            (item, buyer) IN (SELECT value ->> 0, value ->> 1 FROM json_each(:pools))
+        '''
+        parameters = {**names, 'pools': json.dumps(pools)}
+        dst.execute(f'DELETE FROM pool_claims WHERE {claims}', parameters)
+        dst.executemany('INSERT INTO pool_claims (item, user1, user2, buyer) VALUES (?, ?, ?, ?)', src.execute(
+            f'SELECT item, user1, user2, buyer FROM pool_claims WHERE {claims}', parameters).fetchall())
+
+    def delete_source(self):
+        """Delete the community from the source shard; call inside its transaction."""
+        names = {'names': json.dumps(sorted(self.usernames))}
+        with self.source.pool.transaction() as conn:
+            bought = f'SELECT pool_id FROM purchase_pools WHERE buyer {_IN_NAMES}'
+            # Memberships in pools bought by users who stay remain with those pools
+            conn.execute(f'DELETE FROM pool_members WHERE pool_id IN ({bought})', names)
+            conn.execute(f'DELETE FROM purchase_pools WHERE buyer {_IN_NAMES}', names)
+            conn.execute(f'DELETE FROM grocery_lists WHERE username {_IN_NAMES}', names)
+            conn.execute(f'DELETE FROM change_log WHERE username {_IN_NAMES}', names)
+            conn.execute(f'DELETE FROM users WHERE username {_IN_NAMES}', names)
+            # Pair rows stay while the other user is still here
+            gone = 'NOT IN (SELECT username FROM users)'
+            for table, first, second in (('friends', 'user1', 'user2'), ('balances', 'user1', 'user2'),
+                                         ('pool_claims', 'user1', 'user2'), ('payments', 'payer', 'payee')):
+                conn.execute(f'''
+                    DELETE FROM {table}
+                    WHERE ({first} {_IN_NAMES} OR {second} {_IN_NAMES}) AND {first} {gone} AND {second} {gone}
+                ''', names)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('directory', help='directory database')
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('add-shard', help='register a shard database file')
+    command.add_argument('name')
+    command.add_argument('path')
+    command = commands.add_parser('add-community', help='place a new community on a shard')
+    command.add_argument('name')
+    command.add_argument('shard')
+    command = commands.add_parser('adopt', help="home a shard's users without a community in one")
+    command.add_argument('shard')
+    command.add_argument('community')
+    command = commands.add_parser('move', help='move a community to another shard while it stays online')
+    command.add_argument('community')
+    command.add_argument('shard')
+    command.add_argument('--drain-seconds', type=float, default=1.0,
+                         help='time for requests in other processes to finish before the final catch-up')
+    commands.add_parser('status', help='list shards and communities')
+    args = parser.parse_args()
+
+    router = ShardRouter(args.directory)
+    try:
+        if args.command == 'add-shard':
+            router.add_shard(args.name, args.path)
+        elif args.command == 'add-community':
+            router.add_community(args.name, args.shard)
+        elif args.command == 'adopt':
+            print(f'{router.adopt(args.shard, args.community)} users homed in {args.community}')
+        elif args.command == 'move':
+            report = router.move_community(args.community, args.shard, args.drain_seconds)
+            print(f'moved {report.users} users of {report.community} from {report.source} to {report.target} '
+                  f'in {report.total_ms / 1000:.1f} s over {report.rounds} copies; '
+                  f'writes were held back for {report.paused_ms:.0f} ms')
+        else:
+            communities = router.communities()
+            for shard, path in sorted(router.shards().items()):
+                on_shard = sorted(name for name, home in communities.items() if home == shard)
+                print(f"{shard:<12} {path:<30} {', '.join(on_shard) or '-'}")
+    except (ValueError, sqlite3.IntegrityError) as e:
+        print(f'FAIL: {e}')
+        return 1
+    finally:
+        router.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
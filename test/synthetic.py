@@ -0,0 +1,181 @@
+"""Reproducible synthetic populations for benchmarking the data layer.
+
+Writes users, a power-law friend graph, Zipf-distributed grocery lists and
+pairwise purchases straight into a file with the original ``friends.db``
+schema (``PRAGMA user_version = 0``), so ``DatabaseManager`` upgrades it
+through every migration exactly as it would a real database. The same
+arguments always produce the same file. Run from the ``test`` directory::
+
+    python synthetic.py population.db --users 10000 [--seed 0]
+"""
+import argparse
+import itertools
+import math
+import os
+import random
+import sqlite3
+import sys
+from typing import Dict, List
+
+from migrations import _create_base_tables
+from models import UNITS, User
+
+# Every synthetic user's password
+PASSWORD = 'password'
+
+_PRODUCTS = [
+    'milk', 'eggs', 'bread', 'butter', 'cheese', 'yogurt', 'bananas', 'apples', 'oranges', 'grapes',
+    'strawberries', 'blueberries', 'avocados', 'tomatoes', 'potatoes', 'onions', 'garlic', 'carrots',
+    'broccoli', 'spinach', 'lettuce', 'cucumbers', 'peppers', 'mushrooms', 'rice', 'pasta', 'flour',
+    'sugar', 'salt', 'olive oil', 'coffee', 'tea', 'orange juice', 'chicken breast', 'ground beef',
+    'salmon', 'tuna', 'bacon', 'ham', 'tofu', 'beans', 'lentils', 'oats', 'cereal', 'peanut butter',
+    'jam', 'honey', 'chocolate', 'crackers', 'chips', 'water', 'soda', 'toilet paper', 'paper towels',
+    'dish soap', 'laundry detergent', 'shampoo', 'toothpaste', 'diapers', 'cat food',
+]
+_QUALIFIERS = ['', 'organic', 'whole', 'large', 'low-fat', 'free-range', 'bulk', 'family size', 'gluten-free']
+# Typical quantities per unit
+_QUANTITIES = {
+    'kg': [0.5, 1.0, 2.0, 5.0], 'lbs': [1.0, 2.0, 3.0, 10.0], 'pieces': [1.0, 2.0, 6.0, 12.0],
+    'pack': [1.0, 2.0, 4.0], 'box': [1.0, 2.0], 'bottle': [1.0, 2.0, 6.0],
+}
+
+
+def zipf_weights(count: int, exponent: float) -> List[float]:
+    """Cumulative Zipf weights for ranks 1..count, for ``random.choices(cum_weights=...)``."""
+    return list(itertools.accumulate(1 / rank ** exponent for rank in range(1, count + 1)))
+
+
+def catalog(seed: int = 0) -> List[str]:
+    """Every item name, in a fixed popularity order (most popular first)."""
+    names = [f'{qualifier} {product}'.strip() for product in _PRODUCTS for qualifier in _QUALIFIERS]
+    random.Random(seed).shuffle(names)
+    # Plain product names are the most common way to write an item
+    return _PRODUCTS + [name for name in names if name not in _PRODUCTS]
+
+
+def friend_edges(users: int, friends: int, rng: random.Random) -> List[tuple]:
+    """Undirected (new, existing) edges of a preferential-attachment graph.
+
+    Each user after the first few befriends ``friends // 2`` existing users
+    chosen in proportion to how many friends they already have, so the
+    mean degree is about ``friends`` and degrees follow a power law with a
+    few highly connected hubs (the lowest-numbered users).
+    """
+    links = max(1, friends // 2)
+    seed_users = min(users, links + 1)
+    edges = list(itertools.combinations(range(seed_users), 2))
+    # Each user appears once per friendship, so choosing from it is degree-proportional
+    endpoints = [user for edge in edges for user in edge]
+    for new in range(seed_users, users):
+        chosen = set()
+        while len(chosen) < links:
+            chosen.add(rng.choice(endpoints))
+        for existing in chosen:
+            edges.append((new, existing))
+            endpoints.extend((new, existing))
+    return edges
+
+
+def user_name(index: int) -> str:
+    return f'user{index}'
+
+
+def generate(path: str, users: int, friends: int = 10, items: int = 15, purchases: int = 2,
+             seed: int = 0, item_exponent: float = 1.1, unit_exponent: float = 1.0) -> Dict[str, int]:
+    """Write a synthetic population to a new database at ``path``; return its row counts.
+
+    ``friends`` and ``items`` are the mean friends and grocery items per
+    user; ``purchases`` is the number of items per user bought with a
+    friend, about two thirds of them already settled.
+    """
+    if os.path.exists(path):
+        raise FileExistsError(path)
+    rng = random.Random(seed)
+    names = [user_name(index) for index in range(users)]
+    items_by_rank = catalog(seed)
+    item_weights = zipf_weights(len(items_by_rank), item_exponent)
+    unit_weights = zipf_weights(len(UNITS), unit_exponent)
+    password = User.hash_password(PASSWORD)
+
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute('PRAGMA journal_mode = MEMORY')
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('BEGIN')
+        _create_base_tables(conn.cursor())
+        conn.executemany('INSERT INTO users (username, password, email) VALUES (?, ?, ?)',
+                         ((name, password, f'{name}@example.com') for name in names))
+
+        friendships = [[] for _ in range(users)]
+        for user1, user2 in friend_edges(users, friends, rng):
+            friendships[user1].append(user2)
+            friendships[user2].append(user1)
+        conn.executemany('INSERT INTO friends (user1, user2) VALUES (?, ?)',
+                         ((names[user], names[friend]) for user in range(users) for friend in friendships[user]))
+
+        lists = []
+        grocery_rows = []
+        for name in names:
+            # Lognormal list lengths: most lists are short, a few are long
+            length = min(len(items_by_rank), max(1, round(rng.lognormvariate(math.log(items), 0.5))))
+            wanted = set()
+            while len(wanted) < length:
+                wanted.update(rng.choices(items_by_rank, cum_weights=item_weights, k=length - len(wanted)))
+            wanted = sorted(wanted)
+            lists.append(wanted)
+            for item in wanted:
+                unit = rng.choices(UNITS, cum_weights=unit_weights)[0]
+                grocery_rows.append((name, item, rng.choice(_QUANTITIES[unit]), unit))
+        conn.executemany('INSERT INTO grocery_lists (username, item, quantity, unit) VALUES (?, ?, ?, ?)',
+                         grocery_rows)
+
+        purchase_rows = []
+        for user in range(users):
+            if not friendships[user]:
+                continue
+            for item in rng.sample(lists[user], min(purchases, len(lists[user]))):
+                friend = names[rng.choice(friendships[user])]
+                if rng.random() < 2 / 3:
+                    price = round(rng.uniform(2, 60), 2)
+                    purchase_rows.append((item, names[user], price, 1, names[user], friend,
+                                          round(price / 2, 2), round(price / 2, 2)))
+                else:
+                    purchase_rows.append((item, names[user], None, 0, names[user], friend, None, None))
+        conn.executemany('''
+            INSERT INTO purchase_tracking
+                (item, buyer, total_price, is_purchased, user1, user2, user1_share, user2_share)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', purchase_rows)
+        conn.execute('COMMIT')
+    finally:
+        conn.close()
+
+    return {
+        'users': users,
+        'friendships': sum(map(len, friendships)) // 2,
+        'grocery_rows': len(grocery_rows),
+        'purchases': len(purchase_rows),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='database file to create')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--friends', type=int, default=10, help='mean friends per user')
+    parser.add_argument('--items', type=int, default=15, help='mean grocery items per user')
+    parser.add_argument('--purchases', type=int, default=2, help='items per user bought with a friend')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    try:
+        counts = generate(args.path, args.users, args.friends, args.items, args.purchases, args.seed)
+    except FileExistsError:
+        print(f'{args.path} already exists')
+        return 1
+    print(', '.join(f'{count} {name}' for name, count in counts.items()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
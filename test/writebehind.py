@@ -0,0 +1,144 @@
+"""Optional write-behind queue that group-commits DatabaseManager mutations.
+
+``WriteBehind`` runs every mutation submitted to it on a single background
+thread. The thread takes what has queued up within ``window_ms`` of the
+first mutation and commits it as one transaction, each mutation in its own
+savepoint, so a burst of clicks shares one commit and writers never wait
+on each other's locks. A mutation that fails is rolled back on its own and
+its future raises, without failing the rest of its batch.
+
+Reads stay on the caller's thread. Call ``flush(username)`` before reading
+a user's data to see their own writes; futures also resolve only once their
+batch has committed.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, wait
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from database import DatabaseManager
+
+# Mutations that can be queued, and the positions of the users each writes for; none when the
+# users are not among the arguments, as for a pool's members or a conversion everyone uses
+MUTATIONS: Dict[str, Tuple[int, ...]] = {
+    'add_grocery_item': (0,),
+    'add_grocery_items': (0,),
+    'update_grocery_item': (0,),
+    'remove_grocery_item': (0,),
+    'remove_grocery_item_by_id': (0,),
+    'add_friend': (0, 1),
+    'remove_friend': (0, 1),
+    'track_matched_item_purchase': (1, 2),
+    'settle_pool': (),
+    'complete_item_purchase': (),
+    'record_payment': (0, 1),
+    'add_unit_conversion': (),
+}
+
+
+class _Write(NamedTuple):
+    method: str
+    args: tuple
+    usernames: Tuple[str, ...]
+    future: Future
+
+
+class WriteBehind:
+    def __init__(self, db: DatabaseManager, window_ms: float = 5.0, max_batch: int = 256):
+        """Start the writer thread for ``db``.
+
+        Each batch waits at most ``window_ms`` after its first mutation for
+        more, and holds at most ``max_batch`` mutations.
+        """
+        self.db = db
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.batches = 0
+        self._queue: 'queue.Queue[Optional[_Write]]' = queue.Queue()
+        # The latest queued write of each user, and of anyone
+        self._pending: Dict[Optional[str], Future] = {}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, method: str, *args) -> Future:
+        """Queue ``db.<method>(*args)``; the future holds its result once committed, or its exception."""
+        if method not in MUTATIONS:
+            raise ValueError(f'{method} cannot be written behind')
+        if not self._thread.is_alive():
+            raise RuntimeError('the write-behind queue is closed')
+        usernames = tuple(args[position] for position in MUTATIONS[method])
+        future = Future()
+        with self._lock:
+            for username in (*usernames, None):
+                self._pending[username] = future
+            self._queue.put(_Write(method, args, usernames, future))
+        return future
+
+    def flush(self, username: Optional[str] = None, timeout: Optional[float] = None):
+        """Wait until every write queued so far for ``username``, or by anyone, is committed.
+
+        Batches commit in queue order, so the latest write done means all
+        earlier ones are.
+        """
+        with self._lock:
+            future = self._pending.get(username)
+        if future is not None:
+            wait([future], timeout)
+
+    def close(self):
+        """Commit what is queued and stop the writer thread."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            write = self._queue.get()
+            if write is None:
+                break
+            batch = [write]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch:
+                try:
+                    write = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if write is None:
+                    stopping = True
+                    break
+                batch.append(write)
+            self._commit(batch)
+
+    def _commit(self, queued: List[_Write]):
+        batch = [write for write in queued if write.future.set_running_or_notify_cancel()]
+        outcomes = []
+        try:
+            with self.db.pool.transaction():
+                for write in batch:
+                    try:
+                        # A savepoint, so a failed write is undone without its batch
+                        with self.db.pool.transaction():
+                            outcomes.append((getattr(self.db, write.method)(*write.args), None))
+                    except Exception as e:
+                        outcomes.append((None, e))
+        except Exception as e:
+            outcomes = [(None, e)] * len(batch)
+        self.batches += 1
+        if self.db.cache is not None:
+            # Reads on other connections may have cached the old rows while the batch was open
+            if all(write.usernames for write in batch):
+                self.db.cache.bump({username for write in batch for username in write.usernames})
+            else:
+                self.db.cache.clear()
+        finished = {id(write.future) for write in queued}
+        with self._lock:
+            for username, future in list(self._pending.items()):
+                if id(future) in finished:
+                    del self._pending[username]
+        for write, (result, error) in zip(batch, outcomes):
+            if error is None:
+                write.future.set_result(result)
+            else:
+                write.future.set_exception(error)